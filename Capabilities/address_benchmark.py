@@ -0,0 +1,115 @@
+"""Micro-benchmark for the custom address detector of NamedEntityRecognitionService.
+
+Runs the previous substring based detector and the current precompiled one
+over a synthetic corpus of labelled business card lines and reports
+throughput (lines/sec) and line classification errors for both.
+
+Usage: python address_benchmark.py [number_of_cards]
+"""
+from collections import defaultdict
+import random
+import re
+import sys
+import time
+
+from chalicelib.named_entity_recognition_service import (
+    ADDRESS_LINE_PATTERN, NamedEntityRecognitionService)
+
+FIRST_NAMES = ['John', 'Maria', 'Wei', 'Priya', 'Ahmed', 'Sofia', 'Kurt', 'Aldric', 'Drew', 'Flora']
+LAST_NAMES = ['Smith', 'Garcia', 'Chen', 'Patel', 'Hassan', 'Rossi', 'Stein', 'Fleming', 'Drummond', 'Ostrander']
+TITLES = ['First Vice President', 'Director of Strategy', 'Senior Consultant', 'Systems Administrator',
+          'Head of Distribution', 'Master Craftsman', 'Chief Financial Officer', 'Dr. of Dental Surgery',
+          'Assistant Manager', 'Software Engineer']
+COMPANIES = ['Streamline Industries', 'Firstrate Logistics', 'Adstream Media', 'Landmark Holdings',
+             'Bestway Trading', 'Roadrunner Express', 'Trustworthy Partners', 'Fastlane Digital',
+             'Dreamworks Studio', 'Flagstone Capital']
+STREETS = ['Main Street', 'Oak Ave', 'Sunset Blvd', 'Park Road', 'Maple Dr', 'Cedar Lane', 'Elm St',
+           'Broadway Suite 400', 'Harbor Rd', 'Lake Shore Drive']
+CITIES = ['Springfield, IL 62704', 'Austin, TX 78701', 'Boston, MA 02108', 'Seattle, WA 98101',
+          'Denver, CO 80202']
+
+
+def build_corpus(cards, seed=42):
+    """Returns (card texts, labelled lines) where labels are True for address lines"""
+    rng = random.Random(seed)
+    texts = []
+    labelled = []
+    for _ in range(cards):
+        first = rng.choice(FIRST_NAMES)
+        last = rng.choice(LAST_NAMES)
+        company = rng.choice(COMPANIES)
+        domain = company.split()[0].lower()
+        card = [
+            (f'{first} {last}', False),
+            (rng.choice(TITLES), False),
+            (company, False),
+            (f'{first.lower()}.{last.lower()}@{domain}.com', False),
+            (f'www.{domain}.com', False),
+            (f'+1 ({rng.randint(200, 999)}) {rng.randint(200, 999)}-{rng.randint(1000, 9999)}', False),
+            (f'{rng.randint(1, 9999)} {rng.choice(STREETS)}', True),
+            (rng.choice(CITIES), True),
+        ]
+        texts.append('\n'.join(line for line, _ in card))
+        labelled.extend(card)
+    return texts, labelled
+
+
+def legacy_detect_addresses(text, response_list):
+    """Previous implementation, kept here as the baseline"""
+    lines = text.split('\n')
+    address_indicators = ['street', 'avenue', 'ave', 'st', 'road', 'rd', 'lane', 'ln', 'drive', 'dr',
+                          'blvd', 'boulevard', 'suite', 'apt', 'apartment', 'floor', 'fl']
+    zip_pattern = re.compile(r'\b\d{5}(?:-\d{4})?\b')
+    state_pattern = re.compile(r'\b[A-Z]{2}\b')
+    for i, line in enumerate(lines):
+        line_lower = line.lower()
+        if any(indicator in line_lower for indicator in address_indicators) or zip_pattern.search(line):
+            potential_address = line
+            if i + 1 < len(lines):
+                next_line = lines[i + 1]
+                if zip_pattern.search(next_line) or state_pattern.search(next_line):
+                    potential_address += ', ' + next_line
+            if potential_address not in response_list['address']:
+                response_list['address'].append(potential_address)
+
+
+def legacy_is_address(line):
+    indicators = ['street', 'avenue', 'ave', 'st', 'road', 'rd', 'lane', 'ln', 'drive', 'dr',
+                  'blvd', 'boulevard', 'suite', 'apt', 'apartment', 'floor', 'fl']
+    line_lower = line.lower()
+    return any(i in line_lower for i in indicators) or re.search(r'\b\d{5}(?:-\d{4})?\b', line) is not None
+
+
+def is_address(line):
+    return ADDRESS_LINE_PATTERN.search(line) is not None
+
+
+def throughput(detect, texts, line_count):
+    start = time.perf_counter()
+    for text in texts:
+        detect(text, defaultdict(list))
+    elapsed = time.perf_counter() - start
+    return line_count / elapsed
+
+
+def classification_errors(classify, labelled):
+    false_positives = sum(1 for line, label in labelled if classify(line) and not label)
+    false_negatives = sum(1 for line, label in labelled if not classify(line) and label)
+    return false_positives, false_negatives
+
+
+if __name__ == '__main__':
+    cards = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    texts, labelled = build_corpus(cards)
+    service = NamedEntityRecognitionService()
+
+    results = [
+        ('before', legacy_detect_addresses, legacy_is_address),
+        ('after', service._detect_addresses, is_address),
+    ]
+    print(f'{cards} cards, {len(labelled)} lines')
+    for label, detect, classify in results:
+        rate = throughput(detect, texts, len(labelled))
+        false_positives, false_negatives = classification_errors(classify, labelled)
+        print(f'{label:>6}: {rate:12,.0f} lines/sec  '
+              f'false positives: {false_positives:6d}  false negatives: {false_negatives:6d}')
@@ -0,0 +1,289 @@
+"""Offline end-to-end benchmark of the API routes.
+
+Drives the Chalice routes of app.py in process through the chalice test
+client while every AWS call is answered by RecordedAWS, a stand-in hooked
+into the shared boto3 session that returns the recorded responses in
+benchmark_fixtures/aws_responses.json (Textract, Comprehend,
+ComprehendMedical) or synthesizes DynamoDB and S3 responses. No request
+leaves the process, so the numbers are our own overhead: routing, JSON,
+caches, codecs, thread pools and the botocore client stack. Besides the
+HTTP routes it invokes the S3 upload event handler with synthetic events.
+
+For every scenario it reports p50/p95/p99/mean latency, requests/sec and
+the mean time per instrumentation span, and writes them to a JSON file.
+With --baseline it compares p95 against a previous results file and exits
+with status 1 if a scenario got slower than the tolerance allows.
+
+Usage: python api_benchmark.py [--requests N] [--output FILE]
+                               [--baseline FILE] [--tolerance 0.2]
+"""
+from collections import defaultdict
+import hashlib
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_fixtures', 'aws_responses.json')
+USER_ID = 'api-benchmark'
+BUCKET = 'business-cards-bucket2'
+LIST_SIZE = 50
+WARMUP_REQUESTS = 20
+
+
+class StandInResponse:
+    """The part of a botocore HTTP response read after a before-call stand-in"""
+
+    def __init__(self, status_code):
+        self.status_code = status_code
+        self.headers = {}
+        self.content = b''
+
+
+class RecordedAWS:
+    """before-call handler answering AWS calls without sending them.
+
+    Returning (http response, parsed response) from before-call makes
+    botocore skip the network, like botocore's Stubber, but for any call
+    order and any number of calls.
+    """
+
+    def __init__(self, fixtures):
+        self.fixtures = fixtures
+        self.calls = defaultdict(int)
+        # Items of the recognition results table, by image_id
+        self.results = {}
+
+    def register(self, events):
+        events.register('before-parameter-build', self.keep_params)
+        events.register('before-call', self)
+
+    def keep_params(self, params, context, **kwargs):
+        # before-call only sees the serialized request, keep the API parameters
+        context['api_params'] = params
+
+    def __call__(self, model, context, **kwargs):
+        params = context.get('api_params', {})
+        service = kwargs['event_name'].split('.')[1]
+        name = f'{service}.{model.name}'
+        self.calls[name] += 1
+        handler = getattr(self, '_' + name.replace('.', '_').replace('-', '_'), None)
+        if handler is not None:
+            status, parsed = handler(params)
+        elif name in self.fixtures:
+            status, parsed = 200, json.loads(json.dumps(self.fixtures[name]))
+        else:
+            status, parsed = 200, {}
+        parsed.setdefault('ResponseMetadata', {'HTTPStatusCode': status, 'RetryAttempts': 0})
+        return StandInResponse(status), parsed
+
+    def _card(self, user_id, card_id):
+        item = json.loads(json.dumps(self.fixtures['dynamodb.card']))
+        item['user_id'] = {'S': user_id}
+        item['card_id'] = {'S': card_id}
+        return item
+
+    def _comprehend_BatchDetectEntities(self, params):
+        entities = self.fixtures['comprehend.DetectEntities']['Entities']
+        return 200, {'ResultList': [{'Index': i, 'Entities': entities} for i in range(len(params['TextList']))],
+                     'ErrorList': []}
+
+    def _dynamodb_GetItem(self, params):
+        key = params['Key']
+        if 'image_id' in key:
+            item = self.results.get(key['image_id']['S'])
+            return 200, {'Item': item} if item else {}
+        return 200, {'Item': self._card(key['user_id']['S'], key['card_id']['S'])}
+
+    def _dynamodb_PutItem(self, params):
+        item = params['Item']
+        if 'image_id' in item:
+            # The claim's condition always holds, benchmark images are new
+            self.results[item['image_id']['S']] = item
+        return 200, {}
+
+    def _dynamodb_Query(self, params):
+        if params.get('Select') == 'COUNT':
+            return 200, {'Count': LIST_SIZE, 'ScannedCount': LIST_SIZE}
+        user_id = params['ExpressionAttributeValues'][':user_id']['S']
+        items = [self._card(user_id, f'{i:08d}-0000-4000-8000-000000000000')
+                 for i in range(min(params.get('Limit', LIST_SIZE), LIST_SIZE))]
+        return 200, {'Items': items, 'Count': len(items), 'ScannedCount': len(items)}
+
+    def _dynamodb_UpdateItem(self, params):
+        key = params['Key']
+        if 'image_id' in key:
+            values = params['ExpressionAttributeValues']
+            self.results[key['image_id']['S']] = {
+                'image_id': key['image_id'], 'etag': values[':etag'], 'status': values[':status'],
+                'updated_at': values[':now'], params['ExpressionAttributeNames']['#value']: values[':value']}
+            return 200, {}
+        return 200, {'Attributes': self._card(key['user_id']['S'], key['card_id']['S'])}
+
+    def _dynamodb_BatchWriteItem(self, params):
+        return 200, {'UnprocessedItems': {}}
+
+    def _s3_HeadObject(self, params):
+        # A distinct ETag per image, so every recognition misses the OCR cache
+        return 200, {'ETag': '"' + hashlib.md5(params['Key'].encode('utf-8')).hexdigest() + '"'}
+
+    def _s3_GetObject(self, params):
+        return 404, {'Error': {'Code': 'NoSuchKey', 'Message': 'The specified key does not exist.'}}
+
+
+def scenarios():
+    """(name, function of the request number returning method, path, body).
+    The S3 method stands for an upload event of the object at path.
+    """
+    card_id = '00000000-0000-4000-8000-000000000000'
+    return [
+        ('recognize', lambda i: ('POST', f'/images/benchmark-{i}.jpg/recognize_entities', None)),
+        ('precompute', lambda i: ('S3', f'precomputed-{i}.jpg', None)),
+        # The images precomputed by the previous scenario
+        ('recognize_precomputed', lambda i: ('POST', f'/images/precomputed-{i}.jpg/recognize_entities', None)),
+        ('list', lambda i: ('GET', f'/cards/{USER_ID}', None)),
+        ('list_page', lambda i: ('GET', f'/cards/{USER_ID}?limit=20', None)),
+        ('get', lambda i: ('GET', f'/card/{USER_ID}/{card_id}', None)),
+        ('create', lambda i: ('POST', '/cards', {
+            'user_id': USER_ID, 'card_id': None, 'user_names': f'Jane Doe {i}',
+            'telephone_numbers': ['+1 (555) 014-2398'], 'email_addresses': ['jane.doe@acmecloud.com'],
+            'company_name': 'Acme Cloud Services', 'company_website': 'www.acmecloud.com',
+            'company_address': '1200 Market Street, Suite 400, San Francisco, CA 94103',
+            'image_storage': 'jane-doe.jpg'})),
+        ('update', lambda i: ('PUT', '/cards', {
+            'user_id': USER_ID, 'card_id': card_id, 'name': f'Jane Doe {i}',
+            'phone': '+1 (555) 014-2398', 'email': 'jane.doe@acmecloud.com',
+            'website': 'www.acmecloud.com', 'address': '1200 Market Street, Suite 400',
+            'image_storage': 'jane-doe.jpg'})),
+    ]
+
+
+def percentile(sorted_values, fraction):
+    index = min(len(sorted_values) - 1, max(0, round(fraction * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def run(requests):
+    os.environ.setdefault('AWS_ACCESS_KEY_ID', 'benchmark')
+    os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'benchmark')
+    # Only sampled debug logging would write, keep it off
+    os.environ['LOG_SAMPLE_RATE'] = '0'
+
+    import app
+    from chalice.test import Client
+    from chalicelib import aws_clients, instrumentation
+
+    with open(FIXTURES) as f:
+        stand_in = RecordedAWS(json.load(f))
+    # Session handlers are copied into every client created afterwards
+    stand_in.register(aws_clients.session().events)
+    collector = instrumentation.MetricsCollector()
+    instrumentation.set_metrics_sink(collector)
+
+    results = {}
+    with Client(app.app) as client:
+        for name, build in scenarios():
+            for i in range(WARMUP_REQUESTS):
+                request(client, *build(-1 - i))
+            collector.lines.clear()
+
+            latencies = []
+            errors = 0
+            started = time.perf_counter()
+            for i in range(requests):
+                start = time.perf_counter()
+                response = request(client, *build(i))
+                latencies.append((time.perf_counter() - start) * 1000)
+                if response is not None and (response.status_code >= 400 or (
+                        isinstance(response.json_body, dict) and 'error' in response.json_body)):
+                    errors += 1
+            elapsed = time.perf_counter() - started
+
+            records = collector.records()
+            if build(0)[0] == 'S3':
+                errors = sum(1 for record in records if record['StatusCode'] >= 400)
+            spans = defaultdict(list)
+            for record in records:
+                for metric in record['_aws']['CloudWatchMetrics'][0]['Metrics']:
+                    spans[metric['Name']].append(record[metric['Name']])
+
+            latencies.sort()
+            results[name] = {
+                'requests': requests,
+                'errors': errors,
+                'p50_ms': round(percentile(latencies, 0.50), 3),
+                'p95_ms': round(percentile(latencies, 0.95), 3),
+                'p99_ms': round(percentile(latencies, 0.99), 3),
+                'mean_ms': round(statistics.fmean(latencies), 3),
+                'requests_per_second': round(requests / elapsed, 1),
+                'span_mean_ms': {span: round(statistics.fmean(values), 3) for span, values in spans.items()},
+            }
+    return results
+
+
+def request(client, method, path, body):
+    if method == 'S3':
+        # Event handlers answer nothing, failures show up in the metrics
+        client.lambda_.invoke('precompute_entities_jpg', client.events.generate_s3_event(BUCKET, path))
+        return None
+    headers = {'Content-Type': 'application/json'} if body is not None else {}
+    return client.http.request(method, path, headers=headers,
+                               body=json.dumps(body) if body is not None else b'')
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline, tolerance):
+    """Prints the p95 change per scenario and returns the regressed ones"""
+    regressions = []
+    for name, result in results.items():
+        previous = baseline['scenarios'].get(name)
+        if not previous:
+            continue
+        change = result['p95_ms'] / previous['p95_ms'] - 1 if previous['p95_ms'] else 0.0
+        print(f'{name:<22} p95 {previous["p95_ms"]:>9.3f}ms -> {result["p95_ms"]:>9.3f}ms ({change:+.0%})')
+        if change > tolerance:
+            regressions.append(name)
+    return regressions
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+
+    def option(name, default):
+        return args[args.index(name) + 1] if name in args else default
+
+    requests = int(option('--requests', 500))
+    output = option('--output', 'api_benchmark_results.json')
+    results = run(requests)
+
+    print(f'{"scenario":<22} {"p50":>9} {"p95":>9} {"p99":>9} {"req/s":>9} errors')
+    for name, r in results.items():
+        print(f'{name:<22} {r["p50_ms"]:>7.3f}ms {r["p95_ms"]:>7.3f}ms {r["p99_ms"]:>7.3f}ms '
+              f'{r["requests_per_second"]:>9.1f} {r["errors"]:>6}')
+
+    with open(output, 'w') as f:
+        json.dump({
+            'revision': git_revision(),
+            'timestamp': int(time.time()),
+            'python': platform.python_version(),
+            'requests_per_scenario': requests,
+            'scenarios': results,
+        }, f, indent=2)
+    print(f'Results written to {output}')
+
+    if '--baseline' in args:
+        with open(option('--baseline', None)) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, float(option('--tolerance', 0.2)))
+        if regressions:
+            sys.exit(f'p95 regressed for: {", ".join(regressions)}')
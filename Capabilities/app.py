@@ -1,15 +1,32 @@
-from chalice import Chalice, Response
+from chalice import Chalice, Response, BadRequestError, NotFoundError, TooManyRequestsError
 from chalicelib.dynamo_service import DynamoService
+from chalicelib.card_cache import CardCache
 from chalicelib.business_card_list import BusinessCardList
 from chalicelib.business_card import BusinessCard
+from chalicelib import card_codec
+from chalicelib import card_formats
+from chalicelib import aws_clients
+from chalicelib import throttling
+from chalicelib import instrumentation
 from chalicelib import storage_service
 from chalicelib import recognition_service
 from chalicelib import textract_service
+from chalicelib import text_layout
+from chalicelib import recognition_results
+from chalicelib import recognition_jobs
+from chalicelib.ocr_engine import CachedOcrEngine, HedgedOcrEngine
+from chalicelib.image_normalization_service import ImageNormalizationService, NORMALIZED_PREFIX
 # importing the named entity recognition service
 from chalicelib import named_entity_recognition_service
 
 import base64
+import functools
+import hashlib
 import json
+import os
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait
 from urllib.parse import parse_qs
 
 #####
@@ -26,155 +43,684 @@ app.cors = True
 #####
 storage_location = 'business-cards-bucket2'
 table_name = 'BusinessCardsTable'
+# Inverted index for card search: partition key term_key (S), sort key card_id (S)
+search_index_table_name = 'BusinessCardsSearchIndex'
+# GSI of the cards table: partition key user_id (S), sort key name_sort_key (S),
+# see provision.py
+names_index_name = 'CardNamesIndex'
+# Entities precomputed on upload: partition key image_id (S), see provision.py
+recognition_results_table_name = 'RecognitionResultsTable'
+# Bulk recognition jobs: partition key job_id (S), sort key entry (S), see provision.py
+jobs_table_name = 'RecognitionJobsTable'
+# The jobs queue redrives to the dead-letter queue after a few receives,
+# see RecognitionJobQueue.create_queues
+jobs_queue_name = 'RecognitionJobsQueue'
+jobs_dead_letter_queue_name = 'RecognitionJobsDeadLetterQueue'
 storage_service = storage_service.StorageService(storage_location)
 recognition_service = recognition_service.RecognitionService(storage_service)
-textract_service = textract_service.TextractService(storage_service)
-named_entity_recognition_service = named_entity_recognition_service.NamedEntityRecognitionService()
-dynamo_service = DynamoService(table_name)
+# Optional preprocessing: OCR reads a downscaled grayscale variant of each image
+normalize_images = os.environ.get('NORMALIZE_IMAGES', 'false').lower() == 'true'
+normalize_max_dimension = int(os.environ.get('NORMALIZE_MAX_DIMENSION', '2000'))
+image_normalization_service = ImageNormalizationService(storage_service, normalize_max_dimension)
+
+# OCR runs on Textract; when Textract is slower than this percentile of its
+# recent latencies, the image is also sent to Rekognition and the first
+# answer wins. Rekognition is also the fallback when Textract fails.
+ocr_hedging = os.environ.get('OCR_HEDGING', 'true').lower() == 'true'
+ocr_hedge_percentile = float(os.environ.get('OCR_HEDGE_PERCENTILE', '0.95'))
+textract_engine = textract_service.TextractService(storage_service)
+ocr_engine = textract_engine
+hedged_ocr_engine = None
+if ocr_hedging:
+    ocr_engine = hedged_ocr_engine = HedgedOcrEngine(textract_engine, recognition_service,
+                                                     hedge_percentile=ocr_hedge_percentile)
+# OCR results are cached by image content: in memory while the container is
+# warm and in the bucket (under ocr-cache/) across containers. Only Textract
+# results are cached; a Rekognition hedge or fallback answer is served once.
+ocr_cache_size = 256
+ocr_cache = textract_service.OcrResultCache(
+    max_entries=ocr_cache_size,
+    store=textract_service.S3OcrCacheStore(storage_service),
+    engine=textract_engine.name)
+ocr_engine = CachedOcrEngine(ocr_engine, ocr_cache, storage_service, cached_engine=textract_engine.name)
+# remote, local_first or local (see named_entity_recognition_service.NER_MODES)
+ner_mode = os.environ.get('NER_MODE', named_entity_recognition_service.NER_MODE_REMOTE)
+named_entity_recognition_service = named_entity_recognition_service.NamedEntityRecognitionService(mode=ner_mode)
+# Card and list page reads are cached, see CardCache. Invalidations must
+# reach every container, so the cache is only used with the store shared
+# through the bucket (under card-cache/): off or s3
+card_cache_mode = os.environ.get('CARD_CACHE', 'off').lower()
+card_cache_size = 1024
+card_cache_ttl = 60
+card_cache = None
+if card_cache_mode == 's3':
+    card_cache = CardCache(card_cache_size, card_cache_ttl,
+                           store=textract_service.S3OcrCacheStore(storage_service, prefix=''))
+# off: no search index; write: card writes maintain it while searches still
+# filter the user partition (set this, then run provision.py reindex-cards);
+# on: searches read the index too
+search_index_mode = os.environ.get('SEARCH_INDEX', 'off').lower()
+# off: cards are listed by card_id only and unfiltered searches sort them in
+# memory; on: name ordering reads the names index (create it with
+# provision.py create-names-index, then run backfill-name-sort-keys)
+names_index_mode = os.environ.get('NAMES_INDEX', 'off').lower()
+dynamo_service = DynamoService(table_name,
+                               search_index_table_name if search_index_mode in ('write', 'on') else None,
+                               names_index_name if names_index_mode == 'on' else None, cache=card_cache,
+                               search_with_index=search_index_mode == 'on')
+recognition_result_store = recognition_results.RecognitionResultStore(recognition_results_table_name)
+job_store = recognition_jobs.RecognitionJobStore(jobs_table_name)
+job_queue = recognition_jobs.RecognitionJobQueue(jobs_queue_name, jobs_dead_letter_queue_name)
+
+# GET /cards/{user_id} page sizes and orderings
+list_page_size = 50
+list_max_page_size = 100
+list_sort_orders = ('card_id', 'name')
+
+# POST /cards/bulk formats
+bulk_import_content_types = ['text/csv', 'text/vcard', 'text/x-vcard']
+
+# Exports are private files under this prefix, shared through presigned URLs
+export_prefix = 'exports/'
+export_url_expiry = 900
+
+# Uploads under these prefixes are our own derived files, not card images,
+# and are not recognized on upload
+precompute_skip_prefixes = (NORMALIZED_PREFIX, 'ocr-cache/', export_prefix, 'benchmark/')
+# S3 notifications filter on a single suffix, so precompute_entities is
+# subscribed once per image extension and OCR cache entries (.json) and
+# exports (.csv, .vcf) don't invoke it. Suffixes are case sensitive, images
+# with other extensions are recognized on request instead.
+precompute_suffixes = ('.jpg', '.jpeg', '.png', '.tif', '.tiff', '.pdf')
+
+# Direct-to-S3 uploads (POST /images/upload_url)
+upload_content_types = ('image/jpeg', 'image/png', 'image/tiff', 'application/pdf')
+upload_max_bytes = 10 * 1024 * 1024
+upload_url_expiry = 300
+
+# Runs storage writes that overlap with OCR (POST /images:recognize)
+background_executor = ThreadPoolExecutor(max_workers=4)
+
+# Upper bounds for POST /images/recognize_entities:batch. boto3 clients are
+# thread safe, so images are recognized in parallel up to this many at a time.
+batch_max_concurrency = 8
+batch_max_images = 200
+
+# POST /jobs. Messages are sent from a few threads in chunks of
+# jobs_send_chunk images.
+jobs_max_images = 10000
+jobs_send_concurrency = 8
+jobs_send_chunk = 500
+# Job workers take up to jobs_batch_size messages per invocation and
+# recognize their images in parallel. At most jobs_max_concurrency workers
+# run at once, so a large job drains at a steady rate within the AWS rate
+# limits while the rest waits in the queue.
+jobs_batch_size = 10
+jobs_max_concurrency = 5
+# GET /jobs/{job_id} result page sizes
+jobs_page_size = 100
+jobs_max_page_size = 1000
 
 
 #####
 # RESTful endpoints
 #####
+@app.middleware('http')
+def instrument_request(event, get_response):
+    """Times every request: adds a Server-Timing header with the spans of
+    the request (AWS calls and pipeline stages) and emits them as EMF metrics
+    """
+    token = instrumentation.start_request()
+    start = time.perf_counter()
+    try:
+        response = get_response(event)
+    finally:
+        spans = instrumentation.end_request(token)
+    total_ms = (time.perf_counter() - start) * 1000
+
+    response.headers['Server-Timing'] = instrumentation.server_timing(spans, total_ms)
+    route = f"{event.method} {event.context.get('resourcePath', event.path)}"
+    instrumentation.emit_metrics(route, spans, total_ms, response.status_code)
+    return response
+
+
+def throttle_aware(view_function):
+    """Answers AWS throttling that outlasted the client retries with a 429,
+    so callers back off instead of seeing an internal error
+    """
+    @functools.wraps(view_function)
+    def wrapper(*args, **kwargs):
+        try:
+            return view_function(*args, **kwargs)
+        except Exception as e:
+            if throttling.is_throttling(e):
+                print(f"Throttled in {view_function.__name__}: {e}")
+                raise TooManyRequestsError('AWS request rate exceeded, retry later')
+            raise
+    return wrapper
+
+
 @app.route('/images', methods=['POST'], cors=True)
+@throttle_aware
 def upload_image():
     """processes file upload and saves file to storage service"""
     request_data = json.loads(app.current_request.raw_body)
     file_name = request_data['filename']
     file_bytes = base64.b64decode(request_data['filebytes'])
-    print("file_bytes", file_bytes)
-    image_info = storage_service.upload_file(file_bytes, file_name)
+    image_info = store_image(file_bytes, file_name)
 
     return image_info
 
 
-@app.route('/images/{image_id}/recognize_entities', methods=['POST'], cors=True)
-def recognize_image_entities(image_id):
-    """detects then extracts named entities from text in the specified image"""
+@app.route('/images/upload_url', methods=['POST'], cors=True,
+           content_types=['application/json'])
+def create_image_upload_url():
+    """returns a presigned POST for uploading an image directly to storage
+
+    Request body: {"filename": ..., "content_type": ...}
+    The client POSTs the file to "uploadUrl" as multipart/form-data with
+    every entry of "fields" followed by the file, then uses "fileId" as with
+    POST /images.
+    """
+    req_body = app.current_request.json_body or {}
+    file_name = req_body.get('filename')
+    content_type = req_body.get('content_type')
+    if not file_name:
+        raise BadRequestError('filename is required')
+    if content_type not in upload_content_types:
+        raise BadRequestError(f'content_type must be one of {", ".join(upload_content_types)}')
+
+    return storage_service.create_upload_url(file_name, content_type,
+                                             upload_max_bytes, upload_url_expiry)
+
+
+@app.route('/images:recognize', methods=['POST'], cors=True)
+@throttle_aware
+def upload_and_recognize_image():
+    """saves the uploaded file and extracts named entities from it in one request
+
+    Takes the same body as POST /images. OCR runs on the decoded bytes while
+    the file is written to storage in the background, and the response
+    combines the upload info with the detected entities.
+    """
+    etag = upload = None
     try:
-        MIN_CONFIDENCE = 80.0
+        request_data = json.loads(app.current_request.raw_body)
+        file_name = request_data['filename']
+        file_bytes = base64.b64decode(request_data['filebytes'])
+
+        ocr_bytes = file_bytes
+        if normalize_images:
+            with instrumentation.span('normalize'):
+                ocr_bytes = image_normalization_service.normalize(file_bytes)
+        # A single part upload's ETag is the MD5 of its body
+        etag = hashlib.md5(file_bytes).hexdigest()
+        upload = instrumentation.submit(background_executor, claim_and_store_image,
+                                        file_bytes, file_name, ocr_bytes, etag)
+
+        with instrumentation.span('ocr'):
+            text_lines = ocr_engine.detect_text_bytes(ocr_bytes)
+        with instrumentation.span('ner'):
+            entities = named_entity_recognition_service.detect_entities(text_layout.assemble_text(text_lines))
+
+        image_info = upload.result()
+        image_info['entities'] = entities
+        # Not in the background: Lambda freezes the container as soon as the
+        # handler returns, and the upload's bucket event skipped this image
+        save_precomputed_entities(file_name, etag, entities)
+        return image_info
+    except Exception as e:
+        if etag is not None:
+            # Release the claim, taken first by the upload task, so the image
+            # is recognized live on request instead of waiting for it to go stale
+            wait([upload])
+            save_precomputed_entities(file_name, etag, {'error': str(e)})
+        if throttling.is_throttling(e):
+            raise
+        print(f"Error in upload_and_recognize_image: {e}")
+        return {"error": str(e)}
 
-        print(f"Processing image: {image_id}")
-        text_lines = textract_service.detect_text(image_id)
-        ner_lines = []
 
-        ner_text = ""
-        recognized_lines = []
+def claim_and_store_image(file_bytes, file_name, normalized, etag):
+    """Claims the image's precomputed result, then uploads the image. The
+    upload's bucket event fires before OCR here is done and, finding the
+    claim taken, leaves the work to this request.
+    """
+    try:
+        recognition_result_store.claim(file_name, etag)
+    except Exception as e:
+        print(f"Error claiming precomputed entities of {file_name}: {e}")
+    return store_image(file_bytes, file_name, normalized)
 
-        # appending lines with confidence score > 80 to an empty list
-        for line in text_lines:
-            if float(line['confidence']) >= MIN_CONFIDENCE:
-                recognized_lines.append(
-                    line['text']
-                )
 
-        print(recognized_lines)
+def store_image(file_bytes, file_name, normalized=None):
+    """Uploads an image and, when enabled, its normalized variant"""
+    with instrumentation.span('store_image'):
+        image_info = storage_service.upload_file(file_bytes, file_name)
+        if normalize_images and image_normalization_service.is_available():
+            image_normalization_service.store_normalized(file_bytes, file_name, normalized)
+    return image_info
 
-        # appending all recognized lines together to form a text string
-        for i in recognized_lines:
-            ner_text = ner_text + " " + i
-        print(ner_text)
 
-        # calling the named_entity_recognition_service to detected entities from the recognized text
-        ner_lines = named_entity_recognition_service.detect_entities(ner_text)
-        print(ner_lines, "\n")
+@app.route('/images/{image_id}/recognize_entities', methods=['POST'], cors=True)
+@throttle_aware
+def recognize_image_entities(image_id):
+    """detects then extracts named entities from text in the specified image
 
-        return ner_lines
+    Entities precomputed when the image was uploaded are returned as they
+    are; images without a complete result are processed live.
+    """
+    try:
+        entities = precomputed_entities(image_id)
+        if entities is not None:
+            return entities
+        return recognize_entities(image_id)
     except Exception as e:
+        if throttling.is_throttling(e):
+            raise
         print(f"Error in recognize_image_entities: {e}")
         return {"error": str(e)}
 
 
+@app.route('/images/recognize_entities:batch', methods=['POST'], cors=True,
+           content_types=['application/json'])
+def recognize_image_entities_batch():
+    """runs entity recognition for a list of images concurrently
+
+    Request body: {"image_ids": [...], "concurrency": n (optional)}
+    A failing image is reported under "errors" and does not affect the others.
+    """
+    req_body = app.current_request.json_body or {}
+    image_ids = req_body.get('image_ids')
+    if not isinstance(image_ids, list) or not image_ids:
+        raise BadRequestError('image_ids must be a non-empty list')
+    if len(image_ids) > batch_max_images:
+        raise BadRequestError(f'at most {batch_max_images} images can be processed per batch')
+
+    try:
+        concurrency = int(req_body.get('concurrency', batch_max_concurrency))
+    except (ValueError, TypeError):
+        raise BadRequestError('concurrency must be an integer')
+    if concurrency < 1:
+        raise BadRequestError('concurrency must be at least 1')
+    concurrency = min(concurrency, batch_max_concurrency, len(image_ids))
+
+    results = {}
+    errors = {}
+    texts = {}
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = {instrumentation.submit(executor, extract_text, image_id): image_id
+                   for image_id in dict.fromkeys(image_ids)}
+        for future in as_completed(futures):
+            image_id = futures[future]
+            try:
+                texts[image_id] = future.result()
+            except Exception as e:
+                print(f"Error recognizing {image_id}: {e}")
+                errors[image_id] = str(e)
+
+    # NER for all texts at once so Comprehend calls are coalesced in batches
+    ocr_ids = [image_id for image_id in dict.fromkeys(image_ids) if image_id in texts]
+    with instrumentation.span('ner'):
+        entities_list = named_entity_recognition_service.detect_entities_many([texts[i] for i in ocr_ids])
+    for image_id, entities in zip(ocr_ids, entities_list):
+        if 'error' in entities:
+            errors[image_id] = entities['error']
+        else:
+            results[image_id] = entities
+
+    return {"results": results, "errors": errors}
+
+
+def precompute_entities(event):
+    """Recognizes the entities of an image as soon as it is uploaded and
+    stores them for recognize_image_entities to look up
+    """
+    if event.key.startswith(precompute_skip_prefixes):
+        return
+    etag = event.to_dict()['Records'][0]['s3']['object'].get('eTag', '')
+    try:
+        if not recognition_result_store.claim(event.key, etag):
+            return
+    except Exception as e:
+        if throttling.is_throttling(e):
+            raise
+        # e.g. the results table is missing (provision.py create-recognition-results);
+        # retrying the invocation wouldn't help, the image is recognized on request
+        print(f"Error claiming precomputed entities of {event.key}: {e}")
+        return
+
+    token = instrumentation.start_request()
+    start = time.perf_counter()
+    status_code = 200
+    try:
+        entities = recognize_entities(event.key)
+        error = entities_error(entities)
+        if error is not None:
+            status_code = 500
+            recognition_result_store.fail(event.key, etag, error)
+        else:
+            recognition_result_store.complete(event.key, etag, entities)
+    except Exception as e:
+        status_code = 500
+        print(f"Error precomputing entities of {event.key}: {e}")
+        recognition_result_store.fail(event.key, etag, e)
+        if throttling.is_throttling(e):
+            # Lambda retries failed asynchronous invocations, by then the
+            # FAILED result can be claimed again
+            raise
+    finally:
+        spans = instrumentation.end_request(token)
+        instrumentation.emit_metrics('S3 ObjectCreated', spans, (time.perf_counter() - start) * 1000, status_code)
+
+
+for suffix in precompute_suffixes:
+    precompute_handler = app.on_s3_event(bucket=storage_location, events=['s3:ObjectCreated:*'], suffix=suffix,
+                                         name=f'precompute_entities_{suffix[1:]}')(precompute_entities)
+# Every subscription's Lambda runs app.precompute_entities
+precompute_entities = precompute_handler
+
+
+def precomputed_entities(image_id):
+    """Returns the entities precomputed for an image, or None when there is
+    no complete result (not uploaded through the bucket event, still in
+    progress or failed) or the lookup fails
+    """
+    try:
+        with instrumentation.span('precomputed_lookup'):
+            result = recognition_result_store.get(image_id)
+    except Exception as e:
+        print(f"Error looking up precomputed entities of {image_id}: {e}")
+        return None
+    if result is None or result['status'] != recognition_results.STATUS_COMPLETE:
+        return None
+    return result['entities']
+
+
+def entities_error(entities):
+    """Returns why entities are not a complete result: the NER error or the
+    errors of the providers that failed, whose fields may be missing. None
+    if every provider answered.
+    """
+    if 'error' in entities:
+        return entities['error']
+    if entities.get('provider_errors'):
+        return '; '.join(f'{provider}: {error}' for provider, error in entities['provider_errors'].items())
+    return None
+
+
+def save_precomputed_entities(image_id, etag, entities):
+    """Completes a claimed result, or fails it when the entities are not
+    complete so that requests recognize the image live again
+    """
+    try:
+        error = entities_error(entities)
+        if error is not None:
+            recognition_result_store.fail(image_id, etag, error)
+        else:
+            recognition_result_store.complete(image_id, etag, entities)
+    except Exception as e:
+        print(f"Error saving precomputed entities of {image_id}: {e}")
+
+
+@app.route('/jobs', methods=['POST'], cors=True, content_types=['application/json'])
+@throttle_aware
+def create_job():
+    """Queues entity recognition for many images and returns at once
+
+    Request body: {"image_ids": [...]}. Poll GET /jobs/{job_id} for the
+    progress and results.
+    """
+    req_body = app.current_request.json_body or {}
+    image_ids = req_body.get('image_ids')
+    if not isinstance(image_ids, list) or not image_ids:
+        raise BadRequestError('image_ids must be a non-empty list')
+    image_ids = list(dict.fromkeys(image_ids))
+    if len(image_ids) > jobs_max_images:
+        raise BadRequestError(f'at most {jobs_max_images} images can be processed per job')
+
+    job_id = job_store.create_job(len(image_ids))
+    try:
+        with ThreadPoolExecutor(max_workers=jobs_send_concurrency) as executor:
+            futures = [instrumentation.submit(executor, job_queue.send, job_id,
+                                              image_ids[start:start + jobs_send_chunk])
+                       for start in range(0, len(image_ids), jobs_send_chunk)]
+            for future in futures:
+                future.result()
+    except Exception as e:
+        print(f"Error queuing job {job_id}: {e}")
+        job_store.fail_job(job_id, e)
+        raise
+    return Response(body={"job_id": job_id, "status": recognition_jobs.STATUS_QUEUED,
+                          "total": len(image_ids)},
+                    status_code=202)
+
+
+@app.route('/jobs/{job_id}', methods=['GET'], cors=True)
+@throttle_aware
+def get_job(job_id):
+    """Returns the status and counters of a job with a page of its results
+
+    Query params: limit (results per page) and cursor (next_cursor of the
+    previous page).
+    """
+    params = app.current_request.query_params or {}
+    try:
+        limit = int(params.get('limit', jobs_page_size))
+    except ValueError:
+        raise BadRequestError('limit must be an integer')
+    limit = max(1, min(limit, jobs_max_page_size))
+
+    try:
+        job = job_store.get_job(job_id, limit, params.get('cursor'))
+    except ValueError as e:
+        raise BadRequestError(str(e))
+    if job is None:
+        raise NotFoundError(f'job {job_id} not found')
+    return job
+
+
+@app.on_sqs_message(queue=jobs_queue_name, batch_size=jobs_batch_size,
+                    maximum_concurrency=jobs_max_concurrency)
+def process_jobs(event):
+    """Recognizes the images of a batch of job messages in parallel.
+
+    Lambda deletes the batch's messages only if the invocation succeeds, so
+    when some messages fail the successful ones are deleted here and the
+    invocation fails. The failed ones come back after the visibility timeout
+    and move to the dead-letter queue once they have failed too often.
+    """
+    records = list(event)
+    token = instrumentation.start_request()
+    start = time.perf_counter()
+    succeeded = []
+    failed = []
+    try:
+        with ThreadPoolExecutor(max_workers=len(records)) as executor:
+            futures = {instrumentation.submit(executor, process_job_message, record.body): record
+                       for record in records}
+            for future in as_completed(futures):
+                record = futures[future]
+                try:
+                    future.result()
+                except Exception as e:
+                    print(f"Error processing job message {record.to_dict().get('messageId')}: {e}")
+                    failed.append(record)
+                    continue
+                succeeded.append(record)
+
+        if failed and succeeded:
+            job_queue.delete([record.receipt_handle for record in succeeded])
+    finally:
+        spans = instrumentation.end_request(token)
+        instrumentation.emit_metrics('SQS RecognitionJobs', spans, (time.perf_counter() - start) * 1000,
+                                     500 if failed else 200)
+    if failed:
+        raise RuntimeError(f'{len(failed)} of {len(records)} job messages failed')
+
+
+def process_job_message(body):
+    """Recognizes the image of one job message and stores its entities,
+    unless a redelivered message finds them stored already
+    """
+    message = json.loads(body)
+    job_id, image_id = message['job_id'], message['image_id']
+    entities = precomputed_entities(image_id)
+    if entities is None:
+        entities = recognize_entities(image_id)
+    if 'error' in entities:
+        raise RuntimeError(entities['error'])
+    job_store.store_image_result(job_id, image_id, entities=entities)
+
+
+@app.on_sqs_message(queue=jobs_dead_letter_queue_name, batch_size=jobs_batch_size)
+def record_failed_jobs(event):
+    """Records the images of messages that failed too often as failed"""
+    for record in event:
+        try:
+            message = json.loads(record.body)
+            job_id, image_id = message['job_id'], message['image_id']
+        except (ValueError, KeyError, TypeError):
+            print(f"Dropping malformed job message: {record.body}")
+            continue
+        job_store.store_image_result(job_id, image_id, error='recognition failed after retries')
+
+
+def recognize_entities(image_id):
+    """OCR -> layout assembly -> named entity recognition pipeline for one image"""
+    ner_text = extract_text(image_id)
+
+    # calling the named_entity_recognition_service to detected entities from the recognized text
+    with instrumentation.span('ner'):
+        ner_lines = named_entity_recognition_service.detect_entities(ner_text)
+    instrumentation.debug('Entities: %s', ner_lines)
+
+    return ner_lines
+
+
+def extract_text(image_id):
+    """Runs OCR on the image and returns the confident text to feed NER"""
+    instrumentation.debug('Processing image: %s', image_id)
+    ocr_name = image_id
+    if normalize_images:
+        with instrumentation.span('normalize'):
+            ocr_name = image_normalization_service.ensure_normalized(image_id)
+    with instrumentation.span('ocr'):
+        text_lines = ocr_engine.detect_text(ocr_name)
+    ner_text = text_layout.assemble_text(text_lines)
+    instrumentation.debug('NER text: %s', ner_text)
+    return ner_text
+
+
 @app.route('/cards/{user_id}', methods=['GET'], cors=True)
+@throttle_aware
 def get_cards(user_id):
-    """Get the paginated list of cards from a query"""
+    """Get the paginated list of cards from a query
+
+    Query params: limit (page size), cursor (next_cursor of the previous
+    page) and sort (card_id or name, defaults to card_id). With limit or
+    cursor the response is {"cards": [...], "next_cursor": ...} where
+    next_cursor is null on the last page. Without them all cards are
+    returned as a plain list. A cursor is only valid with the sort it was
+    returned for.
+    """
+    params = app.current_request.query_params or {}
+    paginated = 'limit' in params or 'cursor' in params
     try:
-        print(f"Fetching cards for user: {user_id}")
-        
-        # First, check if the user exists in the table
-        try:
-            # Try to scan for this user_id to see if any records exist
-            scan_result = dynamo_service.dynamodb.scan(
-                TableName=dynamo_service.table_name,
-                FilterExpression="user_id = :uid",
-                ExpressionAttributeValues={
-                    ':uid': {'S': user_id}
-                },
-                Limit=1
-            )
-            print(f"Scan result for user {user_id}: {scan_result}")
-            if 'Items' in scan_result and len(scan_result['Items']) == 0:
-                print(f"No items found for user {user_id} in scan")
-            
-            # Check if the table has any data at all
-            sample_scan = dynamo_service.dynamodb.scan(
-                TableName=dynamo_service.table_name,
-                Limit=2
-            )
-            print(f"Sample scan of table (up to 2 items): {sample_scan}")
-        except Exception as e:
-            print(f"Error during diagnostic scan: {e}")
-        
-        # Now proceed with the regular query
-        cardlist_container = dynamo_service.search_cards(user_id)
-        print(f"DynamoDB response: {cardlist_container}")
-        
-        # Check if Items exists in the response
-        if 'Items' not in cardlist_container:
-            print("No 'Items' in DynamoDB response")
-            return []
-            
+        limit = int(params.get('limit', list_page_size))
+    except ValueError:
+        raise BadRequestError('limit must be an integer')
+    limit = max(1, min(limit, list_max_page_size))
+    cursor = params.get('cursor')
+    sort = params.get('sort', 'card_id')
+    if sort not in list_sort_orders:
+        raise BadRequestError(f'sort must be one of {", ".join(list_sort_orders)}')
+
+    try:
+        instrumentation.debug('Fetching cards for user: %s', user_id)
         cards_list = []
-        index = 1
-        for item in cardlist_container['Items']:
+        while True:
             try:
-                # Handle potential missing fields or different data types
-                phone = ''
-                if 'telephone_numbers' in item:
-                    if 'SS' in item['telephone_numbers'] and item['telephone_numbers']['SS']:
-                        phone = item['telephone_numbers']['SS'][0]
-                    elif 'NS' in item['telephone_numbers'] and item['telephone_numbers']['NS']:
-                        phone = item['telephone_numbers']['NS'][0]
-                
-                email = ''
-                if 'email_addresses' in item:
-                    if 'SS' in item['email_addresses'] and item['email_addresses']['SS']:
-                        email = item['email_addresses']['SS'][0]
-                
-                # Use card_names if available, otherwise fallback to company_name
-                name = ''
-                if 'card_names' in item and 'S' in item['card_names']:
-                    name = item['card_names']['S']
-                elif 'company_name' in item and 'S' in item['company_name']:
-                    name = item['company_name']['S']
-                
-                obj = {
-                    'id': index,
-                    'card_id': item.get('card_id', {}).get('S', ''),
-                    'name': name,
-                    'phone': phone,
-                    'email': email,
-                    'website': item.get('company_website', {}).get('S', ''),
-                    'address': item.get('company_address', {}).get('S', ''),
-                    'image_storage': item.get('image_storage', {}).get('S', '')
-                }
-                print(f"Processed item {index}: {obj}")
-                cards_list.append(obj)
-                index += 1
-            except Exception as e:
-                print(f"Error processing item: {e}")
-                print(f"Problematic item: {item}")
-                continue
-
-        print(f"Returning {len(cards_list)} cards")
-        return cards_list
+                items, cursor = dynamo_service.list_cards(user_id, limit, cursor, by_name=sort == 'name')
+            except ValueError as e:
+                raise BadRequestError(str(e))
+
+            for item in items:
+                try:
+                    cards_list.append(card_codec.list_row(item, len(cards_list) + 1))
+                except Exception as e:
+                    print(f"Error processing item: {e}")
+                    instrumentation.debug('Problematic item: %s', item)
+
+            if paginated or cursor is None:
+                break
+
+        instrumentation.debug('Returning %d cards', len(cards_list))
+        if paginated:
+            return conditional_response({"cards": cards_list, "next_cursor": cursor})
+        return conditional_response(cards_list)
+    except BadRequestError:
+        raise
     except Exception as e:
+        if throttling.is_throttling(e):
+            raise
         print(f"Error in get_cards: {e}")
         return {"error": str(e)}
 
 
+@app.route('/cards/{user_id}/export', methods=['GET'], cors=True)
+@throttle_aware
+def export_cards(user_id):
+    """Exports all cards of a user as a CSV or vCard file
+
+    Query params: format (csv or vcard, defaults to vcard) and version
+    (vCard version 3.0 or 4.0, defaults to 3.0). Cards are serialized as
+    they are read and written to storage in parts; the response holds a
+    presigned download URL for the file.
+    """
+    params = app.current_request.query_params or {}
+    export_format = params.get('format', 'vcard').lower()
+    version = params.get('version', '3.0')
+    if export_format == 'csv':
+        extension, content_type = 'csv', 'text/csv; charset=utf-8'
+    elif export_format == 'vcard':
+        extension, content_type = 'vcf', 'text/vcard; charset=utf-8'
+        if version not in card_formats.VCARD_VERSIONS:
+            raise BadRequestError(f'version must be one of {", ".join(card_formats.VCARD_VERSIONS)}')
+    else:
+        raise BadRequestError('format must be csv or vcard')
+
+    count = 0
+
+    def counted_cards():
+        nonlocal count
+        for card in dynamo_service.iter_cards(user_id):
+            count += 1
+            yield card
+
+    if export_format == 'csv':
+        chunks = card_formats.iter_csv_export(counted_cards())
+    else:
+        chunks = card_formats.iter_vcard_export(counted_cards(), version)
+
+    file_name = f'{export_prefix}{user_id}/{uuid.uuid4()}.{extension}'
+    with storage_service.open_writer(file_name, content_type) as writer:
+        for chunk in chunks:
+            writer.write(chunk)
+
+    return {
+        "count": count,
+        "format": export_format,
+        "fileId": file_name,
+        "downloadUrl": storage_service.create_download_url(file_name, export_url_expiry,
+                                                           f'cards.{extension}'),
+        "expiresIn": export_url_expiry
+    }
+
+
 @app.route('/cards', methods=['POST'], cors=True,
            content_types=['application/json'])
+@throttle_aware
 def post_card():
     """Creates a card"""
 
@@ -196,8 +742,40 @@ def post_card():
 
 
 
+@app.route('/cards/bulk', methods=['POST'], cors=True,
+           content_types=bulk_import_content_types)
+@throttle_aware
+def post_cards_bulk():
+    """Imports many cards from a CSV or vCard document
+
+    Query params: user_id (owner of the cards). The format follows the
+    Content-Type header (text/csv or text/vcard). CSV needs a header row,
+    see card_formats.CSV_COLUMNS. Returns a per-row report.
+    """
+    params = app.current_request.query_params or {}
+    user_id = params.get('user_id')
+    if not user_id:
+        raise BadRequestError('user_id query parameter is required')
+
+    content_type = app.current_request.headers.get('content-type', '').split(';')[0].strip().lower()
+    lines = card_formats.iter_text_lines(app.current_request.raw_body)
+    if content_type == 'text/csv':
+        rows = card_formats.iter_csv_cards(lines, user_id)
+    else:
+        rows = card_formats.iter_vcard_cards(lines, user_id)
+
+    try:
+        report = dynamo_service.store_cards(rows)
+    except UnicodeDecodeError:
+        raise BadRequestError('body must be UTF-8 encoded')
+
+    created = sum(1 for row in report if row['status'] == 'created')
+    return {"created": created, "failed": len(report) - created, "rows": report}
+
+
 @app.route('/cards', methods=['PUT'], cors=True,
            content_types=['application/json'])
+@throttle_aware
 def put_card():
     """Updates a card"""
     req_body = app.current_request.json_body
@@ -218,14 +796,47 @@ def put_card():
 
 
 @app.route('/cards/{user_id}/{card_id}', methods=['DELETE'], cors=True)
+@throttle_aware
 def delete_card(user_id, card_id):
     """Deletes a card"""
     dynamo_service.delete_card(user_id, card_id)
 
 @app.route('/card/{user_id}/{card_id}', methods=['GET'], cors=True)
+@throttle_aware
 def get_card(user_id, card_id):
     """Query a specific card by id"""
-    return dynamo_service.get_card(user_id, card_id)
+    card = dynamo_service.get_card(user_id, card_id)
+    return conditional_response(card_codec.to_dict(card)) if card else None
+
+
+def conditional_response(body):
+    """Returns body as JSON with an ETag, or an empty 304 response when the
+    request's If-None-Match already has that ETag
+    """
+    payload = json.dumps(body, separators=(',', ':'))
+    etag = '"' + hashlib.sha256(payload.encode('utf-8')).hexdigest()[:32] + '"'
+    # Browsers revalidate before reusing their copy
+    headers = {'ETag': etag, 'Cache-Control': 'private, no-cache'}
+
+    if_none_match = (app.current_request.headers or {}).get('if-none-match', '')
+    tags = [tag.strip().replace('W/', '', 1) for tag in if_none_match.split(',')]
+    if etag in tags or '*' in tags:
+        return Response(body='', status_code=304, headers=headers)
+    headers['Content-Type'] = 'application/json'
+    return Response(body=payload, status_code=200, headers=headers)
+
+@app.route('/stats', methods=['GET'], cors=True)
+def get_stats():
+    """Returns the counters of the container: AWS throttling and rate
+    limiting per operation, OCR hedging, cache hit rates and NER calls
+    """
+    return {
+        "aws": aws_clients.get_stats(),
+        "ocr": hedged_ocr_engine.get_stats() if hedged_ocr_engine else {},
+        "ocr_cache": ocr_cache.get_stats(),
+        "card_cache": card_cache.get_stats() if card_cache else {},
+        "ner": named_entity_recognition_service.get_stats(),
+    }
 
 @app.route('/test', methods=['POST'], cors=True)
 def handler():
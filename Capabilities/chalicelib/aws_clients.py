@@ -0,0 +1,140 @@
+"""Lazily created, process wide boto3 clients.
+
+Creating a client loads its service model, which is a large part of a cold
+start. Services ask this registry for their clients when they make their
+first call instead of building them in their constructors, so a request
+only pays for the clients it uses. All clients share one boto3 session.
+
+Clients are throttle aware: they retry in adaptive mode (which also slows
+the client down while the service throttles), have connection pools sized
+for the thread pools that use them, and calls to operations listed in
+RATE_LIMITS wait for a token of a per-operation bucket before being sent.
+Throttled attempts and rate limiter waits are counted, see get_stats.
+"""
+from collections import defaultdict
+import json
+import os
+import threading
+
+import boto3
+from botocore.config import Config
+
+from chalicelib import instrumentation
+from chalicelib.throttling import THROTTLING_ERROR_CODES, TokenBucket
+
+REGION = 'us-east-1'
+
+# Attempts per call, including the first one, in adaptive retry mode
+MAX_ATTEMPTS = 8
+DEFAULT_POOL_CONNECTIONS = 10
+# Connections per client; NER, batch and hedged OCR call these from thread pools
+POOL_CONNECTIONS = {
+    'comprehend': 32,
+    'comprehendmedical': 32,
+    'dynamodb': 32,
+    'rekognition': 16,
+    's3': 32,
+    'sqs': 16,
+    'textract': 16,
+}
+# Client side limits in calls per second for each "service.Operation", set
+# to the account's TPS quotas. AWS_RATE_LIMITS (a JSON object of the same
+# shape) overrides or adds entries.
+RATE_LIMITS = {
+    'textract.DetectDocumentText': 10,
+    'textract.AnalyzeDocument': 10,
+    'comprehend.DetectEntities': 20,
+    'comprehend.BatchDetectEntities': 10,
+    'comprehendmedical.DetectEntitiesV2': 20,
+    'rekognition.DetectText': 50,
+}
+RATE_LIMITS.update(json.loads(os.environ.get('AWS_RATE_LIMITS', '{}')))
+
+_session = None
+_clients = {}
+# Sessions and client creation are not thread safe
+_lock = threading.Lock()
+
+_buckets = {name: TokenBucket(rate) for name, rate in RATE_LIMITS.items()}
+_stats_lock = threading.Lock()
+_stats = {'throttled_attempts': defaultdict(int), 'rate_limited_calls': defaultdict(int),
+          'rate_limited_seconds': defaultdict(float)}
+
+
+def session():
+    """Returns the boto3 session shared by every client"""
+    global _session
+    with _lock:
+        if _session is None:
+            _session = boto3.session.Session(region_name=REGION)
+        return _session
+
+
+def client(service_name):
+    """Returns the shared client of an AWS service, creating it on first use
+
+    Args:
+        service_name (str): boto3 service name, e.g. 's3'
+
+    Returns:
+        botocore.client.BaseClient: Client of the service (clients are thread safe)
+    """
+    existing = _clients.get(service_name)
+    if existing is not None:
+        return existing
+
+    shared_session = session()
+    with _lock:
+        if service_name not in _clients:
+            config = Config(retries={'mode': 'adaptive', 'max_attempts': MAX_ATTEMPTS},
+                            max_pool_connections=POOL_CONNECTIONS.get(service_name, DEFAULT_POOL_CONNECTIONS))
+            new_client = shared_session.client(service_name, config=config)
+            instrumentation.instrument_client(new_client, service_name)
+            new_client.meta.events.register('before-call', _rate_limit(service_name))
+            new_client.meta.events.register('needs-retry', _count_throttling(service_name))
+            _clients[service_name] = new_client
+        return _clients[service_name]
+
+
+def _rate_limit(service_name):
+    def handler(model, **kwargs):
+        name = f'{service_name}.{model.name}'
+        bucket = _buckets.get(name)
+        if bucket is None:
+            return
+        waited = bucket.acquire()
+        if waited:
+            with _stats_lock:
+                _stats['rate_limited_calls'][name] += 1
+                _stats['rate_limited_seconds'][name] += waited
+    return handler
+
+
+def _count_throttling(service_name):
+    def handler(response=None, operation=None, **kwargs):
+        # response is (http response, parsed body), None on connection errors
+        if response is None or operation is None:
+            return
+        if response[1].get('Error', {}).get('Code') in THROTTLING_ERROR_CODES:
+            with _stats_lock:
+                _stats['throttled_attempts'][f'{service_name}.{operation.name}'] += 1
+    return handler
+
+
+def get_stats():
+    """Returns throttling counters per "service.Operation": attempts the
+    service throttled (retried or not) and calls delayed by the rate limiter
+    """
+    with _stats_lock:
+        return {
+            'throttled_attempts': dict(_stats['throttled_attempts']),
+            'rate_limited_calls': dict(_stats['rate_limited_calls']),
+            'rate_limited_seconds': {name: round(seconds, 3)
+                                     for name, seconds in _stats['rate_limited_seconds'].items()},
+        }
+
+
+def created_clients():
+    """Returns the names of the services whose clients exist so far"""
+    with _lock:
+        return sorted(_clients)
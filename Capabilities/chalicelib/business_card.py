@@ -1,13 +1,18 @@
 import json
 
 class BusinessCard:
+    """Contact information of a business card. See card_codec for the
+    conversion to and from DynamoDB items.
+    """
+    __slots__ = ('user_id', 'card_id', 'names', 'telephone_numbers', 'email_addresses',
+                 'company_name', 'company_website', 'company_address', 'image_storage')
 
     def __init__(self,
                  user_id=None,
                  card_id=None,
                  names='',
-                 telephone_numbers=[],
-                 email_addresses=[],
+                 telephone_numbers=None,
+                 email_addresses=None,
                  company_name='',
                  company_website='',
                  company_address='',
@@ -16,8 +21,8 @@ class BusinessCard:
         self.user_id = user_id
         self.card_id = card_id
         self.names = str(names)
-        self.telephone_numbers = telephone_numbers
-        self.email_addresses = email_addresses
+        self.telephone_numbers = telephone_numbers if telephone_numbers is not None else []
+        self.email_addresses = email_addresses if email_addresses is not None else []
         self.company_name = company_name
         self.company_website = company_website
         self.company_address = company_address
@@ -33,57 +38,8 @@ class BusinessCard:
         return response
 
     def __repr__(self):
-        # return self.names
-        return json.dumps(self,
-                          default=lambda o: o.__dict__, sort_keys=True, indent=4)
+        return f'BusinessCard(user_id={self.user_id!r}, card_id={self.card_id!r}, names={self.names!r})'
 
     def __str__(self):
-        # return self.names
-        return json.dumps(self,
-                          default=lambda o: o.__dict__, sort_keys=True, indent=4)
-
-    def toDynamoFormat(self, isUpdate=False):
-        # Ensure we have valid data for DynamoDB
-        # String Sets (SS) must not be empty
-        telephone_numbers = [str(tn) for tn in self.telephone_numbers]
-        if not telephone_numbers:
-            telephone_numbers = ['None']
-            
-        email_addresses = self.email_addresses
-        if not email_addresses:
-            email_addresses = ['none@example.com']
-
-        value = {
-            'user_id': {'S': str(self.user_id)},
-            'card_id': {'S': str(self.card_id)},
-            'card_names': {'S': self.names or 'Unknown'},
-            'telephone_numbers': {'SS': telephone_numbers},
-            'email_addresses': {'SS': email_addresses},
-            'company_name': {'S': self.company_name or 'Unknown'},
-            'company_website': {'S': str(self.company_website or '')},
-            'company_address': {'S': self.company_address or ''},
-            'image_storage': {'S': self.image_storage or ''},
-        }
-
-        if isUpdate:
-            # Ensure we have valid data for DynamoDB updates
-            # String Sets (SS) must not be empty
-            telephone_numbers = [str(tn) for tn in self.telephone_numbers]
-            if not telephone_numbers:
-                telephone_numbers = ['None']
-                
-            email_addresses = self.email_addresses
-            if not email_addresses:
-                email_addresses = ['none@example.com']
-                
-            value = {
-                # 'user_id': {'Value': {'S': self.user_id}, 'Action': 'PUT'},
-                'card_names': {'Value': {'S': self.names or 'Unknown'}, 'Action': 'PUT'},
-                'telephone_numbers': {'Value': {'SS': telephone_numbers},  'Action': 'PUT'},
-                'email_addresses': {'Value': {'SS': email_addresses},  'Action': 'PUT'},
-                'company_name': {'Value': {'S': self.company_name or 'Unknown'},  'Action': 'PUT'},
-                'company_website': {'Value': {'S': str(self.company_website or '')},  'Action': 'PUT'},
-                'company_address': {'Value': {'S': self.company_address or ''},  'Action': 'PUT'},
-                'image_storage': {'Value': {'S': self.image_storage or ''},  'Action': 'PUT'}
-            }
-        return value
+        return json.dumps({slot: getattr(self, slot) for slot in self.__slots__},
+                          sort_keys=True, indent=4)
@@ -1,17 +1,23 @@
+import heapq
+from itertools import islice
 from math import ceil
-from chalicelib.business_card import BusinessCard
+from chalicelib import card_codec
 
 class BusinessCardList:
     """This class encapsulates a list of BusinessCard objects and stores
     control information for pagination purpuses
     """
-    def __init__(self, search_result, page, pagesize):
+    def __init__(self, search_result, page, pagesize, count=None):
         """Constructor
 
         Args:
-            search_result (dict): this is the raw result received from a call to dynamodb scan api
+            search_result (dict or iterable): this is the raw result received from a call to dynamodb scan api,
+                or an iterable of BusinessCard objects such as DynamoService.iter_cards
             page (int): Page number requested
             pagesize (int): Number of items per page
+            count (int, optional): Total number of cards when search_result is an iterable
+                already sorted by name, such as DynamoService.iter_cards_by_name. Only the
+                cards up to the requested page are then read from it. Defaults to None.
         """
         self.raw_result = search_result
         self.cards = []
@@ -21,48 +27,28 @@ class BusinessCardList:
         self.numpages = 0
 
         # Create card object list
-        self.__build_list()
+        self.__build_list(count)
 
-    def __build_list(self):
+    def __build_list(self, count):
         """Internal method for extracting information from dynamodb results and
         create BusinessCard objects with pagination
         """
-        items = self.raw_result['Items']
-        self.count = int(self.raw_result['Count'])
-
-        # Extract card information
-        for item in items:
-
-            c = BusinessCard()
-
-            if item.__contains__('card_id'):
-                c.card_id = item['card_id']['S']
-
-            if item.__contains__('user_id'):
-                c.user_id = item['user_id']['S']
-
-            if item.__contains__('card_names'):
-                c.names = item['card_names']['S']
-
-            if item.__contains__('telephone_numbers'):
-                c.telephone_numbers = item['telephone_numbers']['SS']
-
-            if item.__contains__('email_addresses'):
-                c.email_addresses = item['email_addresses']['SS']
-
-            if item.__contains__('company_name'):
-                c.company_name = item['company_name']['S']
-
-            if item.__contains__('company_website'):
-                c.company_website = item['company_website']['S']
-
-            if item.__contains__('company_address'):
-                c.company_address = item['company_address']['S']
-
-            self.cards.append(c)
-
-        # Sort cards by person name
-        self.cards.sort(key=lambda x: x.names)
+        if isinstance(self.raw_result, dict):
+            cards = (card_codec.from_item(item) for item in self.raw_result['Items'])
+        else:
+            cards = iter(self.raw_result)
+
+        # Only the cards up to the requested page are kept, never the whole result
+        needed = max(self.pagesize * max(self.page, 1), 0)
+        if count is not None:
+            self.count = count
+            self.cards = list(islice(cards, needed))
+        else:
+            counted = self.__counted(cards)
+            self.cards = heapq.nsmallest(needed, counted, key=card_codec.card_sort_key)
+            # nsmallest returns at once when nothing is needed, count the rest anyway
+            for _ in counted:
+                pass
 
         # Calculate indexes for pagination in sorted results
         start_index = 0
@@ -85,8 +71,11 @@ class BusinessCardList:
         # Retrieve elements by index bounds
         self.cards = self.cards[start_index:end_index]
 
-        # print(start_index, ' ', end_index)
-
+    def __counted(self, cards):
+        """Yields cards while counting them into self.count"""
+        for card in cards:
+            self.count += 1
+            yield card
 
     def get_list(self):
         """Return the list of BusinessCard objects
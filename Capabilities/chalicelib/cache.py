@@ -0,0 +1,85 @@
+from collections import OrderedDict
+import threading
+import time
+
+
+_MISSING = object()
+
+
+class LRUCache:
+    """Bounded, thread-safe least-recently-used cache kept in process memory.
+
+    Entries survive for the lifetime of a warm Lambda container, or ttl
+    seconds when given, and are evicted oldest-first once max_entries is
+    reached.
+    """
+
+    def __init__(self, max_entries=256, ttl=None):
+        """Constructor
+
+        Args:
+            max_entries (int, optional): Maximum number of entries kept. Defaults to 256.
+            ttl (float, optional): Seconds an entry stays valid after it is stored. Defaults to None (no expiry).
+        """
+        self.max_entries = int(max_entries)
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """Returns the cached value for key and marks it as recently used
+
+        Args:
+            key (str): Cache key
+            default (optional): Value returned when key is not cached. Defaults to None.
+
+        Returns:
+            object: Cached value or default
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+            value, expires_at = entry
+            if expires_at is not None and expires_at <= time.monotonic():
+                del self._entries[key]
+                return default
+            self._entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        """Stores value under key, evicting the least recently used entry if full
+
+        Args:
+            key (str): Cache key
+            value (object): Value to cache
+        """
+        if self.max_entries <= 0:
+            return
+        expires_at = time.monotonic() + self.ttl if self.ttl is not None else None
+        with self._lock:
+            self._entries[key] = (value, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        """Removes key from the cache if present
+
+        Args:
+            key (str): Cache key
+        """
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        """Removes every entry from the cache"""
+        with self._lock:
+            self._entries.clear()
+
+    def __contains__(self, key):
+        return self.get(key, _MISSING) is not _MISSING
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
@@ -0,0 +1,106 @@
+import hashlib
+import json
+import threading
+import uuid
+
+from chalicelib.cache import LRUCache
+
+
+class CardCache:
+    """Read-through cache for card items and list pages of DynamoService.
+
+    Entries live in a TTL bounded in-process LRU and, optionally, in a
+    persistent store shared by containers (any object with get/put/delete of
+    JSON values, e.g. LocalOcrCacheStore). Values are raw DynamoDB items, so
+    they are JSON serializable and decoded on every hit like a fresh read.
+
+    Every key includes a per-user generation: a write replaces the user's
+    generation, which makes all of their cached cards and pages unreachable
+    at once, including entries put by reads that were in flight during the
+    write. With a store the generation is always read from it, so a write
+    through any container invalidates the entries of all of them. Without a
+    store other containers keep their own generation until it expires after
+    ttl seconds, and serve stale cards meanwhile.
+    """
+
+    def __init__(self, max_entries=1024, ttl=60, store=None):
+        """Constructor
+
+        Args:
+            max_entries (int, optional): Size of the in-process LRU tier. Defaults to 1024.
+            ttl (float, optional): Seconds an entry is served from memory. Defaults to 60.
+            store (optional): Persistent tier. Defaults to None.
+        """
+        self.memory = LRUCache(max_entries, ttl)
+        self.store = store
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0}
+
+    def _store_key(self, key):
+        return 'card-cache/' + hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+    def _get(self, key):
+        value = self.memory.get(key)
+        if value is None and self.store:
+            value = self.store.get(self._store_key(key))
+            if value is not None:
+                self.memory.put(key, value)
+        return value
+
+    def _put(self, key, value):
+        self.memory.put(key, value)
+        if self.store:
+            self.store.put(self._store_key(key), value)
+
+    def _generation(self, user_id):
+        key = f'generation:{user_id}'
+        if self.store:
+            # Not from memory, another container may have replaced it
+            generation = self.store.get(self._store_key(key))
+        else:
+            generation = self.memory.get(key)
+        if generation is None:
+            generation = uuid.uuid4().hex
+            self._put(key, generation)
+        return generation
+
+    def _count(self, stat):
+        with self._lock:
+            self._stats[stat] += 1
+
+    def card_key(self, user_id, card_id):
+        """Returns the key of a card, to be read before the database so that a
+        write during the read leaves the result under the old generation
+        """
+        return f'card:{self._generation(user_id)}:{user_id}:{card_id}'
+
+    def page_key(self, user_id, *params):
+        """Returns the key of a page of a user's cards listed with params"""
+        return f'page:{self._generation(user_id)}:{user_id}:' + json.dumps(params)
+
+    def get(self, key):
+        """Returns the cached value for key, or None on a miss"""
+        value = self._get(key)
+        self._count('misses' if value is None else 'hits')
+        return value
+
+    def put(self, key, value):
+        """Caches value under a key returned by card_key or page_key"""
+        self._put(key, value)
+
+    def invalidate(self, user_id):
+        """Drops every cached card and page of a user"""
+        self._put(f'generation:{user_id}', uuid.uuid4().hex)
+
+    def clear(self):
+        """Empties the in-process tier"""
+        self.memory.clear()
+
+    def get_stats(self):
+        """Returns hit / miss counters of the cache"""
+        with self._lock:
+            stats = dict(self._stats)
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = stats['hits'] / lookups if lookups else 0.0
+        stats['entries'] = len(self.memory)
+        return stats
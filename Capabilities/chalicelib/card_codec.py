@@ -0,0 +1,139 @@
+"""Conversion between BusinessCard objects and DynamoDB items.
+
+This is the only place that knows the item layout of the cards table:
+the service, the list builder and the routes all decode through here.
+"""
+import re
+import unicodedata
+
+from chalicelib.business_card import BusinessCard
+
+# DynamoDB sets can't be empty, so empty lists are stored as these placeholders
+EMPTY_PHONE = 'None'
+EMPTY_EMAIL = 'none@example.com'
+UNKNOWN = 'Unknown'
+
+# Sort key of the name ordered index: "<normalized name>#<card_id>"
+NAME_SORT_KEY = 'name_sort_key'
+NAME_SORT_KEY_LENGTH = 100
+WHITESPACE = re.compile(r'\s+')
+
+_new_card = BusinessCard.__new__
+
+
+def _string(item, attribute):
+    value = item.get(attribute)
+    return value.get('S', '') if value else ''
+
+
+def _string_set(item, attribute):
+    value = item.get(attribute)
+    if not value:
+        return []
+    # Phone numbers of older cards were stored as number sets
+    return value.get('SS') or value.get('NS') or []
+
+
+def from_item(item):
+    """Builds a BusinessCard from a raw DynamoDB item.
+
+    Values are taken as stored (they were formatted when the card was
+    written), so the constructor's formatting is skipped. This runs once
+    per item of every list and search, hence the inlined lookups.
+    """
+    card = _new_card(BusinessCard)
+    get = item.get
+    value = get('user_id')
+    card.user_id = value['S'] if value else None
+    value = get('card_id')
+    card.card_id = value['S'] if value else None
+    value = get('card_names')
+    card.names = value['S'] if value else ''
+    value = get('telephone_numbers')
+    # Phone numbers of older cards were stored as number sets
+    card.telephone_numbers = (value.get('SS') or value.get('NS') or []) if value else []
+    value = get('email_addresses')
+    card.email_addresses = value.get('SS', []) if value else []
+    value = get('company_name')
+    card.company_name = value['S'] if value else ''
+    value = get('company_website')
+    card.company_website = value['S'] if value else ''
+    value = get('company_address')
+    card.company_address = value['S'] if value else ''
+    value = get('image_storage')
+    card.image_storage = value['S'] if value else ''
+    return card
+
+
+def name_sort_key(names, card_id):
+    """Returns the key that orders cards by name, case and accent
+    insensitive, with card_id breaking ties between equal names
+    """
+    name = unicodedata.normalize('NFKD', str(names)).casefold()
+    name = ''.join(c for c in name if not unicodedata.combining(c))
+    name = WHITESPACE.sub(' ', name).strip()[:NAME_SORT_KEY_LENGTH]
+    return f'{name}#{card_id}'
+
+
+def card_sort_key(card):
+    """name_sort_key of a decoded card, for sorting cards in memory in the
+    same order as the name ordered index
+    """
+    return name_sort_key(card.names or UNKNOWN, card.card_id)
+
+
+def _unique(values):
+    # DynamoDB rejects sets with duplicate or empty values
+    return [value for value in dict.fromkeys(values) if value]
+
+
+def _attributes(card):
+    """Returns the non-key attributes of a card in DynamoDB format"""
+    return {
+        'card_names': {'S': card.names or UNKNOWN},
+        NAME_SORT_KEY: {'S': card_sort_key(card)},
+        'telephone_numbers': {'SS': _unique(str(tn) for tn in card.telephone_numbers) or [EMPTY_PHONE]},
+        'email_addresses': {'SS': _unique(card.email_addresses) or [EMPTY_EMAIL]},
+        'company_name': {'S': card.company_name or UNKNOWN},
+        'company_website': {'S': str(card.company_website or '')},
+        'company_address': {'S': card.company_address or ''},
+        'image_storage': {'S': card.image_storage or ''},
+    }
+
+
+def to_item(card):
+    """Returns the full DynamoDB item of a card, for put_item"""
+    item = {
+        'user_id': {'S': str(card.user_id)},
+        'card_id': {'S': str(card.card_id)},
+    }
+    item.update(_attributes(card))
+    return item
+
+
+def to_update(card):
+    """Returns the AttributeUpdates of a card, for update_item"""
+    return {attribute: {'Value': value, 'Action': 'PUT'}
+            for attribute, value in _attributes(card).items()}
+
+
+def to_dict(card):
+    """Returns a card as a plain, JSON serializable dict"""
+    return {slot: getattr(card, slot) for slot in BusinessCard.__slots__}
+
+
+def list_row(item, index):
+    """Builds the list view row of a card straight from its raw DynamoDB item"""
+    phones = _string_set(item, 'telephone_numbers')
+    emails = _string_set(item, 'email_addresses')
+    return {
+        'id': index,
+        'card_id': _string(item, 'card_id'),
+        # Use card_names if available, otherwise fallback to company_name
+        'name': _string(item, 'card_names') or _string(item, 'company_name'),
+        'phone': phones[0] if phones else '',
+        'email': emails[0] if emails else '',
+        'website': _string(item, 'company_website'),
+        'address': _string(item, 'company_address'),
+        'image_storage': _string(item, 'image_storage'),
+    }
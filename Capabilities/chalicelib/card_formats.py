@@ -0,0 +1,268 @@
+import csv
+import io
+import re
+
+from chalicelib.business_card import BusinessCard
+from chalicelib import card_codec
+
+# Accepted CSV header names (lowercase) for each BusinessCard field
+CSV_COLUMNS = {
+    'names': ('name', 'names', 'full name', 'card_names', 'user_names'),
+    'telephone_numbers': ('phone', 'phones', 'telephone', 'telephone_numbers', 'mobile'),
+    'email_addresses': ('email', 'emails', 'email_addresses', 'e-mail'),
+    'company_name': ('company', 'company_name', 'organization', 'org'),
+    'company_website': ('website', 'company_website', 'url', 'web'),
+    'company_address': ('address', 'company_address'),
+}
+# Separator for several phones / emails in one CSV cell
+CSV_MULTI_VALUE_SEPARATOR = ';'
+
+VCARD_COMPONENT_SEPARATOR = re.compile(r'(?<!\\);')
+VCARD_ESCAPE = re.compile(r'\\(.)')
+
+
+def iter_text_lines(raw):
+    """Decodes a UTF-8 (optionally BOM prefixed) body line by line without
+    building a decoded copy of the whole body
+    """
+    return io.TextIOWrapper(io.BytesIO(raw), encoding='utf-8-sig', newline='')
+
+
+def iter_csv_cards(lines, user_id):
+    """Parses CSV contacts into cards, one row at a time
+
+    Args:
+        lines (iterable): Text lines of the CSV document, header first
+        user_id (str): Owner of the imported cards
+
+    Yields:
+        tuple: (row number, BusinessCard or None, error message or None)
+    """
+    reader = csv.reader(lines)
+    header = next(reader, None)
+    if header is None:
+        return
+
+    columns = {}
+    for index, name in enumerate(header):
+        name = name.strip().lower()
+        for field, aliases in CSV_COLUMNS.items():
+            if name in aliases and field not in columns:
+                columns[field] = index
+
+    if 'names' not in columns and 'company_name' not in columns:
+        yield 1, None, 'header must have a name or company column'
+        return
+
+    for row_number, row in enumerate(reader, start=2):
+        if not any(cell.strip() for cell in row):
+            continue
+
+        def value(field):
+            index = columns.get(field)
+            return row[index].strip() if index is not None and index < len(row) else ''
+
+        def values(field):
+            return [v.strip() for v in value(field).split(CSV_MULTI_VALUE_SEPARATOR) if v.strip()]
+
+        fields = {
+            'names': value('names'),
+            'telephone_numbers': values('telephone_numbers'),
+            'email_addresses': values('email_addresses'),
+            'company_name': value('company_name'),
+            'company_website': value('company_website'),
+            'company_address': value('company_address'),
+        }
+        yield row_number, *_build_card(user_id, fields)
+
+
+def iter_vcard_cards(lines, user_id):
+    """Parses vCard (2.1, 3.0 or 4.0) contacts into cards, one card at a time
+
+    Args:
+        lines (iterable): Text lines of the vCard document
+        user_id (str): Owner of the imported cards
+
+    Yields:
+        tuple: (number of the card in the document, BusinessCard or None, error message or None)
+    """
+    number = 0
+    properties = None
+    for name, params, value in _iter_vcard_properties(lines):
+        if name == 'BEGIN' and value.upper() == 'VCARD':
+            number += 1
+            properties = []
+        elif name == 'END' and value.upper() == 'VCARD':
+            if properties is not None:
+                yield number, *_build_card(user_id, _vcard_fields(properties))
+            properties = None
+        elif properties is not None:
+            properties.append((name, params, value))
+
+
+def _iter_vcard_properties(lines):
+    """Unfolds continuation lines and splits them into (name, params, value)"""
+    current = None
+    for line in lines:
+        line = line.rstrip('\r\n')
+        if line[:1] in (' ', '\t') and current is not None:
+            current += line[1:]
+            continue
+        if current:
+            yield _split_vcard_property(current)
+        current = line
+    if current:
+        yield _split_vcard_property(current)
+
+
+def _split_vcard_property(line):
+    head, _, value = line.partition(':')
+    name, *params = head.split(';')
+    # Drop the optional group prefix, e.g. "item1.TEL"
+    name = name.rsplit('.', 1)[-1].upper()
+    return name, [param.upper() for param in params], value
+
+
+def _unescape(value):
+    return VCARD_ESCAPE.sub(lambda m: '\n' if m.group(1) in 'nN' else m.group(1), value)
+
+
+def _components(value):
+    """Splits a structured value (N, ORG, ADR) on its unescaped semicolons"""
+    return [_unescape(part) for part in VCARD_COMPONENT_SEPARATOR.split(value)]
+
+
+def _vcard_fields(properties):
+    fields = {'names': '', 'telephone_numbers': [], 'email_addresses': [],
+              'company_name': '', 'company_website': '', 'company_address': ''}
+    structured_name = ''
+    for name, params, value in properties:
+        if name == 'FN':
+            fields['names'] = _unescape(value)
+        elif name == 'N':
+            # Family;Given;Additional;Prefix;Suffix
+            parts = _components(value)
+            parts += [''] * (5 - len(parts))
+            structured_name = ' '.join(p for p in (parts[3], parts[1], parts[2], parts[0], parts[4]) if p)
+        elif name == 'TEL':
+            fields['telephone_numbers'].append(_unescape(value).replace('tel:', ''))
+        elif name == 'EMAIL':
+            fields['email_addresses'].append(_unescape(value))
+        elif name == 'ORG' and not fields['company_name']:
+            fields['company_name'] = _components(value)[0]
+        elif name == 'URL' and not fields['company_website']:
+            fields['company_website'] = _unescape(value)
+        elif name == 'ADR' and not fields['company_address']:
+            # PO box;Extended;Street;Locality;Region;Postal code;Country
+            fields['company_address'] = ', '.join(part.strip() for part in _components(value) if part.strip())
+    if not fields['names']:
+        fields['names'] = structured_name
+    return fields
+
+
+def _build_card(user_id, fields):
+    if not fields['names'] and not fields['company_name'] and not fields['email_addresses']:
+        return None, 'contact has no name, company or email'
+    return BusinessCard(user_id, None, **fields), None
+
+
+# Column order of exported CSV files, readable again by iter_csv_cards
+CSV_EXPORT_HEADER = ['name', 'phone', 'email', 'company', 'website', 'address']
+VCARD_VERSIONS = ('3.0', '4.0')
+# vCard lines longer than this many octets are folded
+VCARD_LINE_LENGTH = 75
+
+
+def iter_csv_export(cards):
+    """Serializes cards as CSV text, yielding one line at a time
+
+    Args:
+        cards (iterable): BusinessCard objects
+
+    Yields:
+        str: The header line followed by one line per card
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator='\r\n')
+
+    def line(values):
+        writer.writerow(values)
+        text = buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+        return text
+
+    yield line(CSV_EXPORT_HEADER)
+    for card in cards:
+        yield line([
+            card.names,
+            CSV_MULTI_VALUE_SEPARATOR.join(_exported_values(card.telephone_numbers)),
+            CSV_MULTI_VALUE_SEPARATOR.join(_exported_values(card.email_addresses)),
+            card.company_name,
+            card.company_website,
+            card.company_address,
+        ])
+
+
+def iter_vcard_export(cards, version='3.0'):
+    """Serializes cards as vCard 3.0 or 4.0 text, yielding one card at a time
+
+    Args:
+        cards (iterable): BusinessCard objects
+        version (str, optional): vCard version, one of VCARD_VERSIONS. Defaults to '3.0'.
+
+    Yields:
+        str: One BEGIN:VCARD ... END:VCARD block per card
+    """
+    if version not in VCARD_VERSIONS:
+        raise ValueError(f'version must be one of {VCARD_VERSIONS}')
+
+    for card in cards:
+        name = card.names or card.company_name
+        given, _, family = name.rpartition(' ') if ' ' in name else ('', '', name)
+        lines = ['BEGIN:VCARD', f'VERSION:{version}',
+                 f'FN:{_escape(name)}',
+                 f'N:{_escape(family)};{_escape(given)};;;']
+        if card.company_name:
+            lines.append(f'ORG:{_escape(card.company_name)}')
+        for phone in _exported_values(card.telephone_numbers):
+            lines.append(f'TEL;TYPE=work,voice:{_escape(phone)}' if version == '3.0'
+                         else f'TEL;TYPE=work,voice;VALUE=text:{_escape(phone)}')
+        for email in _exported_values(card.email_addresses):
+            lines.append(f'EMAIL;TYPE=work:{_escape(email)}')
+        if card.company_website:
+            lines.append(f'URL:{_escape(card.company_website)}')
+        if card.company_address:
+            lines.append(f'ADR;TYPE=work:;;{_escape(card.company_address)};;;;')
+        lines.append('END:VCARD')
+        yield ''.join(_fold(line) + '\r\n' for line in lines)
+
+
+def _exported_values(values):
+    # card_codec stores placeholders because DynamoDB sets can't be empty
+    return [str(v) for v in values if str(v) not in (card_codec.EMPTY_PHONE, card_codec.EMPTY_EMAIL)]
+
+
+def _escape(value):
+    return (str(value).replace('\\', '\\\\').replace('\n', '\\n')
+            .replace(',', '\\,').replace(';', '\\;'))
+
+
+def _fold(line):
+    """Folds a content line into chunks of at most VCARD_LINE_LENGTH octets"""
+    encoded = line.encode('utf-8')
+    if len(encoded) <= VCARD_LINE_LENGTH:
+        return line
+    chunks = []
+    start = 0
+    limit = VCARD_LINE_LENGTH
+    while start < len(encoded):
+        end = min(start + limit, len(encoded))
+        # Don't split a multi-byte character
+        while end < len(encoded) and (encoded[end] & 0xC0) == 0x80:
+            end -= 1
+        chunks.append(encoded[start:end].decode('utf-8'))
+        start = end
+        # Continuation lines start with a space, which counts towards the limit
+        limit = VCARD_LINE_LENGTH - 1
+    return '\r\n '.join(chunks)
@@ -0,0 +1,70 @@
+import random
+import time
+
+# DynamoDB limits per BatchWriteItem / BatchGetItem call
+BATCH_WRITE_SIZE = 25
+BATCH_GET_SIZE = 100
+
+
+def backoff_delay(attempt, base=0.05, cap=2.0):
+    """Exponential backoff with full jitter for the given retry attempt (1 based)"""
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+def batch_write(dynamodb, table_name, write_requests, max_attempts=8):
+    """Writes requests with BatchWriteItem in chunks of 25, retrying
+    UnprocessedItems with jittered exponential backoff.
+
+    Args:
+        dynamodb: boto3 DynamoDB client
+        table_name (str): Table to write to
+        write_requests (list): PutRequest / DeleteRequest dicts
+        max_attempts (int, optional): Calls per chunk before giving up. Defaults to 8.
+
+    Returns:
+        list: Requests that were still unprocessed after the last attempt
+    """
+    failed = []
+    for start in range(0, len(write_requests), BATCH_WRITE_SIZE):
+        pending = write_requests[start:start + BATCH_WRITE_SIZE]
+        for attempt in range(max_attempts):
+            if attempt:
+                time.sleep(backoff_delay(attempt))
+            response = dynamodb.batch_write_item(RequestItems={table_name: pending})
+            pending = response.get('UnprocessedItems', {}).get(table_name, [])
+            if not pending:
+                break
+        failed.extend(pending)
+    return failed
+
+
+def batch_get(dynamodb, table_name, keys, max_attempts=8):
+    """Reads items with BatchGetItem in chunks of 100, retrying UnprocessedKeys
+    with jittered exponential backoff.
+
+    Args:
+        dynamodb: boto3 DynamoDB client
+        table_name (str): Table to read from
+        keys (list): Primary keys in DynamoDB format
+        max_attempts (int, optional): Calls per chunk before giving up. Defaults to 8.
+
+    Raises:
+        RuntimeError: If some keys are still unprocessed after the last attempt
+
+    Returns:
+        list: Items found, in no particular order
+    """
+    items = []
+    for start in range(0, len(keys), BATCH_GET_SIZE):
+        request = {table_name: {'Keys': keys[start:start + BATCH_GET_SIZE]}}
+        for attempt in range(max_attempts):
+            if attempt:
+                time.sleep(backoff_delay(attempt))
+            response = dynamodb.batch_get_item(RequestItems=request)
+            items.extend(response.get('Responses', {}).get(table_name, []))
+            request = response.get('UnprocessedKeys')
+            if not request:
+                break
+        if request:
+            raise RuntimeError(f'{len(request[table_name]["Keys"])} keys unprocessed by BatchGetItem')
+    return items
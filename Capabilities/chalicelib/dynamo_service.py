@@ -1,23 +1,57 @@
-import boto3
-import boto3.dynamodb
+import base64
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import json
+import logging
 import uuid
 
+from botocore.exceptions import ClientError
+
+from chalicelib import aws_clients
+from chalicelib import instrumentation
 from chalicelib.business_card import BusinessCard
 from chalicelib.business_card_list import BusinessCardList
+from chalicelib import card_codec
+from chalicelib.dynamo_batch import BATCH_WRITE_SIZE, batch_get, batch_write
+from chalicelib.search_index import CardSearchIndex
+
+
+# Attributes needed to render the card list view
+LIST_VIEW_ATTRIBUTES = ['card_id', 'card_names', 'company_name', 'telephone_numbers',
+                        'email_addresses', 'company_website', 'company_address', 'image_storage']
 
 
 class DynamoService:
     """Service to manage interaction with AWS DynamoDB
     """
 
-    def __init__(self, table_name):
+    def __init__(self, table_name, index_table_name=None, names_index_name=None, cache=None,
+                 search_with_index=True):
         """Constructor
 
         Args:
             table_name (str): Table name in DynamoDB service
+            index_table_name (str, optional): Search index table name, see CardSearchIndex.
+                Without it searches filter the whole user partition. Defaults to None.
+            names_index_name (str, optional): Global secondary index of the table with
+                partition key user_id and sort key name_sort_key, see create_names_index.
+                Without it name ordered lists are sorted in memory. Defaults to None.
+            cache (CardCache, optional): Read-through cache for get_card and list_cards,
+                invalidated by every write of this service. Defaults to None.
+            search_with_index (bool, optional): Whether searches read the search index. False
+                only maintains it, e.g. until reindex_all_cards has indexed the existing cards.
+                Defaults to True.
         """
         self.table_name = table_name
-        self.dynamodb = boto3.client('dynamodb','us-east-1')
+        self.names_index_name = names_index_name
+        self.cache = cache
+        self.search_index = None
+        if index_table_name:
+            self.search_index = CardSearchIndex(index_table_name)
+        self.search_with_index = search_with_index
+
+    @property
+    def dynamodb(self):
+        return aws_clients.client('dynamodb')
 
     def store_card(self, card: BusinessCard):
         """Creates a new card record
@@ -32,12 +66,101 @@ class DynamoService:
         # Ensure primary key - low collision
         card.card_id = str(uuid.uuid4())
 
+        item = card_codec.to_item(card)
         response = self.dynamodb.put_item(
             TableName=self.table_name,
-            Item=card.toDynamoFormat()
+            Item=item
         )
+        self._update_search_index(card.user_id, card.card_id, new_item=item)
+        if self.cache:
+            self.cache.invalidate(card.user_id)
         return response['ResponseMetadata']['HTTPStatusCode'] == 200
 
+    def store_cards(self, rows, max_workers=8):
+        """Creates many card records with BatchWriteItem, 25 at a time.
+        Rows are consumed lazily and chunks are written by up to max_workers
+        threads, so only a bounded number of cards is held in memory.
+
+        Args:
+            rows (iterable): (row number, BusinessCard or None, error message or None)
+                tuples as produced by the card_formats parsers
+            max_workers (int, optional): Chunks written concurrently. Defaults to 8.
+
+        Returns:
+            list: Per-row report dicts with "row", "status" ("created" or "error")
+                and "card_id" (plus "warning" if it could not be indexed) or "error"
+        """
+        report = []
+        in_flight = set()
+        chunk = []
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for row, card, error in rows:
+                if card is None:
+                    report.append({'row': row, 'status': 'error', 'error': error})
+                    continue
+                chunk.append((row, card))
+                if len(chunk) == BATCH_WRITE_SIZE:
+                    in_flight.add(instrumentation.submit(executor, self._store_chunk, chunk))
+                    chunk = []
+                    if len(in_flight) >= max_workers:
+                        # Stop reading rows until a chunk is written
+                        done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            report.extend(future.result())
+            if chunk:
+                in_flight.add(instrumentation.submit(executor, self._store_chunk, chunk))
+            for future in in_flight:
+                report.extend(future.result())
+
+        report.sort(key=lambda entry: entry['row'])
+        return report
+
+    def _store_chunk(self, chunk):
+        items = {}
+        for row, card in chunk:
+            card.card_id = str(uuid.uuid4())
+            items[card.card_id] = card_codec.to_item(card)
+
+        # card_id -> error of the cards that were not written
+        failed = {}
+        try:
+            unprocessed = batch_write(self.dynamodb, self.table_name,
+                                      [{'PutRequest': {'Item': item}} for item in items.values()])
+            for request in unprocessed:
+                failed[request['PutRequest']['Item']['card_id']['S']] = 'write throttled, retries exhausted'
+        except ClientError as e:
+            # A rejected batch (e.g. ValidationException) writes none of its cards
+            failed = dict.fromkeys(items, e.response.get('Error', {}).get('Message', str(e)))
+
+        # card_ids of written cards whose postings were not written
+        unindexed = set()
+        if self.search_index:
+            postings = []
+            for card_id, item in items.items():
+                if card_id not in failed:
+                    postings += self.search_index.posting_requests(item['user_id']['S'], card_id, new_item=item)
+            try:
+                unprocessed_postings = batch_write(self.dynamodb, self.search_index.table_name, postings)
+                unindexed.update(request['PutRequest']['Item']['card_id']['S'] for request in unprocessed_postings)
+            except ClientError as e:
+                logging.error(f"Search index postings failed for an import chunk: {e}")
+                unindexed.update(card_id for card_id in items if card_id not in failed)
+
+        if self.cache:
+            for user_id in {card.user_id for row, card in chunk}:
+                self.cache.invalidate(user_id)
+
+        report = []
+        for row, card in chunk:
+            if card.card_id in failed:
+                report.append({'row': row, 'status': 'error', 'error': failed[card.card_id]})
+            else:
+                entry = {'row': row, 'status': 'created', 'card_id': card.card_id}
+                if card.card_id in unindexed:
+                    entry['warning'] = 'not added to the search index, run a reindex'
+                report.append(entry)
+        return report
+
     def update_card(self, card: BusinessCard):
         """Updates a new card record
 
@@ -51,9 +174,14 @@ class DynamoService:
             TableName=self.table_name,
             Key={'user_id': {'S': str(card.user_id)}, 'card_id': {
                 'S': str(card.card_id)}},
-            AttributeUpdates=card.toDynamoFormat(isUpdate=True),
-            ReturnValues='ALL_NEW'
+            AttributeUpdates=card_codec.to_update(card),
+            ReturnValues='ALL_OLD'
         )
+        self._update_search_index(card.user_id, card.card_id,
+                                  old_item=response.get('Attributes'),
+                                  new_item=card_codec.to_item(card))
+        if self.cache:
+            self.cache.invalidate(card.user_id)
         return response['ResponseMetadata']['HTTPStatusCode'] == 200
 
     def delete_card(self, user_id, card_id):
@@ -69,10 +197,28 @@ class DynamoService:
         response = self.dynamodb.delete_item(
             TableName=self.table_name,
             Key={'user_id': {'S': str(user_id)}, 'card_id': {
-                'S': str(card_id)}}
+                'S': str(card_id)}},
+            ReturnValues='ALL_OLD'
         )
+        if 'Attributes' in response:
+            self._update_search_index(user_id, card_id, old_item=response['Attributes'])
+        if self.cache:
+            self.cache.invalidate(user_id)
         return response['ResponseMetadata']['HTTPStatusCode'] == 200
 
+    def _update_search_index(self, user_id, card_id, old_item=None, new_item=None):
+        """Updates the postings of a card after its write has committed. A
+        failure is logged rather than raised, since failing the request would
+        make clients retry a write that succeeded; reindex_all_cards repairs
+        the index.
+        """
+        if not self.search_index:
+            return
+        try:
+            self.search_index.update(user_id, card_id, old_item=old_item, new_item=new_item)
+        except Exception as e:
+            logging.error(f"Search index update failed for card {card_id} of user {user_id}: {e}")
+
     def get_card(self, user_id, card_id):
         """Retrieves card information from DynamoDB
 
@@ -83,6 +229,12 @@ class DynamoService:
         Returns:
             BusinessCard: Card information, None if card_id does not exists
         """
+        if self.cache:
+            key = self.cache.card_key(user_id, card_id)
+            item = self.cache.get(key)
+            if item is not None:
+                return card_codec.from_item(item)
+
         response = self.dynamodb.get_item(
             TableName=self.table_name,
             Key={'user_id': {'S': str(user_id)}, 'card_id': {
@@ -91,33 +243,93 @@ class DynamoService:
 
         c = None
         if response.__contains__('Item'):
-            # Handle telephone_numbers which could be SS (string set) or NS (number set)
-            telephone_numbers = []
-            if 'telephone_numbers' in response['Item']:
-                if 'SS' in response['Item']['telephone_numbers']:
-                    telephone_numbers = response['Item']['telephone_numbers']['SS']
-                elif 'NS' in response['Item']['telephone_numbers']:
-                    telephone_numbers = response['Item']['telephone_numbers']['NS']
-                    
-            c = BusinessCard(
-                user_id=response['Item']['user_id']['S'],
-                card_id=response['Item']['card_id']['S'],
-                names=response['Item'].get('card_names', {}).get('S', ''),
-                email_addresses=response['Item'].get('email_addresses', {}).get('SS', []),
-                telephone_numbers=telephone_numbers,
-                company_name=response['Item'].get('company_name', {}).get('S', ''),
-                company_website=response['Item'].get('company_website', {}).get('S', ''),
-                company_address=response['Item'].get('company_address', {}).get('S', ''),
-                image_storage=response['Item'].get('image_storage', {}).get('S', ''),
-            )
+            c = card_codec.from_item(response['Item'])
+            if self.cache:
+                self.cache.put(key, response['Item'])
         return c
 
+    def list_cards(self, user_id, limit=50, cursor=None, by_name=False):
+        """Retrieves one page of a user's cards with only the list view attributes.
+
+        Each call is a single keyed query, so its cost does not depend on how
+        many cards the user has.
+
+        Args:
+            user_id (str): User unique identifier
+            limit (int, optional): Maximum number of cards in the page. Defaults to 50.
+            cursor (str, optional): next_cursor returned for the previous page. Defaults to None.
+            by_name (bool, optional): Order the cards by name (through the names index)
+                instead of card_id. Defaults to False.
+
+        Raises:
+            ValueError: If the cursor is malformed, belongs to another user or to the
+                other ordering, or by_name is requested without a names index
+
+        Returns:
+            tuple: (list of raw DynamoDB items, cursor of the next page or None)
+        """
+        if not user_id:
+            raise ValueError('user_id is a mandatory field')
+        if by_name and not self.names_index_name:
+            raise ValueError('no names index configured')
+
+        # card_id is a key attribute, list it through a placeholder like the others
+        names = {f'#a{i}': attribute for i, attribute in enumerate(LIST_VIEW_ATTRIBUTES)}
+        query = {
+            'TableName': self.table_name,
+            'KeyConditionExpression': 'user_id = :user_id',
+            'ExpressionAttributeValues': {':user_id': {'S': user_id}},
+            'ProjectionExpression': ', '.join(names),
+            'ExpressionAttributeNames': names,
+            'Limit': int(limit),
+        }
+        if by_name:
+            query['IndexName'] = self.names_index_name
+        if cursor:
+            query['ExclusiveStartKey'] = self._decode_cursor(cursor, user_id, by_name)
+
+        if self.cache:
+            key = self.cache.page_key(user_id, by_name, int(limit), cursor)
+            page = self.cache.get(key)
+            if page is not None:
+                return page['items'], page['next_cursor']
+
+        response = self.dynamodb.query(**query)
+        next_cursor = None
+        if 'LastEvaluatedKey' in response:
+            next_cursor = self._encode_cursor(response['LastEvaluatedKey'])
+        if self.cache:
+            self.cache.put(key, {'items': response.get('Items', []), 'next_cursor': next_cursor})
+        return response.get('Items', []), next_cursor
+
+    def _encode_cursor(self, last_evaluated_key):
+        """Turns a LastEvaluatedKey into an opaque, URL safe cursor"""
+        raw = json.dumps(last_evaluated_key, separators=(',', ':'), sort_keys=True)
+        return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii').rstrip('=')
+
+    def _decode_cursor(self, cursor, user_id, by_name=False):
+        """Turns a cursor back into an ExclusiveStartKey for user_id"""
+        try:
+            raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+            key = json.loads(raw)
+            # Keys of the names index also carry the index sort key
+            valid = key['user_id'] == {'S': user_id} and (card_codec.NAME_SORT_KEY in key) == by_name
+        except (ValueError, KeyError, TypeError):
+            valid = False
+        if not valid:
+            raise ValueError('invalid cursor')
+        return key
+
     def search_cards(self, user_id, filter='', page=1, pagesize=10):
         """Method for searching the cards of a particular user.
         It takes into account the page number and pagesize to retrieve the appropriate elements
         ordering the results first by card names.
 
-        To search all items filter should be None or empty string
+        To search all items filter should be None or empty string. Without a
+        filter and with a names index only the first page * pagesize cards in
+        name order are read, and the total is counted on the names index and
+        cached until the user's next write; otherwise the matching cards are
+        streamed through BusinessCardList, which keeps only that many of them.
 
         Args:
             user_id (str): User unique identifier
@@ -126,66 +338,212 @@ class DynamoService:
             pagesize (int, optional): Number of records per page. Defaults to 10.
 
         Returns:
-            dict: DynamoDB response containing Items list
+            BusinessCardList: Requested page of the matching cards
+        """
+        if not filter and self.names_index_name:
+            needed = max(1, int(page) * int(pagesize))
+            return BusinessCardList(self.iter_cards_by_name(user_id, limit=needed), page, pagesize,
+                                    count=self.count_cards(user_id, by_name=True))
+        return BusinessCardList(self.iter_cards(user_id, filter), page, pagesize)
+
+    def iter_cards_by_name(self, user_id, limit=50):
+        """Lazily yields every card of a user in name order, read page by page
+        from the names index
+
+        Args:
+            user_id (str): User unique identifier
+            limit (int, optional): Cards read per query. Defaults to 50.
+
+        Yields:
+            BusinessCard: Cards ordered by name, then card_id
+        """
+        cursor = None
+        while True:
+            items, cursor = self.list_cards(user_id, limit, cursor, by_name=True)
+            for item in items:
+                yield card_codec.from_item(item)
+            if cursor is None:
+                return
+
+    def count_cards(self, user_id, by_name=False):
+        """Counts the cards of a user without reading their attributes. The
+        count is cached like list pages, until the user's next write.
+
+        Args:
+            user_id (str): User unique identifier
+            by_name (bool, optional): Count the cards of the names index, which leaves
+                out cards without a name, so the count matches iter_cards_by_name.
+                Defaults to False.
+
+        Returns:
+            int: Number of cards
         """
+        if self.cache:
+            key = self.cache.page_key(user_id, 'count', by_name)
+            count = self.cache.get(key)
+            if count is not None:
+                return count
 
+        query = {
+            'TableName': self.table_name,
+            'KeyConditionExpression': 'user_id = :user_id',
+            'ExpressionAttributeValues': {':user_id': {'S': user_id}},
+            'Select': 'COUNT',
+        }
+        if by_name:
+            query['IndexName'] = self.names_index_name
+        paginator = self.dynamodb.get_paginator('query')
+        count = sum(response['Count'] for response in paginator.paginate(**query))
+        if self.cache:
+            self.cache.put(key, count)
+        return count
+
+    def iter_cards(self, user_id, filter=''):
+        """Lazily yields every card of a user matching filter, following
+        LastEvaluatedKey page by page. Only one page is held in memory and no
+        further pages are read once the caller stops iterating.
+
+        Args:
+            user_id (str): User unique identifier
+            filter (str, optional): Filter criteria for names, email, company name, website or address. Defaults to None.
+
+        Yields:
+            BusinessCard: Matching cards in key order
+        """
+        for item in self.iter_items(user_id, filter):
+            yield card_codec.from_item(item)
+
+    def iter_items(self, user_id, filter=''):
+        """Same as iter_cards but yields the raw DynamoDB items"""
         if not user_id:
             raise ValueError('user_id is a mandatory field')
-            
-        try:
-            print(f"Searching cards for user_id: {user_id}")
-            
-            if filter != None and filter != '':
-                response = self.dynamodb.query(
-                    TableName=self.table_name,
-                    KeyConditionExpression='user_id = :user_id',
-                    # If specific columns needs to be displayed in the list view
-                    # ProjectionExpression="card_id, card_names, email_addresses, company_name",
-
-                    FilterExpression='contains(card_names,:filter_criteria) OR '\
-                    'contains(email_addresses,:filter_criteria) OR '\
-                    'contains(company_name,:filter_criteria) OR '\
-                    'contains(company_website,:filter_criteria) OR '\
-                    'contains(company_address,:filter_criteria) ',
-                    ExpressionAttributeValues={
-                        ':user_id': {'S': user_id},
-                        ':filter_criteria': {'S': filter}
-                    },
-                )
-            else:
-                # Empty search case
-                print(f"Querying table: {self.table_name} for user_id: {user_id}")
-                response = self.dynamodb.query(
-                    TableName=self.table_name,
-                    KeyConditionExpression='user_id = :user_id',
-                    ExpressionAttributeValues={
-                        ':user_id': {'S': user_id},
-                    },
-                )
-
-            print(f"DynamoDB response: {response}")
-            
-            # Check if we have items in the response
-            if 'Items' not in response:
-                print("No 'Items' key in DynamoDB response")
-                # Try to list tables to verify connection
-                tables = self.dynamodb.list_tables()
-                print(f"Available tables: {tables}")
-            elif len(response['Items']) == 0:
-                print(f"'Items' array is empty in DynamoDB response for user_id: {user_id}")
-                # Verify the table exists and has the expected structure
+
+        if filter and self.search_index and self.search_with_index:
+            card_ids = self.search_index.search(user_id, filter)
+            if card_ids is not None:
+                # Only the matching cards are read, in card_id order like a query
+                keys = [{'user_id': {'S': user_id}, 'card_id': {'S': card_id}}
+                        for card_id in sorted(card_ids)]
+                items = batch_get(self.dynamodb, self.table_name, keys)
+                yield from sorted(items, key=lambda item: item['card_id']['S'])
+                return
+
+        query = {
+            'TableName': self.table_name,
+            'KeyConditionExpression': 'user_id = :user_id',
+            'ExpressionAttributeValues': {':user_id': {'S': user_id}},
+        }
+        if filter != None and filter != '':
+            query['FilterExpression'] = 'contains(card_names,:filter_criteria) OR '\
+                'contains(email_addresses,:filter_criteria) OR '\
+                'contains(company_name,:filter_criteria) OR '\
+                'contains(company_website,:filter_criteria) OR '\
+                'contains(company_address,:filter_criteria) '
+            query['ExpressionAttributeValues'][':filter_criteria'] = {'S': filter}
+
+        paginator = self.dynamodb.get_paginator('query')
+        for response in paginator.paginate(**query):
+            yield from response.get('Items', [])
+
+    def reindex_cards(self, user_id):
+        """Rebuilds the search index postings of every card of a user, e.g.
+        for cards stored before the index existed
+
+        Args:
+            user_id (str): User unique identifier
+
+        Returns:
+            int: Number of cards indexed
+        """
+        if not self.search_index:
+            raise ValueError('no search index table configured')
+
+        count = 0
+        for item in self.iter_items(user_id):
+            self.search_index.update(user_id, item['card_id']['S'], new_item=item)
+            count += 1
+        return count
+
+    def reindex_all_cards(self):
+        """Writes the search index postings of every card in the table, for
+        cards stored before the index was maintained. Postings are plain
+        puts, so running it again is harmless.
+
+        Returns:
+            int: Number of cards indexed
+        """
+        if not self.search_index:
+            raise ValueError('no search index table configured')
+
+        count = 0
+        paginator = self.dynamodb.get_paginator('scan')
+        for response in paginator.paginate(TableName=self.table_name):
+            postings = []
+            for item in response.get('Items', []):
+                postings += self.search_index.posting_requests(item['user_id']['S'], item['card_id']['S'],
+                                                               new_item=item)
+                count += 1
+            unprocessed = batch_write(self.dynamodb, self.search_index.table_name, postings)
+            if unprocessed:
+                raise RuntimeError(f'{len(unprocessed)} search index postings could not be written')
+        return count
+
+    def create_names_index(self):
+        """Adds the names index (see names_index_name) to the cards table.
+        DynamoDB builds it in the background; run backfill_name_sort_keys
+        for cards stored before name_sort_key was written.
+        """
+        if not self.names_index_name:
+            raise ValueError('no names index configured')
+
+        self.dynamodb.update_table(
+            TableName=self.table_name,
+            AttributeDefinitions=[
+                {'AttributeName': 'user_id', 'AttributeType': 'S'},
+                {'AttributeName': card_codec.NAME_SORT_KEY, 'AttributeType': 'S'},
+            ],
+            GlobalSecondaryIndexUpdates=[{'Create': {
+                'IndexName': self.names_index_name,
+                'KeySchema': [
+                    {'AttributeName': 'user_id', 'KeyType': 'HASH'},
+                    {'AttributeName': card_codec.NAME_SORT_KEY, 'KeyType': 'RANGE'},
+                ],
+                # The list view is served from the index alone
+                'Projection': {
+                    'ProjectionType': 'INCLUDE',
+                    'NonKeyAttributes': [a for a in LIST_VIEW_ATTRIBUTES if a != 'card_id'],
+                },
+            }}],
+        )
+
+    def backfill_name_sort_keys(self):
+        """Writes name_sort_key on every card that doesn't have one yet, so
+        it appears in the names index
+
+        Returns:
+            int: Number of cards updated
+        """
+        count = 0
+        paginator = self.dynamodb.get_paginator('scan')
+        for response in paginator.paginate(
+                TableName=self.table_name,
+                FilterExpression='attribute_not_exists(#sort_key)',
+                ProjectionExpression='user_id, card_id, card_names',
+                ExpressionAttributeNames={'#sort_key': card_codec.NAME_SORT_KEY}):
+            for item in response.get('Items', []):
+                card = card_codec.from_item(item)
                 try:
-                    table_desc = self.dynamodb.describe_table(TableName=self.table_name)
-                    print(f"Table description: {table_desc}")
-                    # Try a scan to see if there's any data at all
-                    scan_result = self.dynamodb.scan(TableName=self.table_name, Limit=5)
-                    print(f"Scan result (first 5 items): {scan_result}")
-                except Exception as e:
-                    print(f"Error checking table: {e}")
-                
-            return response
-            
-        except Exception as e:
-            print(f"Error in search_cards: {e}")
-            # Return an empty response structure instead of raising an exception
-            return {'Items': []}
+                    self.dynamodb.update_item(
+                        TableName=self.table_name,
+                        Key={'user_id': item['user_id'], 'card_id': item['card_id']},
+                        UpdateExpression='SET #sort_key = :sort_key',
+                        # Don't recreate cards deleted since the scan
+                        ConditionExpression='attribute_exists(card_id)',
+                        ExpressionAttributeNames={'#sort_key': card_codec.NAME_SORT_KEY},
+                        ExpressionAttributeValues={':sort_key': {'S': card_codec.card_sort_key(card)}})
+                except self.dynamodb.exceptions.ConditionalCheckFailedException:
+                    continue
+                count += 1
+        if self.cache:
+            self.cache.clear()
+        return count
@@ -0,0 +1,100 @@
+import io
+import logging
+
+try:
+    from PIL import Image, ImageOps, UnidentifiedImageError
+except ImportError:  # Pillow is optional, without it images are used as uploaded
+    Image = None
+
+# Normalized variants live next to the originals under this prefix
+NORMALIZED_PREFIX = 'normalized/'
+
+
+class ImageNormalizationService:
+    """Prepares uploaded card images for OCR: applies the EXIF orientation,
+    downscales to a maximum dimension, converts to grayscale and re-encodes
+    as JPEG. The normalized variant is stored beside the original.
+    """
+
+    def __init__(self, storage_service, max_dimension=2000, grayscale=True, quality=85):
+        """Constructor
+
+        Args:
+            storage_service (StorageService): Storage holding the original images
+            max_dimension (int, optional): Longest side in pixels after downscaling. Defaults to 2000.
+            grayscale (bool, optional): Convert to grayscale. Defaults to True.
+            quality (int, optional): JPEG quality of the re-encoded image. Defaults to 85.
+        """
+        self.storage_service = storage_service
+        self.max_dimension = int(max_dimension)
+        self.grayscale = grayscale
+        self.quality = int(quality)
+
+    def is_available(self):
+        """Returns True if the image library is installed"""
+        return Image is not None
+
+    def normalized_name(self, file_name):
+        return NORMALIZED_PREFIX + file_name
+
+    def normalize(self, file_bytes):
+        """Returns the normalized JPEG bytes of an image.
+
+        Files that can't be decoded as images (e.g. PDFs) or that don't get
+        smaller are returned unchanged.
+        """
+        if Image is None:
+            return file_bytes
+
+        try:
+            with Image.open(io.BytesIO(file_bytes)) as image:
+                image = ImageOps.exif_transpose(image)
+                image.thumbnail((self.max_dimension, self.max_dimension))
+                image = image.convert('L' if self.grayscale else 'RGB')
+
+                output = io.BytesIO()
+                image.save(output, format='JPEG', quality=self.quality, optimize=True)
+        except UnidentifiedImageError:
+            return file_bytes
+
+        normalized = output.getvalue()
+        return normalized if len(normalized) < len(file_bytes) else file_bytes
+
+    def store_normalized(self, file_bytes, file_name, normalized=None):
+        """Normalizes an image and stores the result, returning the stored file name
+
+        Args:
+            file_bytes (bytes): Original image, already stored as file_name
+            file_name (str): Name of the original image
+            normalized (bytes, optional): Result of normalize(file_bytes) if already computed
+        """
+        normalized_name = self.normalized_name(file_name)
+        if normalized is None:
+            normalized = self.normalize(file_bytes)
+        logging.info(f"Normalized {file_name}: {len(file_bytes)} -> {len(normalized)} bytes")
+        content_type = 'image/jpeg' if normalized is not file_bytes else 'application/octet-stream'
+        # Remember which version of the original this variant was made from
+        source_etag = self.storage_service.get_file_etag(file_name)
+        self.storage_service.write_file(normalized, normalized_name, content_type=content_type,
+                                        metadata={'source-etag': source_etag})
+        return normalized_name
+
+    def ensure_normalized(self, file_name):
+        """Returns the name of the normalized variant of file_name, creating it
+        from the original if it is missing or was made from an older version
+        of the original (e.g. after a direct upload)
+        """
+        if not self.is_available():
+            return file_name
+
+        normalized_name = self.normalized_name(file_name)
+        metadata = self.storage_service.get_file_metadata(normalized_name)
+        if metadata is not None:
+            if metadata.get('source-etag') == self.storage_service.get_file_etag(file_name):
+                return normalized_name
+
+        file_bytes = self.storage_service.read_file(file_name)
+        if file_bytes is None:
+            # Let OCR report the missing image
+            return file_name
+        return self.store_normalized(file_bytes, file_name)
@@ -0,0 +1,180 @@
+"""Per-request latency spans, Server-Timing headers, EMF metrics and sampled
+debug logging.
+
+A request started with start_request collects the spans timed with span()
+and the AWS calls of the clients passed to instrument_client. The spans live
+in a context variable; work handed to a thread pool through submit() runs
+in a copy of the caller's context, so its spans land in the same request.
+Outside a request spans are not recorded.
+"""
+from collections import defaultdict
+import contextlib
+import contextvars
+import json
+import logging
+import os
+import random
+import sys
+import time
+
+METRICS_NAMESPACE = 'CardOCR'
+# Fraction of requests whose debug() messages are logged
+LOG_SAMPLE_RATE = float(os.environ.get('LOG_SAMPLE_RATE', '0.01'))
+
+_spans = contextvars.ContextVar('spans', default=None)
+_sampled = contextvars.ContextVar('sampled', default=False)
+_log = logging.getLogger('card_ocr')
+# Whether a message is written is decided per request by debug()
+_log.setLevel(logging.DEBUG)
+
+
+def _stdout_sink(line):
+    # Lambda forwards stdout to CloudWatch Logs, which extracts EMF metrics
+    sys.stdout.write(line + '\n')
+
+
+_metrics_sink = _stdout_sink
+
+
+def set_metrics_sink(sink):
+    """Replaces where EMF lines go (a callable taking one JSON string),
+    e.g. a MetricsCollector in tests. None restores stdout.
+    """
+    global _metrics_sink
+    _metrics_sink = sink or _stdout_sink
+
+
+class MetricsCollector:
+    """Metrics sink keeping the EMF lines in memory, for tests and benchmarks"""
+
+    def __init__(self):
+        self.lines = []
+
+    def __call__(self, line):
+        self.lines.append(line)
+
+    def records(self):
+        """Returns the collected EMF records as dicts"""
+        return [json.loads(line) for line in self.lines]
+
+
+def start_request(sample_rate=None):
+    """Starts collecting spans for the current request and decides whether
+    its debug messages are logged
+
+    Returns:
+        contextvars.Token: Token to pass to end_request
+    """
+    rate = LOG_SAMPLE_RATE if sample_rate is None else sample_rate
+    _sampled.set(random.random() < rate)
+    return _spans.set([])
+
+
+def end_request(token):
+    """Stops collecting spans and returns those of the request
+
+    Returns:
+        list: (name, milliseconds) tuples in completion order
+    """
+    spans = _spans.get() or []
+    _spans.reset(token)
+    return spans
+
+
+def record(name, milliseconds):
+    """Adds a span measured elsewhere to the current request"""
+    spans = _spans.get()
+    if spans is not None:
+        # list.append is atomic, pool threads share the request's list
+        spans.append((name, milliseconds))
+
+
+@contextlib.contextmanager
+def span(name):
+    """Times the enclosed block as a span of the current request"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, (time.perf_counter() - start) * 1000)
+
+
+def submit(executor, fn, *args, **kwargs):
+    """executor.submit that runs fn in a copy of the caller's context, so
+    its spans and log sampling belong to the caller's request
+    """
+    return executor.submit(contextvars.copy_context().run, fn, *args, **kwargs)
+
+
+def instrument_client(client, service_name):
+    """Records every call of a boto3 client as a "<service>.<Operation>"
+    span, from before the call (including rate limiter waits and retries)
+    until it returns or fails
+    """
+    def before_call(model, context, **kwargs):
+        context['instrumentation_start'] = time.perf_counter()
+
+    def after_call(model, context, **kwargs):
+        start = context.pop('instrumentation_start', None)
+        if start is not None:
+            record(f'{service_name}.{model.name}', (time.perf_counter() - start) * 1000)
+
+    def after_call_error(context, **kwargs):
+        # No model here, the span is named after the event
+        start = context.pop('instrumentation_start', None)
+        if start is not None:
+            operation = kwargs.get('event_name', '').rsplit('.', 1)[-1]
+            record(f'{service_name}.{operation}', (time.perf_counter() - start) * 1000)
+
+    client.meta.events.register_first('before-call', before_call)
+    client.meta.events.register('after-call', after_call)
+    client.meta.events.register('after-call-error', after_call_error)
+
+
+def summarize(spans):
+    """Sums spans by name
+
+    Returns:
+        dict: name -> (calls, total milliseconds), in first seen order
+    """
+    totals = defaultdict(lambda: [0, 0.0])
+    for name, milliseconds in spans:
+        totals[name][0] += 1
+        totals[name][1] += milliseconds
+    return {name: tuple(total) for name, total in totals.items()}
+
+
+def server_timing(spans, total_ms):
+    """Formats spans as a Server-Timing header value"""
+    entries = [f'{name};dur={ms:.1f}' + (f';desc="{calls} calls"' if calls > 1 else '')
+               for name, (calls, ms) in summarize(spans).items()]
+    entries.append(f'total;dur={total_ms:.1f}')
+    return ', '.join(entries)
+
+
+def emit_metrics(route, spans, total_ms, status_code):
+    """Writes one EMF record with the request's total and per-span latency"""
+    values = {name: round(ms, 3) for name, (calls, ms) in summarize(spans).items()}
+    values['total'] = round(total_ms, 3)
+    metrics_record = {
+        '_aws': {
+            'Timestamp': int(time.time() * 1000),
+            'CloudWatchMetrics': [{
+                'Namespace': METRICS_NAMESPACE,
+                'Dimensions': [['Route']],
+                'Metrics': [{'Name': name, 'Unit': 'Milliseconds'} for name in values],
+            }],
+        },
+        'Route': route,
+        'StatusCode': status_code,
+    }
+    metrics_record.update(values)
+    _metrics_sink(json.dumps(metrics_record, separators=(',', ':')))
+
+
+def debug(message, *args):
+    """Logs a debug message for sampled requests only; args are %-formatted
+    lazily, so unsampled requests pay neither formatting nor I/O
+    """
+    if _sampled.get():
+        _log.debug(message, *args)
@@ -1,67 +1,395 @@
 from collections import defaultdict
-import boto3
+from concurrent.futures import ThreadPoolExecutor
 from botocore.exceptions import BotoCoreError, ClientError
+from chalicelib import aws_clients
+from chalicelib import instrumentation
+from chalicelib import throttling
 import sys
 import re
+import threading
+import time
+
+# Comprehend BatchDetectEntities limits: documents per call and UTF-8 bytes
+# per document. Larger documents go through single DetectEntities calls.
+COMPREHEND_BATCH_SIZE = 25
+COMPREHEND_BATCH_MAX_BYTES = 5000
+COMPREHEND_BATCH_RETRIES = 2
+
+
+# Deployment modes: "remote" uses only the AWS services for model-based fields,
+# "local_first" resolves regular fields with rules and calls AWS only for what
+# is left, "local" never calls AWS
+NER_MODE_REMOTE = 'remote'
+NER_MODE_LOCAL_FIRST = 'local_first'
+NER_MODE_LOCAL = 'local'
+NER_MODES = (NER_MODE_REMOTE, NER_MODE_LOCAL_FIRST, NER_MODE_LOCAL)
+
+# Once rules have found these fields ComprehendMedical has nothing left to add
+LOCAL_RESOLVED_FIELDS = ('email', 'phone')
+
+# A line is part of an address when it contains a street/unit word or a ZIP
+# code. Indicators must be whole words, so "st" doesn't match "first" and
+# "dr" doesn't match "address".
+ADDRESS_INDICATORS = ('street', 'avenue', 'ave', 'st', 'road', 'rd', 'lane', 'ln', 'drive', 'dr',
+                      'blvd', 'boulevard', 'suite', 'apt', 'apartment', 'floor', 'fl')
+ADDRESS_LINE_PATTERN = re.compile(
+    r'\b(?i:' + '|'.join(ADDRESS_INDICATORS) + r')\b|\b\d{5}(?:-\d{4})?\b')
+# The following line continues an address when it has a ZIP code or state code
+ADDRESS_CONTINUATION_PATTERN = re.compile(r'\b\d{5}(?:-\d{4})?\b|\b[A-Z]{2}\b')
+
+
+class LocalEntityExtractor:
+    """Rule based extraction of the regular business card fields:
+    emails, phone numbers, URLs and postal codes
+    """
+    EMAIL_PATTERN = re.compile(r'[A-Za-z0-9._%+-]+@[A-Za-z0-9-]+(?:\.[A-Za-z0-9-]+)*\.[A-Za-z]{2,}')
+    # +44 20 7946 0958, (555) 123-4567, 555.123.4567, +1-555-123-4567,
+    # 1-800-555-0199, 089 1234567, 5551234567. A number starts with a country
+    # code, a US trunk 1, an area code in parentheses or an area group
+    # followed by one long or at least two more groups, or is one run of 10+
+    # digits. Groups are separated by spaces, tabs, dots or dashes, never by
+    # line breaks, so numbers on consecutive lines aren't joined.
+    PHONE_PATTERN = re.compile(
+        r'(?<![\w@.+-])(?:'
+        r'\+\d{1,3}[ \t.-]?(?:\(\d{1,4}\)[ \t.-]?)?\d{1,5}(?:[ \t.-]\d{2,8}){1,4}'
+        r'|1[ \t.-](?:\(\d{3}\)|\d{3})[ \t.-]?\d{3}[ \t.-]\d{4}'
+        r'|\(\d{1,4}\)[ \t.-]?\d{2,8}(?:[ \t.-]\d{2,8}){0,3}'
+        r'|\d{2,5}[ \t.-]\d{6,8}'
+        r'|\d{2,5}[ \t.-]\d{2,8}(?:[ \t.-]\d{2,8}){1,3}'
+        r'|\d{10,15}'
+        r')(?![\w@])')
+    # Day, month and year groups such as 12-05-2023 or 2023 10 15 have the
+    # shape of a phone number but are dates
+    DATE_PATTERN = re.compile(
+        r'(?:0?[1-9]|[12]\d|3[01])[ \t.-](?:0?[1-9]|[12]\d|3[01])[ \t.-](?:19|20)\d{2}'
+        r'|(?:19|20)\d{2}[ \t.-](?:0?[1-9]|1[0-2])[ \t.-](?:0?[1-9]|[12]\d|3[01])')
+    URL_PATTERN = re.compile(r'\b(?:https?://|www\.)\S+\.[a-zA-Z]{2,}\S*\b')
+    DOMAIN_PATTERN = re.compile(
+        r'(?<![@\w.-])[A-Za-z0-9-]+(?:\.[A-Za-z0-9-]+)*\.(?:com|org|net|io|biz|info|co)(?:/[^\s]*)?(?![\w@.-])',
+        re.IGNORECASE)
+    # US ZIP after a state code, Canadian and UK postal codes
+    POSTAL_CODE_PATTERN = re.compile(
+        r'(?<=\b[A-Z]{2} )\d{5}(?:-\d{4})?\b'
+        r'|\b[A-Z]\d[A-Z] ?\d[A-Z]\d\b'
+        r'|\b[A-Z]{1,2}\d[A-Z\d]? \d[A-Z]{2}\b')
+    MIN_PHONE_DIGITS = 7
+    MAX_PHONE_DIGITS = 15
+
+    def extract(self, text):
+        """Extracts the regular fields from text
+
+        Args:
+            text (str): Recognized card text
+
+        Returns:
+            list: (field, value) pairs in order of appearance per field
+        """
+        entities = []
+        emails = self.EMAIL_PATTERN.findall(text)
+        for email in emails:
+            entities.append(('email', email))
+
+        # Don't let digits inside emails or URLs be read as phone numbers
+        remaining = self.EMAIL_PATTERN.sub(' ', text)
+        urls = self.URL_PATTERN.findall(remaining)
+        remaining = self.URL_PATTERN.sub(' ', remaining)
+        urls += self.DOMAIN_PATTERN.findall(remaining)
+        remaining = self.DOMAIN_PATTERN.sub(' ', remaining)
+        for url in urls:
+            entities.append(('url', url))
+
+        postal_codes = self.POSTAL_CODE_PATTERN.findall(remaining)
+        for postal_code in postal_codes:
+            entities.append(('postal_code', postal_code))
+        remaining = self.POSTAL_CODE_PATTERN.sub(' ', remaining)
+
+        for match in self.PHONE_PATTERN.finditer(remaining):
+            phone = match.group().strip()
+            if self.DATE_PATTERN.fullmatch(phone):
+                continue
+            digits = sum(c.isdigit() for c in phone)
+            if self.MIN_PHONE_DIGITS <= digits <= self.MAX_PHONE_DIGITS:
+                entities.append(('phone', phone))
+
+        return entities
 
 
 class NamedEntityRecognitionService:
-    def __init__(self):
-        self.comprehendmedical = boto3.client('comprehendmedical', region_name='us-east-1')
-        self.comprehend = boto3.client('comprehend', region_name='us-east-1')
+    def __init__(self, max_workers=16, mode=NER_MODE_REMOTE):
+        if mode not in NER_MODES:
+            raise ValueError(f'mode must be one of {NER_MODES}')
+        # Shared by all requests in the container; each detect_entities call
+        # uses two workers, so this also bounds concurrent batch requests
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.mode = mode
+        self.local_extractor = LocalEntityExtractor()
+        self._stats_lock = threading.Lock()
+        self._stats = {'remote_calls': 0, 'remote_calls_skipped': 0, 'entities': defaultdict(int)}
+
+    @property
+    def comprehendmedical(self):
+        return aws_clients.client('comprehendmedical')
+
+    @property
+    def comprehend(self):
+        return aws_clients.client('comprehend')
         
     
     def detect_entities(self, text):
-        response_list = defaultdict(list)
         try:
-            # Use AWS Comprehend for basic entity detection
-            response = self.comprehend.detect_entities(
-                Text = text,
-                LanguageCode = 'en'
-            )
-            for record in response['Entities']:
-                if record['Type'] == 'NAME':
-                    response_list['name'].append(record['Text'])
-                if record['Type'] == 'LOCATION':
-                    response_list['address'].append(record['Text'])
-
-            # Use AWS ComprehendMedical for specialized entities
-            response = self.comprehendmedical.detect_entities_v2(
-                Text = text
-            )
-
-            for record in response['Entities']:
-                if record['Type'] == 'NAME':
-                    response_list['name'].append(record['Text'])
-                if record['Type'] == 'EMAIL':
-                    response_list['email'].append(record['Text'])
-                if record['Type'] == 'PHONE_OR_FAX':
-                    response_list['phone'].append(record['Text'])
-                if record['Type'] == 'URL':
-                    response_list['url'].append(record['Text'])
-                if record['Type'] == 'ADDRESS':
-                    response_list['address'].append(record['Text'])
-            
-            # Custom detection for URLs and addresses
-            self._detect_urls(text, response_list)
-            self._detect_addresses(text, response_list)
-                    
-            return response_list
-
-
-        except(BotoCoreError, ClientError) as error: 
-            print(f"AWS SDK error: {error}")
-            return {"error": str(error)}
-        
+            local_entities, remote_providers = self._plan(text)
+
+            # Both AWS services are independent, so issue them concurrently and
+            # run the local passes while the requests are in flight
+            detectors = {
+                'comprehend': self._detect_comprehend_entities,
+                'comprehendmedical': self._detect_medical_entities,
+            }
+            providers = [(provider, instrumentation.submit(self.executor, detectors[provider], text))
+                         for provider in remote_providers]
+            return self._merge_entities(text, local_entities, providers, raise_throttling=True)
+
         except Exception as e:
+            if throttling.is_throttling(e):
+                raise
             print(f"Unexpected error: {e}")
             return {"error": str(e)}
+
+    def detect_entities_many(self, texts):
+        """Detects entities for many texts, coalescing Comprehend calls with
+        BatchDetectEntities (up to 25 documents per call).
+
+        Args:
+            texts (list): Texts to analyze, usually one per card
+
+        Returns:
+            list: One detect_entities style result per text, in the same order
+        """
+        texts = list(texts)
+        try:
+            plans = [self._plan(text) for text in texts]
+
+            # ComprehendMedical has no batch API, so those calls go to the pool
+            # while this thread drives the Comprehend batches
+            medical_futures = [instrumentation.submit(self.executor, self._detect_medical_entities, text)
+                               if 'comprehendmedical' in providers else None
+                               for text, (_, providers) in zip(texts, plans)]
+            comprehend_indices = [index for index, (_, providers) in enumerate(plans)
+                                  if 'comprehend' in providers]
+            comprehend_results = dict(zip(
+                comprehend_indices,
+                self._batch_detect_comprehend_entities([texts[index] for index in comprehend_indices])))
+
+            results = []
+            for index, (text, (local_entities, _)) in enumerate(zip(texts, plans)):
+                providers = []
+                if index in comprehend_results:
+                    providers.append(('comprehend', comprehend_results[index]))
+                if medical_futures[index] is not None:
+                    providers.append(('comprehendmedical', medical_futures[index]))
+                results.append(self._merge_entities(text, local_entities, providers))
+            return results
+
+        except Exception as e:
+            print(f"Unexpected error: {e}")
+            return [{"error": str(e)} for _ in texts]
+
+    def get_stats(self):
+        """Returns remote call counters and the number of entities produced per engine"""
+        with self._stats_lock:
+            stats = dict(self._stats)
+            stats['entities'] = dict(self._stats['entities'])
+        return stats
+
+    def _plan(self, text):
+        """Runs the rule based extraction for the configured mode and decides
+        which remote providers are still needed for text
+
+        Returns:
+            tuple: (local entities, list of remote provider names)
+        """
+        local_entities = []
+        if self.mode != NER_MODE_REMOTE:
+            with instrumentation.span('ner.local'):
+                local_entities = self.local_extractor.extract(text)
+
+        providers = []
+        if self.mode != NER_MODE_LOCAL and text.strip():
+            # Person names and free-form addresses always need a model
+            providers.append('comprehend')
+            resolved = {key for key, _ in local_entities}
+            if not all(field in resolved for field in LOCAL_RESOLVED_FIELDS):
+                providers.append('comprehendmedical')
+
+        with self._stats_lock:
+            self._stats['remote_calls'] += len(providers)
+            self._stats['remote_calls_skipped'] += 2 - len(providers)
+        return local_entities, providers
+
+    def _merge_entities(self, text, local_entities, providers, raise_throttling=False):
+        """Merges rule based, provider and local pass results for one text.
+
+        providers is a list of (provider name, result) where result is a
+        future, a list of (key, value) entities or the exception raised.
+        The engine that produced each value is reported under "sources",
+        aligned with the value lists. Errors of some providers are reported
+        under "provider_errors"; when every provider called failed the result
+        is an {"error": ...} like any failed detection, or, with
+        raise_throttling, a throttling error among them is raised.
+        """
+        response_list = defaultdict(list)
+        sources = defaultdict(list)
+
+        def add(key, value, engine, dedupe):
+            if dedupe and value in response_list.get(key, ()):
+                return
+            response_list[key].append(value)
+            sources[key].append(engine)
+
+        for key, value in local_entities:
+            add(key, value, 'local', True)
+        local_keys = set(response_list)
+
+        # Custom detection for URLs and addresses
+        local_list = defaultdict(list)
+        with instrumentation.span('ner.local_passes'):
+            self._detect_urls(text, local_list)
+            self._detect_addresses(text, local_list)
+
+        # Merge in a fixed provider order so results don't depend on timing
+        provider_errors = {}
+        failures = []
+        for provider, entities in providers:
+            if hasattr(entities, 'result'):
+                try:
+                    entities = entities.result()
+                except (BotoCoreError, ClientError) as error:
+                    entities = error
+            if isinstance(entities, Exception):
+                instrumentation.debug('AWS SDK error from %s: %s', provider, entities)
+                provider_errors[provider] = str(entities)
+                failures.append(entities)
+                continue
+            for key, value in entities:
+                add(key, value, provider, key in local_keys)
+
+        if providers and len(failures) == len(providers):
+            throttled = [error for error in failures if throttling.is_throttling(error)]
+            if raise_throttling and throttled:
+                raise throttled[0]
+            print(f"AWS SDK error: {failures[0]}")
+            return {'error': str(failures[0]), 'provider_errors': provider_errors}
+
+        for key in ('url', 'address'):
+            for value in local_list[key]:
+                add(key, value, 'local', True)
+
+        with self._stats_lock:
+            for engine_list in sources.values():
+                for engine in engine_list:
+                    self._stats['entities'][engine] += 1
+
+        response_list['sources'] = dict(sources)
+        if provider_errors:
+            response_list['provider_errors'] = provider_errors
+
+        return response_list
+
+    def _detect_comprehend_entities(self, text):
+        """Use AWS Comprehend for basic entity detection"""
+        response = self.comprehend.detect_entities(
+            Text = text,
+            LanguageCode = 'en'
+        )
+        return self._comprehend_records(response['Entities'])
+
+    def _batch_detect_comprehend_entities(self, texts):
+        """Runs Comprehend over texts using BatchDetectEntities.
+
+        Only the documents reported in ErrorList are retried. Documents over
+        the batch size limit fall back to single DetectEntities calls.
+
+        Returns:
+            list: Entities (or the error raised) for each text, in order
+        """
+        results = [[] for _ in texts]
+        pending = []
+        oversized = {}
+        for index, text in enumerate(texts):
+            size = len(text.encode('utf-8'))
+            if size >= COMPREHEND_BATCH_MAX_BYTES:
+                oversized[index] = instrumentation.submit(self.executor, self._detect_comprehend_entities, text)
+            elif size > 0 and text.strip():
+                pending.append(index)
+
+        for attempt in range(COMPREHEND_BATCH_RETRIES + 1):
+            if attempt:
+                time.sleep(0.1 * 2 ** attempt)
+            failed = []
+            for start in range(0, len(pending), COMPREHEND_BATCH_SIZE):
+                batch = pending[start:start + COMPREHEND_BATCH_SIZE]
+                try:
+                    response = self.comprehend.batch_detect_entities(
+                        TextList = [texts[index] for index in batch],
+                        LanguageCode = 'en'
+                    )
+                except (BotoCoreError, ClientError) as error:
+                    for index in batch:
+                        results[index] = error
+                    failed.extend(batch)
+                    continue
+
+                for record in response['ResultList']:
+                    results[batch[record['Index']]] = self._comprehend_records(record['Entities'])
+                for record in response['ErrorList']:
+                    index = batch[record['Index']]
+                    results[index] = RuntimeError(f"{record['ErrorCode']}: {record['ErrorMessage']}")
+                    failed.append(index)
+            pending = sorted(failed)
+            if not pending:
+                break
+
+        for index, future in oversized.items():
+            try:
+                results[index] = future.result()
+            except (BotoCoreError, ClientError) as error:
+                results[index] = error
+
+        return results
+
+    def _comprehend_records(self, records):
+        entities = []
+        for record in records:
+            # Comprehend reports people as PERSON
+            if record['Type'] == 'NAME' or record['Type'] == 'PERSON':
+                entities.append(('name', record['Text']))
+            if record['Type'] == 'LOCATION':
+                entities.append(('address', record['Text']))
+        return entities
+
+    def _detect_medical_entities(self, text):
+        """Use AWS ComprehendMedical for specialized entities"""
+        response = self.comprehendmedical.detect_entities_v2(
+            Text = text
+        )
+        entities = []
+        for record in response['Entities']:
+            if record['Type'] == 'NAME':
+                entities.append(('name', record['Text']))
+            if record['Type'] == 'EMAIL':
+                entities.append(('email', record['Text']))
+            if record['Type'] == 'PHONE_OR_FAX':
+                entities.append(('phone', record['Text']))
+            if record['Type'] == 'URL':
+                entities.append(('url', record['Text']))
+            if record['Type'] == 'ADDRESS':
+                entities.append(('address', record['Text']))
+        return entities
     
     def _detect_urls(self, text, response_list):
         """Custom URL detection to catch websites that AWS Comprehend might miss"""
         # Match common URL patterns including those starting with www.
-        url_pattern = re.compile(r'\b(?:https?://|www\.)\S+\.[a-zA-Z]{2,}\S*\b')
-        urls = url_pattern.findall(text)
+        urls = LocalEntityExtractor.URL_PATTERN.findall(text)
         for url in urls:
             if url not in response_list['url']:
                 response_list['url'].append(url)
@@ -69,31 +397,22 @@ class NamedEntityRecognitionService:
     def _detect_addresses(self, text, response_list):
         """Custom address detection logic"""
         lines = text.split('\n')
-        
-        # Common address patterns
-        address_indicators = ['street', 'avenue', 'ave', 'st', 'road', 'rd', 'lane', 'ln', 'drive', 'dr', 
-                             'blvd', 'boulevard', 'suite', 'apt', 'apartment', 'floor', 'fl']
-        
-        # Look for zip code patterns
-        zip_pattern = re.compile(r'\b\d{5}(?:-\d{4})?\b')
-        
-        # State abbreviation pattern
-        state_pattern = re.compile(r'\b[A-Z]{2}\b')
-        
+
+        # Classify every line with one precompiled scan each
+        is_address = [ADDRESS_LINE_PATTERN.search(line) is not None for line in lines]
+
         for i, line in enumerate(lines):
-            line_lower = line.lower()
-            
-            # Check for address indicators
-            if any(indicator in line_lower for indicator in address_indicators) or zip_pattern.search(line):
-                # Check if this line might be part of a multi-line address
-                potential_address = line
-                
-                # Look at the next line to see if it might be part of the same address
-                if i + 1 < len(lines):
-                    next_line = lines[i + 1]
-                    if zip_pattern.search(next_line) or state_pattern.search(next_line):
-                        potential_address += ', ' + next_line
-                
-                if potential_address not in response_list['address']:
-                    response_list['address'].append(potential_address)
-        
\ No newline at end of file
+            if not is_address[i]:
+                continue
+
+            # Check if this line might be part of a multi-line address
+            potential_address = line
+
+            # Look at the next line to see if it might be part of the same address
+            if i + 1 < len(lines):
+                next_line = lines[i + 1]
+                if ADDRESS_CONTINUATION_PATTERN.search(next_line):
+                    potential_address += ', ' + next_line
+
+            if potential_address not in response_list['address']:
+                response_list['address'].append(potential_address)
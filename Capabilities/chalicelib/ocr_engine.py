@@ -0,0 +1,260 @@
+"""OCR engines and the policies layered on top of them.
+
+An OCR engine turns an image, stored in the storage bucket or passed as
+bytes, into lines of {text, confidence, boundingBox}. TextractService and
+RecognitionService are engines; HedgedOcrEngine races two of them and
+CachedOcrEngine caches the lines of any engine by image content.
+"""
+from abc import ABC, abstractmethod
+from bisect import bisect_left
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import concurrent.futures
+import hashlib
+import threading
+import time
+
+from chalicelib import instrumentation
+from chalicelib import throttling
+
+
+class OcrEngine(ABC):
+    """Interface of the OCR engines"""
+
+    # Identifies the engine in stats and in the OCR cache namespace
+    name = None
+
+    @abstractmethod
+    def detect_text(self, file_name):
+        """Detects text in an image stored in the storage bucket
+
+        Returns:
+            list: Lines as dicts with text, confidence (0-100) and boundingBox
+        """
+
+    @abstractmethod
+    def detect_text_bytes(self, file_bytes):
+        """Detects text in an image passed as bytes, without reading it from S3
+
+        Returns:
+            list: Lines as dicts with text, confidence (0-100) and boundingBox
+        """
+
+    def detect(self, method, argument):
+        """Calls detect_text or detect_text_bytes (method) and tells which
+        engine answered, which differs from this one for engines combining
+        others
+
+        Returns:
+            tuple: (lines, name of the engine that produced them)
+        """
+        return getattr(self, method)(argument), self.name
+
+
+class LatencyHistogram:
+    """Thread-safe histogram of call latencies with logarithmic buckets.
+
+    Bucket bounds grow by GROWTH from MIN_MS up to MAX_MS, so percentiles
+    are accurate to about 20% at any scale. Once max_samples latencies are
+    recorded all counts are halved, so old samples fade out and the
+    percentiles follow the engine's current behavior.
+    """
+
+    MIN_MS = 1.0
+    MAX_MS = 120000.0
+    GROWTH = 1.2
+
+    def __init__(self, max_samples=1000):
+        bounds = [self.MIN_MS]
+        while bounds[-1] < self.MAX_MS:
+            bounds.append(bounds[-1] * self.GROWTH)
+        self.bounds = bounds
+        self.max_samples = max_samples
+        self._counts = [0] * (len(bounds) + 1)
+        self._total = 0
+        self._lock = threading.Lock()
+
+    def record(self, milliseconds):
+        with self._lock:
+            self._counts[bisect_left(self.bounds, milliseconds)] += 1
+            self._total += 1
+            if self._total >= self.max_samples:
+                self._counts = [count // 2 for count in self._counts]
+                self._total = sum(self._counts)
+
+    def count(self):
+        with self._lock:
+            return self._total
+
+    def percentile(self, fraction):
+        """Returns the upper bound in milliseconds of the bucket holding the
+        given fraction of the recorded latencies, None if nothing is recorded
+        """
+        with self._lock:
+            if not self._total:
+                return None
+            rank = fraction * self._total
+            seen = 0
+            for index, count in enumerate(self._counts):
+                seen += count
+                if seen >= rank and count:
+                    return self.bounds[index] if index < len(self.bounds) else self.MAX_MS
+        return self.MAX_MS
+
+    def summary(self):
+        percentiles = {f'p{round(fraction * 100)}_ms': self.percentile(fraction)
+                       for fraction in (0.50, 0.95, 0.99)}
+        summary = {name: round(ms, 1) if ms is not None else None for name, ms in percentiles.items()}
+        summary['count'] = self.count()
+        return summary
+
+
+class HedgedOcrEngine(OcrEngine):
+    """Runs the primary engine and, when it is slow, hedges with the
+    secondary one.
+
+    If the primary has not answered within its hedge budget, the given
+    percentile of its latency histogram, the same image is sent to the
+    secondary engine too and whichever answers first wins. If the primary
+    fails (throttled or otherwise) before the budget runs out, the secondary
+    is used as a fallback. The call only fails when both engines fail, with
+    the primary's error.
+    """
+
+    def __init__(self, primary, secondary, hedge_percentile=0.95, default_budget_ms=3000,
+                 min_samples=20, executor=None):
+        """Constructor
+
+        Args:
+            primary (OcrEngine): Engine asked first
+            secondary (OcrEngine): Engine used for hedges and fallbacks
+            hedge_percentile (float, optional): Primary latency percentile after which to hedge. Defaults to 0.95.
+            default_budget_ms (float, optional): Hedge budget until min_samples are recorded. Defaults to 3000.
+            min_samples (int, optional): Primary latencies needed before the histogram is used. Defaults to 20.
+            executor (optional): Thread pool running the engine calls. Defaults to a pool of 16 threads.
+        """
+        self.primary = primary
+        self.secondary = secondary
+        self.name = f'hedged:{primary.name},{secondary.name}'
+        self.hedge_percentile = hedge_percentile
+        self.default_budget_ms = default_budget_ms
+        self.min_samples = min_samples
+        # Every OCR call holds one thread, hedged calls two
+        self.executor = executor or ThreadPoolExecutor(max_workers=16)
+        self.histograms = {primary.name: LatencyHistogram(), secondary.name: LatencyHistogram()}
+        self._lock = threading.Lock()
+        self._stats = {'calls': 0, 'hedges': 0, 'hedge_wins': 0, 'fallbacks': 0,
+                       'throttled_fallbacks': 0, 'failures': 0}
+
+    def detect_text(self, file_name):
+        return self.detect('detect_text', file_name)[0]
+
+    def detect_text_bytes(self, file_bytes):
+        return self.detect('detect_text_bytes', file_bytes)[0]
+
+    def detect(self, method, argument):
+        self._count('calls')
+        primary = self._submit(self.primary, method, argument)
+        try:
+            return primary.result(timeout=self.hedge_budget_ms() / 1000), self.primary.name
+        except concurrent.futures.TimeoutError:
+            return self._hedge(primary, method, argument)
+        except Exception as e:
+            self._count('throttled_fallbacks' if throttling.is_throttling(e) else 'fallbacks')
+            instrumentation.debug('OCR engine %s failed, falling back to %s: %s',
+                                  self.primary.name, self.secondary.name, e)
+            with instrumentation.span('ocr_fallback'):
+                try:
+                    return self._timed(self.secondary, method, argument), self.secondary.name
+                except Exception:
+                    self._count('failures')
+                    raise e
+
+    def hedge_budget_ms(self):
+        """Returns how long the primary engine gets before the hedge is sent"""
+        histogram = self.histograms[self.primary.name]
+        if histogram.count() < self.min_samples:
+            return self.default_budget_ms
+        return histogram.percentile(self.hedge_percentile)
+
+    def _count(self, stat):
+        with self._lock:
+            self._stats[stat] += 1
+
+    def _timed(self, engine, method, argument):
+        start = time.perf_counter()
+        lines = getattr(engine, method)(argument)
+        # Only successful calls, a fast failure says nothing about latency
+        self.histograms[engine.name].record((time.perf_counter() - start) * 1000)
+        return lines
+
+    def _submit(self, engine, method, argument):
+        return instrumentation.submit(self.executor, self._timed, engine, method, argument)
+
+    def _hedge(self, primary, method, argument):
+        self._count('hedges')
+        with instrumentation.span('ocr_hedge'):
+            secondary = self._submit(self.secondary, method, argument)
+            pending = {primary, secondary}
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    if future.exception() is None:
+                        if future is secondary:
+                            self._count('hedge_wins')
+                            return future.result(), self.secondary.name
+                        return future.result(), self.primary.name
+        self._count('failures')
+        raise primary.exception()
+
+    def get_stats(self):
+        """Returns hedge and fallback counters, the current hedge budget and
+        the latency percentiles of each engine
+        """
+        with self._lock:
+            stats = dict(self._stats)
+        stats['hedge_budget_ms'] = round(self.hedge_budget_ms(), 1)
+        stats['engines'] = {name: histogram.summary() for name, histogram in self.histograms.items()}
+        return stats
+
+
+class CachedOcrEngine(OcrEngine):
+    """Serves the lines of an engine from an OcrResultCache, keyed by image
+    content so re-uploads of the same image hit and overwrites of an
+    existing name miss
+    """
+
+    def __init__(self, engine, cache, storage_service, cached_engine=None):
+        """Constructor
+
+        Args:
+            engine (OcrEngine): Engine answering cache misses
+            cache (OcrResultCache): Cache of the lines
+            storage_service (StorageService): Storage bucket, for the ETags of stored images
+            cached_engine (str, optional): Only lines produced by the engine of this name are
+                cached, e.g. the primary of a HedgedOcrEngine, so hedge and fallback answers
+                are not served again. Defaults to None, caching every answer.
+        """
+        self.engine = engine
+        self.name = engine.name
+        self.cache = cache
+        self.storage_service = storage_service
+        self.cached_engine = cached_engine
+
+    def detect_text(self, file_name):
+        content_key = 'etag-' + self.storage_service.get_file_etag(file_name)
+        return self._cached(content_key, 'detect_text', file_name)
+
+    def detect_text_bytes(self, file_bytes):
+        # The ETag S3 assigns to a single part upload is the MD5 of its body,
+        # so this shares cache entries with detect_text for the same content
+        content_key = 'etag-' + hashlib.md5(file_bytes).hexdigest()
+        return self._cached(content_key, 'detect_text_bytes', file_bytes)
+
+    def _cached(self, content_key, method, argument):
+        with instrumentation.span('ocr_cache'):
+            lines = self.cache.get(content_key)
+        if lines is None:
+            lines, answered_by = self.engine.detect(method, argument)
+            if self.cached_engine is None or answered_by == self.cached_engine:
+                self.cache.put(content_key, lines)
+        return lines
@@ -0,0 +1,285 @@
+"""Bulk recognition jobs: the SQS queue that feeds the workers and the
+DynamoDB table that clients poll for progress and results.
+
+A job is one message per image on the jobs queue. Workers take messages in
+batches, and a message that fails max_receive_count times is moved by SQS
+to the dead-letter queue, whose handler records the image as failed.
+"""
+import base64
+import json
+import time
+import uuid
+
+from chalicelib import aws_clients
+
+STATUS_QUEUED = 'QUEUED'
+STATUS_IN_PROGRESS = 'IN_PROGRESS'
+STATUS_COMPLETE = 'COMPLETE'
+STATUS_FAILED = 'FAILED'
+
+# Sort key of the job's own item; image items use IMAGE_ENTRY_PREFIX + image_id
+JOB_ENTRY = '#job'
+IMAGE_ENTRY_PREFIX = 'image#'
+
+# SQS limit per SendMessageBatch / DeleteMessageBatch call
+QUEUE_BATCH_SIZE = 10
+
+
+class RecognitionJobStore:
+    """Jobs and their per-image results in one DynamoDB table with partition
+    key job_id (S) and sort key entry (S).
+
+    The job item keeps the number of images and the completed and failed
+    counters; every processed image adds an item with its entities or
+    error. Image items are written once, conditionally, in the same
+    transaction as the counter they add to, so messages SQS delivers twice
+    are not counted twice and a stored result is never left uncounted.
+    """
+
+    def __init__(self, table_name, dynamodb=None):
+        """Constructor
+
+        Args:
+            table_name (str): Jobs table name in DynamoDB service
+            dynamodb (optional): boto3 DynamoDB client. Defaults to the shared client of aws_clients.
+        """
+        self.table_name = table_name
+        self._dynamodb = dynamodb
+
+    @property
+    def dynamodb(self):
+        return self._dynamodb or aws_clients.client('dynamodb')
+
+    def create_job(self, total):
+        """Creates a QUEUED job for total images
+
+        Returns:
+            str: The new job's id
+        """
+        job_id = str(uuid.uuid4())
+        self.dynamodb.put_item(
+            TableName=self.table_name,
+            Item={
+                'job_id': {'S': job_id},
+                'entry': {'S': JOB_ENTRY},
+                'status': {'S': STATUS_QUEUED},
+                'total': {'N': str(total)},
+                'completed': {'N': '0'},
+                'failed': {'N': '0'},
+                'created_at': {'N': str(int(time.time()))},
+            })
+        return job_id
+
+    def fail_job(self, job_id, error):
+        """Marks a job that could not be queued as FAILED"""
+        self.dynamodb.update_item(
+            TableName=self.table_name,
+            Key={'job_id': {'S': job_id}, 'entry': {'S': JOB_ENTRY}},
+            UpdateExpression='SET #status = :failed, #error = :error',
+            ExpressionAttributeNames={'#status': 'status', '#error': 'error'},
+            ExpressionAttributeValues={':failed': {'S': STATUS_FAILED}, ':error': {'S': str(error)}})
+
+    def store_image_result(self, job_id, image_id, entities=None, error=None):
+        """Stores the entities of a job's image, or its error, and counts it
+        as completed or failed on the job in one transaction
+
+        Returns:
+            bool: False if the image already had a result (a redelivered message)
+                or the job no longer exists
+        """
+        item = {
+            'job_id': {'S': job_id},
+            'entry': {'S': IMAGE_ENTRY_PREFIX + image_id},
+            'status': {'S': STATUS_FAILED if error is not None else STATUS_COMPLETE},
+            'updated_at': {'N': str(int(time.time()))},
+        }
+        if error is not None:
+            item['error'] = {'S': str(error)}
+        else:
+            item['entities'] = {'S': json.dumps(entities)}
+        counter = 'failed' if error is not None else 'completed'
+        try:
+            self.dynamodb.transact_write_items(TransactItems=[
+                {'Put': {
+                    'TableName': self.table_name,
+                    'Item': item,
+                    'ConditionExpression': 'attribute_not_exists(entry)',
+                }},
+                {'Update': {
+                    'TableName': self.table_name,
+                    'Key': {'job_id': {'S': job_id}, 'entry': {'S': JOB_ENTRY}},
+                    'UpdateExpression': f'ADD {counter} :one',
+                    # Don't recreate jobs deleted by hand
+                    'ConditionExpression': 'attribute_exists(job_id)',
+                    'ExpressionAttributeValues': {':one': {'N': '1'}},
+                }},
+            ])
+        except self.dynamodb.exceptions.TransactionCanceledException as e:
+            reasons = [reason.get('Code') for reason in e.response.get('CancellationReasons', [])]
+            if 'ConditionalCheckFailed' in reasons:
+                return False
+            raise
+        return True
+
+    def get_job(self, job_id, limit=100, cursor=None):
+        """Returns a job with one page of its image results
+
+        Args:
+            job_id (str): Job unique identifier
+            limit (int, optional): Image results per page. Defaults to 100.
+            cursor (str, optional): next_cursor returned for the previous page. Defaults to None.
+
+        Raises:
+            ValueError: If the cursor is malformed or belongs to another job
+
+        Returns:
+            dict: Job status, counters, results and next_cursor. None if the job doesn't exist.
+        """
+        response = self.dynamodb.get_item(
+            TableName=self.table_name,
+            Key={'job_id': {'S': job_id}, 'entry': {'S': JOB_ENTRY}},
+            ConsistentRead=True)
+        item = response.get('Item')
+        if item is None:
+            return None
+
+        query = {
+            'TableName': self.table_name,
+            'KeyConditionExpression': 'job_id = :job_id AND begins_with(entry, :prefix)',
+            'ExpressionAttributeValues': {':job_id': {'S': job_id}, ':prefix': {'S': IMAGE_ENTRY_PREFIX}},
+            'Limit': limit,
+        }
+        if cursor:
+            query['ExclusiveStartKey'] = self._decode_cursor(cursor, job_id)
+        response = self.dynamodb.query(**query)
+
+        results = []
+        for entry in response.get('Items', []):
+            result = {'image_id': entry['entry']['S'][len(IMAGE_ENTRY_PREFIX):], 'status': entry['status']['S']}
+            if 'entities' in entry:
+                result['entities'] = json.loads(entry['entities']['S'])
+            if 'error' in entry:
+                result['error'] = entry['error']['S']
+            results.append(result)
+
+        total = int(item['total']['N'])
+        completed = int(item['completed']['N'])
+        failed = int(item['failed']['N'])
+        status = item['status']['S']
+        if status != STATUS_FAILED and completed + failed:
+            status = STATUS_COMPLETE if completed + failed >= total else STATUS_IN_PROGRESS
+
+        job = {
+            'job_id': job_id,
+            'status': status,
+            'total': total,
+            'completed': completed,
+            'failed': failed,
+            'created_at': int(item['created_at']['N']),
+            'results': results,
+            'next_cursor': (self._encode_cursor(response['LastEvaluatedKey'])
+                            if 'LastEvaluatedKey' in response else None),
+        }
+        if 'error' in item:
+            job['error'] = item['error']['S']
+        return job
+
+    def _encode_cursor(self, last_evaluated_key):
+        """Turns a LastEvaluatedKey into an opaque, URL safe cursor"""
+        raw = json.dumps(last_evaluated_key, separators=(',', ':'), sort_keys=True)
+        return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii').rstrip('=')
+
+    def _decode_cursor(self, cursor, job_id):
+        """Turns a cursor back into an ExclusiveStartKey for job_id"""
+        try:
+            raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+            key = json.loads(raw)
+            valid = key['job_id'] == {'S': job_id} and key['entry']['S'].startswith(IMAGE_ENTRY_PREFIX)
+        except (ValueError, KeyError, TypeError, AttributeError):
+            valid = False
+        if not valid:
+            raise ValueError('invalid cursor')
+        return key
+
+    def create_table(self):
+        """Creates the jobs table, billed per request"""
+        self.dynamodb.create_table(
+            TableName=self.table_name,
+            AttributeDefinitions=[
+                {'AttributeName': 'job_id', 'AttributeType': 'S'},
+                {'AttributeName': 'entry', 'AttributeType': 'S'},
+            ],
+            KeySchema=[
+                {'AttributeName': 'job_id', 'KeyType': 'HASH'},
+                {'AttributeName': 'entry', 'KeyType': 'RANGE'},
+            ],
+            BillingMode='PAY_PER_REQUEST')
+
+
+class RecognitionJobQueue:
+    """The SQS queue of job messages, one {"job_id", "image_id"} per image,
+    and its dead-letter queue
+    """
+
+    def __init__(self, queue_name, dead_letter_queue_name):
+        self.queue_name = queue_name
+        self.dead_letter_queue_name = dead_letter_queue_name
+        self._queue_urls = {}
+
+    @property
+    def client(self):
+        return aws_clients.client('sqs')
+
+    def _queue_url(self, queue_name):
+        url = self._queue_urls.get(queue_name)
+        if url is None:
+            url = self._queue_urls[queue_name] = self.client.get_queue_url(QueueName=queue_name)['QueueUrl']
+        return url
+
+    def send(self, job_id, image_ids, max_attempts=3):
+        """Queues one message per image, ten per SendMessageBatch call
+
+        Raises:
+            RuntimeError: If some messages could still not be sent after max_attempts calls
+        """
+        queue_url = self._queue_url(self.queue_name)
+        for start in range(0, len(image_ids), QUEUE_BATCH_SIZE):
+            pending = [{'Id': str(index), 'MessageBody': json.dumps({'job_id': job_id, 'image_id': image_id})}
+                       for index, image_id in enumerate(image_ids[start:start + QUEUE_BATCH_SIZE])]
+            for _ in range(max_attempts):
+                response = self.client.send_message_batch(QueueUrl=queue_url, Entries=pending)
+                failed_ids = {failure['Id'] for failure in response.get('Failed', [])}
+                pending = [entry for entry in pending if entry['Id'] in failed_ids]
+                if not pending:
+                    break
+            if pending:
+                raise RuntimeError(f'{len(pending)} messages of job {job_id} could not be queued')
+
+    def delete(self, receipt_handles):
+        """Deletes processed messages of the jobs queue, e.g. the successful
+        part of a batch that failed as a whole
+        """
+        queue_url = self._queue_url(self.queue_name)
+        for start in range(0, len(receipt_handles), QUEUE_BATCH_SIZE):
+            entries = [{'Id': str(index), 'ReceiptHandle': handle}
+                       for index, handle in enumerate(receipt_handles[start:start + QUEUE_BATCH_SIZE])]
+            response = self.client.delete_message_batch(QueueUrl=queue_url, Entries=entries)
+            for failure in response.get('Failed', []):
+                print(f"Could not delete message {failure['Id']}: {failure.get('Message')}")
+
+    def create_queues(self, max_receive_count=3, visibility_timeout=900):
+        """Creates the jobs queue and its dead-letter queue. The visibility
+        timeout should be at least six times the worker Lambda's timeout.
+        """
+        dead_letter_url = self.client.create_queue(
+            QueueName=self.dead_letter_queue_name,
+            Attributes={'MessageRetentionPeriod': str(14 * 24 * 3600)})['QueueUrl']
+        dead_letter_arn = self.client.get_queue_attributes(
+            QueueUrl=dead_letter_url, AttributeNames=['QueueArn'])['Attributes']['QueueArn']
+        self.client.create_queue(
+            QueueName=self.queue_name,
+            Attributes={
+                'VisibilityTimeout': str(visibility_timeout),
+                'RedrivePolicy': json.dumps({'deadLetterTargetArn': dead_letter_arn,
+                                             'maxReceiveCount': str(max_receive_count)}),
+            })
@@ -0,0 +1,134 @@
+import json
+import time
+
+from chalicelib import aws_clients
+
+STATUS_IN_PROGRESS = 'IN_PROGRESS'
+STATUS_COMPLETE = 'COMPLETE'
+STATUS_FAILED = 'FAILED'
+
+# Work claimed longer ago than this is considered lost (e.g. the Lambda timed
+# out) and can be claimed again
+STALE_AFTER_SECONDS = 900
+
+
+class RecognitionResultStore:
+    """Entities extracted from uploaded images, precomputed when the image
+    lands in the bucket.
+
+    One item per image in its own DynamoDB table with partition key
+    image_id (S). Every item carries the ETag of the image version it
+    describes and a status: IN_PROGRESS while an event handler works on
+    it, then COMPLETE with the entities or FAILED with the error.
+    """
+
+    def __init__(self, table_name, dynamodb=None):
+        """Constructor
+
+        Args:
+            table_name (str): Results table name in DynamoDB service
+            dynamodb (optional): boto3 DynamoDB client. Defaults to the shared client of aws_clients.
+        """
+        self.table_name = table_name
+        self._dynamodb = dynamodb
+
+    @property
+    def dynamodb(self):
+        return self._dynamodb or aws_clients.client('dynamodb')
+
+    def get(self, image_id):
+        """Returns the result of an image
+
+        Args:
+            image_id (str): Image key in the storage bucket
+
+        Returns:
+            dict: status, etag, updated_at and, by status, entities or error. None if the image has no result.
+        """
+        response = self.dynamodb.get_item(
+            TableName=self.table_name,
+            Key={'image_id': {'S': image_id}},
+            # A result completed a moment ago must not be missed
+            ConsistentRead=True)
+        item = response.get('Item')
+        if item is None:
+            return None
+
+        result = {
+            'status': item['status']['S'],
+            'etag': item['etag']['S'],
+            'updated_at': int(item['updated_at']['N']),
+        }
+        if 'entities' in item:
+            result['entities'] = json.loads(item['entities']['S'])
+        if 'error' in item:
+            result['error'] = item['error']['S']
+        return result
+
+    def claim(self, image_id, etag):
+        """Marks an image version IN_PROGRESS unless it is already complete or
+        being worked on. S3 delivers events at least once, so duplicates of
+        an event find the claim taken.
+
+        Returns:
+            bool: True if the caller should process the image
+        """
+        now = int(time.time())
+        try:
+            self.dynamodb.put_item(
+                TableName=self.table_name,
+                Item={
+                    'image_id': {'S': image_id},
+                    'etag': {'S': etag},
+                    'status': {'S': STATUS_IN_PROGRESS},
+                    'updated_at': {'N': str(now)},
+                },
+                ConditionExpression=('attribute_not_exists(image_id) OR etag <> :etag'
+                                     ' OR #status = :failed'
+                                     ' OR (#status = :in_progress AND updated_at < :stale)'),
+                ExpressionAttributeNames={'#status': 'status'},
+                ExpressionAttributeValues={
+                    ':etag': {'S': etag},
+                    ':failed': {'S': STATUS_FAILED},
+                    ':in_progress': {'S': STATUS_IN_PROGRESS},
+                    ':stale': {'N': str(now - STALE_AFTER_SECONDS)},
+                })
+        except self.dynamodb.exceptions.ConditionalCheckFailedException:
+            return False
+        return True
+
+    def complete(self, image_id, etag, entities):
+        """Stores the entities of an image version, claimed or not"""
+        self._finish(image_id, etag, STATUS_COMPLETE, 'entities', json.dumps(entities))
+
+    def fail(self, image_id, etag, error):
+        """Records that an image version could not be processed"""
+        self._finish(image_id, etag, STATUS_FAILED, 'error', str(error))
+
+    def _finish(self, image_id, etag, status, attribute, value):
+        stale_attribute = 'error' if attribute == 'entities' else 'entities'
+        try:
+            self.dynamodb.update_item(
+                TableName=self.table_name,
+                Key={'image_id': {'S': image_id}},
+                UpdateExpression=('SET etag = :etag, #status = :status, #value = :value, updated_at = :now'
+                                  ' REMOVE #stale'),
+                # A newer upload of the image owns the item now, leave it alone
+                ConditionExpression='attribute_not_exists(image_id) OR etag = :etag',
+                ExpressionAttributeNames={'#status': 'status', '#value': attribute, '#stale': stale_attribute},
+                ExpressionAttributeValues={
+                    ':status': {'S': status},
+                    ':value': {'S': value},
+                    ':now': {'N': str(int(time.time()))},
+                    ':etag': {'S': etag},
+                })
+        except self.dynamodb.exceptions.ConditionalCheckFailedException:
+            pass
+
+    def create_table(self):
+        """Creates the results table, billed per request"""
+        self.dynamodb.create_table(
+            TableName=self.table_name,
+            AttributeDefinitions=[{'AttributeName': 'image_id', 'AttributeType': 'S'}],
+            KeySchema=[{'AttributeName': 'image_id', 'KeyType': 'HASH'}],
+            BillingMode='PAY_PER_REQUEST')
@@ -1,21 +1,32 @@
-import boto3
+from chalicelib import aws_clients
+from chalicelib import instrumentation
+from chalicelib.ocr_engine import OcrEngine
+
+class RecognitionService(OcrEngine):
+    name = 'rekognition.detect_text'
 
-class RecognitionService:
     def __init__(self, storage_service):
-        self.client = boto3.client('rekognition', region_name='us-east-1')
         self.bucket_name = storage_service.get_storage_location()
 
+    @property
+    def client(self):
+        return aws_clients.client('rekognition')
+
     def detect_text(self, file_name):
-        print("file_name", file_name)
-        print("self: ", self)
-        print("self.bucket_name", self.bucket_name)
-        response = self.client.detect_text(
-            Image = {
-                'S3Object': {
-                    'Bucket': self.bucket_name,
-                    'Name': file_name
-                }
+        instrumentation.debug('Rekognition detect_text %s in bucket %s', file_name, self.bucket_name)
+        return self._detect_image({
+            'S3Object': {
+                'Bucket': self.bucket_name,
+                'Name': file_name
             }
+        })
+
+    def detect_text_bytes(self, file_bytes):
+        return self._detect_image({'Bytes': file_bytes})
+
+    def _detect_image(self, image):
+        response = self.client.detect_text(
+            Image = image
         )
 
         lines = []
@@ -0,0 +1,132 @@
+import re
+
+from chalicelib import aws_clients
+from chalicelib.dynamo_batch import batch_write
+
+# Text attributes of a card that can be searched
+INDEXED_ATTRIBUTES = ['card_names', 'email_addresses', 'company_name', 'company_website', 'company_address']
+
+TOKEN_PATTERN = re.compile(r'[^\W_]+')
+MIN_PREFIX_LENGTH = 2
+MAX_TERM_LENGTH = 20
+
+
+def tokenize(text):
+    """Splits text into lowercase alphanumeric tokens"""
+    return TOKEN_PATTERN.findall(str(text).casefold())
+
+
+class CardSearchIndex:
+    """Per-user inverted index of card text kept in its own DynamoDB table.
+
+    Every posting is an item with partition key term_key = "<user_id>#<term>"
+    and sort key card_id. Terms are the lowercase tokens of the indexed
+    attributes plus their prefixes, so a search reads only the postings of
+    its own terms instead of the whole user partition.
+    """
+
+    def __init__(self, table_name, dynamodb=None):
+        """Constructor
+
+        Args:
+            table_name (str): Index table name in DynamoDB service
+            dynamodb (optional): boto3 DynamoDB client. Defaults to the shared client of aws_clients.
+        """
+        self.table_name = table_name
+        self._dynamodb = dynamodb
+
+    @property
+    def dynamodb(self):
+        return self._dynamodb or aws_clients.client('dynamodb')
+
+    def item_terms(self, item):
+        """Returns the set of index terms of a raw card item"""
+        terms = set()
+        for attribute in INDEXED_ATTRIBUTES:
+            value = item.get(attribute)
+            if not value:
+                continue
+            values = value['SS'] if 'SS' in value else [value.get('S', '')]
+            for text in values:
+                for token in tokenize(text):
+                    token = token[:MAX_TERM_LENGTH]
+                    for length in range(min(MIN_PREFIX_LENGTH, len(token)), len(token) + 1):
+                        terms.add(token[:length])
+        return terms
+
+    def query_terms(self, filter):
+        """Returns the terms a card must have to match a search filter"""
+        return {token[:MAX_TERM_LENGTH] for token in tokenize(filter)}
+
+    def update(self, user_id, card_id, old_item=None, new_item=None):
+        """Replaces the postings of a card, writing only the terms that changed
+
+        Args:
+            user_id (str): User unique identifier
+            card_id (str): Card unique identifier
+            old_item (dict, optional): Raw card item before the change, None for new cards
+            new_item (dict, optional): Raw card item after the change, None for deleted cards
+        """
+        requests = self.posting_requests(user_id, card_id, old_item, new_item)
+        unprocessed = batch_write(self.dynamodb, self.table_name, requests)
+        if unprocessed:
+            raise RuntimeError(f'{len(unprocessed)} search index postings could not be written for card {card_id}')
+
+    def posting_requests(self, user_id, card_id, old_item=None, new_item=None):
+        """Returns the BatchWriteItem requests that update() would write, so
+        several cards' postings can be written together
+        """
+        old_terms = self.item_terms(old_item) if old_item else set()
+        new_terms = self.item_terms(new_item) if new_item else set()
+
+        requests = [{'PutRequest': {'Item': self._posting(user_id, term, card_id)}}
+                    for term in sorted(new_terms - old_terms)]
+        requests += [{'DeleteRequest': {'Key': self._posting(user_id, term, card_id)}}
+                     for term in sorted(old_terms - new_terms)]
+        return requests
+
+    def search(self, user_id, filter):
+        """Returns the ids of the user's cards that contain every term of filter
+        (each as a whole word or word prefix), or None when filter has no terms
+        """
+        terms = self.query_terms(filter)
+        if not terms:
+            return None
+
+        # Longer terms tend to have fewer postings, so start with them and
+        # stop as soon as the intersection is empty
+        card_ids = None
+        for term in sorted(terms, key=len, reverse=True):
+            postings = self._postings(user_id, term)
+            card_ids = postings if card_ids is None else card_ids & postings
+            if not card_ids:
+                break
+        return card_ids
+
+    def _postings(self, user_id, term):
+        card_ids = set()
+        paginator = self.dynamodb.get_paginator('query')
+        for response in paginator.paginate(
+                TableName=self.table_name,
+                KeyConditionExpression='term_key = :term_key',
+                ExpressionAttributeValues={':term_key': {'S': f'{user_id}#{term}'}},
+                ProjectionExpression='card_id'):
+            card_ids.update(item['card_id']['S'] for item in response.get('Items', []))
+        return card_ids
+
+    def _posting(self, user_id, term, card_id):
+        return {'term_key': {'S': f'{user_id}#{term}'}, 'card_id': {'S': str(card_id)}}
+
+    def create_table(self):
+        """Creates the index table, billed per request"""
+        self.dynamodb.create_table(
+            TableName=self.table_name,
+            AttributeDefinitions=[
+                {'AttributeName': 'term_key', 'AttributeType': 'S'},
+                {'AttributeName': 'card_id', 'AttributeType': 'S'},
+            ],
+            KeySchema=[
+                {'AttributeName': 'term_key', 'KeyType': 'HASH'},
+                {'AttributeName': 'card_id', 'KeyType': 'RANGE'},
+            ],
+            BillingMode='PAY_PER_REQUEST')
@@ -1,11 +1,15 @@
-import boto3
 import logging
 
+from chalicelib import aws_clients
+
 class StorageService:
     def __init__(self, storage_location):
-        self.client = boto3.client('s3', region_name='us-east-1')
         self.bucket_name = storage_location
 
+    @property
+    def client(self):
+        return aws_clients.client('s3')
+
     def get_storage_location(self):
         return self.bucket_name
 
@@ -29,3 +33,151 @@ class StorageService:
             'fileId': file_name,
             'fileUrl': f"http://{self.bucket_name}.s3.amazonaws.com/{file_name}"
         }
+
+    def create_upload_url(self, file_name, content_type, max_bytes, expires_in=300):
+        """Creates a presigned POST so clients upload straight to the bucket.
+
+        S3 rejects the upload unless it has the given content type and is
+        at most max_bytes long.
+        """
+        fields = {'acl': 'public-read', 'Content-Type': content_type}
+        conditions = [
+            {'acl': 'public-read'},
+            {'Content-Type': content_type},
+            ['content-length-range', 1, max_bytes],
+        ]
+        post = self.client.generate_presigned_post(
+            Bucket=self.bucket_name,
+            Key=file_name,
+            Fields=fields,
+            Conditions=conditions,
+            ExpiresIn=expires_in
+        )
+
+        return {
+            'fileId': file_name,
+            'fileUrl': f"http://{self.bucket_name}.s3.amazonaws.com/{file_name}",
+            'uploadUrl': post['url'],
+            'fields': post['fields'],
+            'expiresIn': expires_in
+        }
+
+    def create_download_url(self, file_name, expires_in=900, download_name=None):
+        """Creates a presigned GET URL for a private file"""
+        params = {'Bucket': self.bucket_name, 'Key': file_name}
+        if download_name:
+            params['ResponseContentDisposition'] = f'attachment; filename="{download_name}"'
+        return self.client.generate_presigned_url('get_object', Params=params, ExpiresIn=expires_in)
+
+    def open_writer(self, file_name, content_type='application/octet-stream'):
+        """Returns a StreamingUpload that writes a private file in parts"""
+        return StreamingUpload(self.client, self.bucket_name, file_name, content_type)
+
+    def get_file_etag(self, file_name):
+        """Returns the S3 ETag of a stored file, which changes whenever its content changes"""
+        response = self.client.head_object(Bucket=self.bucket_name, Key=file_name)
+        return response['ETag'].strip('"')
+
+    def read_file(self, file_name):
+        """Returns the bytes of a stored file, or None if it does not exist"""
+        try:
+            response = self.client.get_object(Bucket=self.bucket_name, Key=file_name)
+        except self.client.exceptions.NoSuchKey:
+            return None
+        return response['Body'].read()
+
+    def get_file_metadata(self, file_name):
+        """Returns the user metadata of a stored file, or None if it does not exist"""
+        try:
+            response = self.client.head_object(Bucket=self.bucket_name, Key=file_name)
+        except self.client.exceptions.ClientError as e:
+            if e.response['Error']['Code'] in ('404', 'NoSuchKey'):
+                return None
+            raise
+        return response.get('Metadata', {})
+
+    def write_file(self, file_bytes, file_name, content_type='application/octet-stream', metadata=None):
+        """Stores a private (non public-read) file, used for internal artifacts"""
+        self.client.put_object(
+            Bucket=self.bucket_name,
+            Body=file_bytes,
+            Key=file_name,
+            ContentType=content_type,
+            Metadata=metadata or {}
+        )
+
+    def delete_files(self, prefix):
+        """Deletes every file whose key starts with prefix"""
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket_name, Prefix=prefix):
+            keys = [{'Key': obj['Key']} for obj in page.get('Contents', [])]
+            if keys:
+                self.client.delete_objects(Bucket=self.bucket_name, Delete={'Objects': keys})
+
+
+class StreamingUpload:
+    """Writes a file to S3 from many small writes while buffering at most one
+    part in memory. Files smaller than one part are stored with a single
+    put_object; larger ones with a multipart upload.
+    """
+    # S3 multipart parts must be at least 5 MB, except the last one
+    PART_SIZE = 8 * 1024 * 1024
+
+    def __init__(self, client, bucket_name, file_name, content_type):
+        self.client = client
+        self.bucket_name = bucket_name
+        self.file_name = file_name
+        self.content_type = content_type
+        self.buffer = bytearray()
+        self.upload_id = None
+        self.parts = []
+        self.size = 0
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        self.buffer += data
+        self.size += len(data)
+        if len(self.buffer) >= self.PART_SIZE:
+            self._upload_part()
+
+    def close(self):
+        """Uploads the remaining data and completes the file"""
+        if self.upload_id is None:
+            self.client.put_object(Bucket=self.bucket_name, Key=self.file_name,
+                                   Body=bytes(self.buffer), ContentType=self.content_type)
+        else:
+            if self.buffer:
+                self._upload_part()
+            self.client.complete_multipart_upload(
+                Bucket=self.bucket_name, Key=self.file_name, UploadId=self.upload_id,
+                MultipartUpload={'Parts': self.parts})
+        self.buffer = bytearray()
+
+    def abort(self):
+        """Discards the parts uploaded so far"""
+        if self.upload_id is not None:
+            self.client.abort_multipart_upload(Bucket=self.bucket_name, Key=self.file_name,
+                                               UploadId=self.upload_id)
+        self.buffer = bytearray()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def _upload_part(self):
+        if self.upload_id is None:
+            response = self.client.create_multipart_upload(Bucket=self.bucket_name, Key=self.file_name,
+                                                           ContentType=self.content_type)
+            self.upload_id = response['UploadId']
+        part_number = len(self.parts) + 1
+        response = self.client.upload_part(Bucket=self.bucket_name, Key=self.file_name,
+                                           UploadId=self.upload_id, PartNumber=part_number,
+                                           Body=bytes(self.buffer))
+        self.parts.append({'ETag': response['ETag'], 'PartNumber': part_number})
+        self.buffer = bytearray()
@@ -0,0 +1,80 @@
+"""Assembles OCR lines into the text fed to named entity recognition.
+
+Lines are put in reading order from their bounding boxes: rows top to
+bottom, lines of a row left to right. Each OCR line stays on its own text
+line (NER's address detection works line by line), and a vertical gap
+between rows starts a new visual block, separated by an empty line.
+"""
+from statistics import median
+
+# Lines below this OCR confidence are left out
+MIN_CONFIDENCE = 80.0
+# Lines whose vertical centers are closer than this fraction of the line
+# height belong to the same row
+ROW_TOLERANCE = 0.5
+# A gap between rows larger than this fraction of the median line height
+# starts a new block
+BLOCK_GAP = 0.75
+
+
+def _box(line):
+    box = line.get('boundingBox') or {}
+    return (box.get('Top', 0.0), box.get('Left', 0.0), box.get('Height', 0.0))
+
+
+def reading_order(lines):
+    """Groups lines into rows in reading order
+
+    Args:
+        lines (list): OCR lines with 'text' and 'boundingBox' (Top, Left, Height)
+
+    Returns:
+        list: Rows top to bottom, each a list of lines left to right
+    """
+    # Python's sort is stable, so lines without geometry keep their order
+    by_center = sorted(lines, key=lambda line: _box(line)[0] + _box(line)[2] / 2)
+
+    rows = []
+    row_center = row_height = None
+    for line in by_center:
+        top, _, height = _box(line)
+        center = top + height / 2
+        if rows and abs(center - row_center) <= ROW_TOLERANCE * max(height, row_height):
+            rows[-1].append(line)
+        else:
+            rows.append([line])
+            row_center, row_height = center, height
+
+    return [sorted(row, key=lambda line: _box(line)[1]) for row in rows]
+
+
+def assemble_text(lines, min_confidence=MIN_CONFIDENCE):
+    """Returns the confidently recognized lines as text in reading order,
+    one line per OCR line and an empty line between visual blocks
+
+    Args:
+        lines (list): OCR lines as returned by TextractService.detect_text
+        min_confidence (float, optional): Minimum OCR confidence. Defaults to MIN_CONFIDENCE.
+
+    Returns:
+        str: Text to feed NER
+    """
+    confident = [line for line in lines
+                 if line['text'] and float(line['confidence']) >= min_confidence]
+    if not confident:
+        return ''
+
+    heights = [_box(line)[2] for line in confident if _box(line)[2] > 0]
+    gap_limit = BLOCK_GAP * median(heights) if heights else None
+
+    parts = []
+    previous_bottom = None
+    for row in reading_order(confident):
+        top = min(_box(line)[0] for line in row)
+        if previous_bottom is not None:
+            gap = top - previous_bottom
+            parts.append('\n\n' if gap_limit is not None and gap > gap_limit else '\n')
+        parts.append('\n'.join(line['text'] for line in row))
+        previous_bottom = max(_box(line)[0] + _box(line)[2] for line in row)
+
+    return ''.join(parts)
@@ -1,28 +1,214 @@
-import boto3
+import hashlib
+import json
+import logging
+import os
+import threading
 
+from chalicelib import aws_clients
+from chalicelib import instrumentation
+from chalicelib.cache import LRUCache
+from chalicelib.ocr_engine import OcrEngine
+
+# Identity of the OCR configuration whose output gets cached. Changing any of
+# these moves the cache to a new namespace, so stale results are never served.
+OCR_ENGINE = 'textract.detect_document_text'
+# Words are already part of their LINE block's text
+OCR_BLOCK_TYPES = ('LINE',)
+OCR_CACHE_VERSION = 1
+
+
+class S3OcrCacheStore:
+    """Persistent OCR cache tier stored as JSON objects in the storage bucket"""
+
+    def __init__(self, storage_service, prefix='ocr-cache/'):
+        self.storage_service = storage_service
+        self.prefix = prefix
+
+    def get(self, key):
+        body = self.storage_service.read_file(self.prefix + key + '.json')
+        return None if body is None else json.loads(body)
+
+    def put(self, key, value):
+        self.storage_service.write_file(json.dumps(value).encode('utf-8'),
+                                        self.prefix + key + '.json',
+                                        content_type='application/json')
+
+    def delete(self, key):
+        self.storage_service.delete_files(self.prefix + key + '.json')
+
+    def clear(self, namespace=''):
+        self.storage_service.delete_files(self.prefix + namespace)
+
+
+class LocalOcrCacheStore:
+    """Persistent OCR cache tier kept on the local file system.
+
+    Stand-in for S3OcrCacheStore when running locally or in tests.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def _path(self, key):
+        return os.path.join(self.directory, *key.split('/')) + '.json'
+
+    def get(self, key):
+        try:
+            with open(self._path(key)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def put(self, key, value):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump(value, f)
+
+    def delete(self, key):
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def clear(self, namespace=''):
+        root = os.path.join(self.directory, namespace)
+        for dirpath, _, filenames in os.walk(root):
+            for filename in filenames:
+                if filename.endswith('.json'):
+                    os.remove(os.path.join(dirpath, filename))
+
+
+class OcrResultCache:
+    """Two tier (in-process LRU + optional persistent store) cache for OCR results.
+
+    Entries are addressed by image content (e.g. S3 ETag) inside a namespace
+    derived from the OCR engine, its parameters and a version number.
+    """
+
+    def __init__(self, max_entries=256, store=None, engine=OCR_ENGINE,
+                 params=None, version=OCR_CACHE_VERSION):
+        """Constructor
+
+        Args:
+            max_entries (int, optional): Size of the in-process LRU tier. Defaults to 256.
+            store (optional): Persistent tier (S3OcrCacheStore, LocalOcrCacheStore). Defaults to None.
+            engine (str, optional): OCR engine identifier. Defaults to OCR_ENGINE.
+            params (dict, optional): OCR parameters affecting the result. Defaults to the block types.
+            version (int, optional): Manual invalidation knob. Defaults to OCR_CACHE_VERSION.
+        """
+        self.memory = LRUCache(max_entries)
+        self.store = store
+        self._lock = threading.Lock()
+        self._stats = {'memory_hits': 0, 'store_hits': 0, 'misses': 0}
+        self.configure(engine, params if params is not None else {'block_types': list(OCR_BLOCK_TYPES)}, version)
+
+    def configure(self, engine, params, version):
+        """Sets the OCR engine identity. Entries produced by a different
+        engine, parameters or version are no longer visible afterwards.
+        """
+        identity = json.dumps({'engine': engine, 'params': params, 'version': version}, sort_keys=True)
+        self.namespace = hashlib.sha256(identity.encode('utf-8')).hexdigest()[:16]
+        self.memory.clear()
+
+    def _key(self, content_key):
+        return f"{self.namespace}/{content_key}"
+
+    def _count(self, stat):
+        with self._lock:
+            self._stats[stat] += 1
+
+    def get(self, content_key):
+        """Returns the cached OCR result for content_key, or None on a miss"""
+        key = self._key(content_key)
+        value = self.memory.get(key)
+        if value is not None:
+            self._count('memory_hits')
+            return value
+
+        if self.store is not None:
+            try:
+                value = self.store.get(key)
+            except Exception as e:
+                logging.warning(f"OCR cache store read failed for {key}: {e}")
+                value = None
+            if value is not None:
+                self.memory.put(key, value)
+                self._count('store_hits')
+                return value
+
+        self._count('misses')
+        return None
+
+    def put(self, content_key, value):
+        """Stores an OCR result in both tiers"""
+        key = self._key(content_key)
+        self.memory.put(key, value)
+        if self.store is not None:
+            try:
+                self.store.put(key, value)
+            except Exception as e:
+                logging.warning(f"OCR cache store write failed for {key}: {e}")
+
+    def invalidate(self, content_key):
+        """Removes a single image's entry from both tiers"""
+        key = self._key(content_key)
+        self.memory.delete(key)
+        if self.store is not None:
+            self.store.delete(key)
+
+    def clear(self):
+        """Removes every entry of the current namespace from both tiers"""
+        self.memory.clear()
+        if self.store is not None:
+            self.store.clear(self.namespace)
+
+    def get_stats(self):
+        """Returns hit/miss counters and the overall hit rate"""
+        with self._lock:
+            stats = dict(self._stats)
+        lookups = stats['memory_hits'] + stats['store_hits'] + stats['misses']
+        stats['hit_rate'] = (stats['memory_hits'] + stats['store_hits']) / lookups if lookups else 0.0
+        stats['entries'] = len(self.memory)
+        return stats
+
+
+class TextractService(OcrEngine):
+    name = OCR_ENGINE
 
-class TextractService:
     def __init__(self, storage_service):
-        self.client = boto3.client('textract', region_name='us-east-1')
         self.bucket_name = storage_service.get_storage_location()
 
+    @property
+    def client(self):
+        return aws_clients.client('textract')
+
     def detect_text(self, file_name):
-        print("file_name", file_name)
-        print("self: ", self)
-        print("self.bucket_name", self.bucket_name)
-        response = self.client.detect_document_text(
-            Document = {
-                'S3Object': {
-                    'Bucket': self.bucket_name,
-                    'Name': file_name
-                }
+        """Detects text in an image stored in the storage bucket"""
+        return self._detect_text(file_name)
+
+    def detect_text_bytes(self, file_bytes):
+        """Detects text in an image passed as bytes, without reading it from S3"""
+        return self._detect_document({'Bytes': file_bytes})
+
+    def _detect_text(self, file_name):
+        instrumentation.debug('Textract detect_text %s in bucket %s', file_name, self.bucket_name)
+        return self._detect_document({
+            'S3Object': {
+                'Bucket': self.bucket_name,
+                'Name': file_name
             }
+        })
+
+    def _detect_document(self, document):
+        response = self.client.detect_document_text(
+            Document = document
         )
         # print("response: ", response['Blocks'])
 
         lines = []
         for detection in response['Blocks']:
-            if detection['BlockType'] == 'LINE' or detection['BlockType'] == 'WORD':
+            if detection['BlockType'] in OCR_BLOCK_TYPES:
                 # print("detection: ", detection)
                 lines.append({
                     'text': detection['Text'],
@@ -30,7 +216,7 @@ class TextractService:
                     'boundingBox': detection['Geometry']['BoundingBox']
                 })
 
-        print("lines: ", lines)
+        instrumentation.debug('Textract lines: %s', lines)
 
         return lines
 
@@ -0,0 +1,63 @@
+import threading
+import time
+
+from botocore.exceptions import ClientError
+
+# Error codes AWS services use when a request exceeds a rate or throughput quota
+THROTTLING_ERROR_CODES = frozenset([
+    'ThrottlingException',
+    'Throttling',
+    'ThrottledException',
+    'TooManyRequestsException',
+    'ProvisionedThroughputExceededException',
+    'RequestLimitExceeded',
+    'RequestThrottled',
+    'RequestThrottledException',
+    'SlowDown',
+    'LimitExceededException',
+])
+
+
+def is_throttling(error):
+    """Returns True if error is an AWS throttling error"""
+    return (isinstance(error, ClientError)
+            and error.response.get('Error', {}).get('Code') in THROTTLING_ERROR_CODES)
+
+
+class TokenBucket:
+    """Thread-safe token bucket that spaces out calls to an API quota.
+
+    Tokens are added at rate per second up to burst; acquire() blocks until a
+    token is available, so callers queue up in the container instead of
+    hitting the service and being throttled.
+    """
+
+    def __init__(self, rate, burst=None):
+        """Constructor
+
+        Args:
+            rate (float): Tokens added per second (the TPS quota)
+            burst (float, optional): Maximum tokens saved up. Defaults to rate (at least 1).
+        """
+        self.rate = float(rate)
+        self.burst = float(burst if burst is not None else max(rate, 1))
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Takes a token, waiting for one if needed
+
+        Returns:
+            float: Seconds waited
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            # Reserve the token now, callers behind us wait for the next ones
+            self._tokens -= 1
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0.0
+        if wait:
+            time.sleep(wait)
+        return wait
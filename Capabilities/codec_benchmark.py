@@ -0,0 +1,119 @@
+"""Benchmark for decoding card items from DynamoDB.
+
+Decodes synthetic raw items with the previous hand-written decoders (copied
+below, together with the previous __dict__ based card class) and with
+card_codec, and reports items/sec and the bytes allocated while holding the
+decoded result. No AWS access is needed.
+
+Usage: python codec_benchmark.py [items]
+"""
+import sys
+import timeit
+import tracemalloc
+
+from chalicelib import card_codec
+
+
+class LegacyBusinessCard:
+    """BusinessCard before card_codec: a plain __dict__ class"""
+
+    def __init__(self, user_id=None, card_id=None, names='', telephone_numbers=[], email_addresses=[],
+                 company_name='', company_website='', company_address='', image_storage=''):
+        self.user_id = user_id
+        self.card_id = card_id
+        self.names = str(names).strip().capitalize()
+        self.telephone_numbers = telephone_numbers
+        self.email_addresses = email_addresses
+        self.company_name = company_name
+        self.company_website = company_website
+        self.company_address = str(company_address).strip()
+        self.image_storage = image_storage
+
+
+def legacy_card_from_item(item):
+    """Previous BusinessCardList / DynamoService decoder"""
+    c = LegacyBusinessCard()
+    if 'card_id' in item:
+        c.card_id = item['card_id']['S']
+    if 'user_id' in item:
+        c.user_id = item['user_id']['S']
+    if 'card_names' in item:
+        c.names = item['card_names']['S']
+    if 'telephone_numbers' in item:
+        c.telephone_numbers = item['telephone_numbers']['SS']
+    if 'email_addresses' in item:
+        c.email_addresses = item['email_addresses']['SS']
+    if 'company_name' in item:
+        c.company_name = item['company_name']['S']
+    if 'company_website' in item:
+        c.company_website = item['company_website']['S']
+    if 'company_address' in item:
+        c.company_address = item['company_address']['S']
+    return c
+
+
+def legacy_list_row(item, index):
+    """Previous get_cards row builder"""
+    phone = ''
+    if 'telephone_numbers' in item:
+        if 'SS' in item['telephone_numbers'] and item['telephone_numbers']['SS']:
+            phone = item['telephone_numbers']['SS'][0]
+        elif 'NS' in item['telephone_numbers'] and item['telephone_numbers']['NS']:
+            phone = item['telephone_numbers']['NS'][0]
+    email = ''
+    if 'email_addresses' in item:
+        if 'SS' in item['email_addresses'] and item['email_addresses']['SS']:
+            email = item['email_addresses']['SS'][0]
+    name = ''
+    if 'card_names' in item and 'S' in item['card_names']:
+        name = item['card_names']['S']
+    elif 'company_name' in item and 'S' in item['company_name']:
+        name = item['company_name']['S']
+    return {
+        'id': index,
+        'card_id': item.get('card_id', {}).get('S', ''),
+        'name': name,
+        'phone': phone,
+        'email': email,
+        'website': item.get('company_website', {}).get('S', ''),
+        'address': item.get('company_address', {}).get('S', ''),
+        'image_storage': item.get('image_storage', {}).get('S', ''),
+    }
+
+
+def synthetic_items(count):
+    return [{
+        'user_id': {'S': 'benchmark'},
+        'card_id': {'S': f'{i:08x}-0000-4000-8000-000000000000'},
+        'card_names': {'S': f'Person {i}'},
+        'telephone_numbers': {'SS': [f'+1555{i:07d}']},
+        'email_addresses': {'SS': [f'person{i}@example.com']},
+        'company_name': {'S': f'Company {i % 1000}'},
+        'company_website': {'S': f'www.company{i % 1000}.com'},
+        'company_address': {'S': f'{i} Main Street, Springfield'},
+        'image_storage': {'S': f'{i:08x}.jpg'},
+    } for i in range(count)]
+
+
+def measure(name, decode, items, repeat=5):
+    # Best of several runs; timeit keeps the garbage collector out of the timings
+    elapsed = min(timeit.repeat(lambda: decode(items), number=1, repeat=repeat))
+
+    tracemalloc.start()
+    result = decode(items)
+    allocated, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+
+    print(f'{name:<24} {len(items) / elapsed:>12,.0f} items/s {allocated:>14,} bytes')
+
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    items = synthetic_items(count)
+    print(f'Decoding {count:,} items')
+
+    measure('legacy cards', lambda items: [legacy_card_from_item(i) for i in items], items)
+    measure('card_codec.from_item', lambda items: [card_codec.from_item(i) for i in items], items)
+    measure('legacy list rows', lambda items: [legacy_list_row(i, n) for n, i in enumerate(items, 1)], items)
+    measure('card_codec.list_row', lambda items: [card_codec.list_row(i, n) for n, i in enumerate(items, 1)], items)
@@ -0,0 +1,126 @@
+"""Cold start benchmark for app.py.
+
+Every sample runs in a fresh Python process, like a new Lambda container:
+it times `import app`, then the first and a second request to one route
+through the chalice test client, and records which AWS clients the route
+created. The median of the samples is reported per route.
+
+With --offline every AWS call is answered by an empty 200 response before
+it is sent (and dummy credentials are used when none are configured), so
+the numbers only contain our own init and request overhead and are
+reproducible without an AWS account. Without it the routes call AWS.
+
+Usage: python cold_start_benchmark.py [--offline] [--samples N] [--json FILE]
+"""
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+USER_ID = 'cold-start-benchmark'
+CARD_ID = '00000000-0000-4000-8000-000000000000'
+
+ROUTES = [
+    ('GET', f'/cards/{USER_ID}', None),
+    ('GET', f'/cards/{USER_ID}?limit=10', None),
+    ('GET', f'/card/{USER_ID}/{CARD_ID}', None),
+    ('DELETE', f'/cards/{USER_ID}/{CARD_ID}', None),
+    ('POST', '/images/upload_url', {'filename': 'card.jpg', 'content_type': 'image/jpeg'}),
+]
+
+
+def answer_offline(request, **kwargs):
+    """before-send handler returning an empty successful response"""
+    from botocore.awsrequest import AWSResponse
+
+    class Body:
+        def __init__(self, content):
+            self.content = content
+
+        def stream(self, **kwargs):
+            yield self.content
+
+    # JSON protocols (DynamoDB, Comprehend, Textract) send X-Amz-Target
+    content = b'{}' if 'X-Amz-Target' in request.headers else b''
+    return AWSResponse(request.url, 200, {}, Body(content))
+
+
+def run_child(method, path, body, offline):
+    if offline:
+        os.environ.setdefault('AWS_ACCESS_KEY_ID', 'offline')
+        os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'offline')
+
+    start = time.perf_counter()
+    import app
+    import_time = time.perf_counter() - start
+
+    from chalice.test import Client
+    from chalicelib import aws_clients
+    if offline:
+        # Registered on the shared session, so every client created later gets it
+        aws_clients.session().events.register('before-send', answer_offline)
+
+    headers = {'Content-Type': 'application/json'} if body is not None else {}
+    payload = json.dumps(body) if body is not None else None
+    timings = []
+    with Client(app.app) as client:
+        for _ in range(2):
+            start = time.perf_counter()
+            response = client.http.request(method, path, headers=headers, body=payload)
+            timings.append(time.perf_counter() - start)
+
+    print(json.dumps({
+        'import': import_time,
+        'first_request': timings[0],
+        'second_request': timings[1],
+        'status': response.status_code,
+        'clients': aws_clients.created_clients(),
+    }))
+
+
+def sample(method, path, body, offline):
+    command = [sys.executable, __file__, '--child', method, path, json.dumps(body)]
+    if offline:
+        command.append('--offline')
+    output = subprocess.run(command, capture_output=True, text=True, check=True,
+                            cwd=os.path.dirname(os.path.abspath(__file__))).stdout
+    # The app prints while handling requests, the result is the last line
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def benchmark(samples, offline):
+    results = []
+    for method, path, body in ROUTES:
+        runs = [sample(method, path, body, offline) for _ in range(samples)]
+        results.append({
+            'route': f'{method} {path}',
+            'import_ms': statistics.median(r['import'] for r in runs) * 1000,
+            'first_request_ms': statistics.median(r['first_request'] for r in runs) * 1000,
+            'second_request_ms': statistics.median(r['second_request'] for r in runs) * 1000,
+            'status': runs[-1]['status'],
+            'clients': runs[-1]['clients'],
+        })
+    return results
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    offline = '--offline' in args
+
+    if args and args[0] == '--child':
+        run_child(args[1], args[2], json.loads(args[3]), offline)
+        sys.exit()
+
+    samples = int(args[args.index('--samples') + 1]) if '--samples' in args else 5
+    results = benchmark(samples, offline)
+
+    print(f'{"route":<72} {"import":>9} {"first":>9} {"second":>9} status  clients')
+    for r in results:
+        print(f'{r["route"]:<72} {r["import_ms"]:>7.1f}ms {r["first_request_ms"]:>7.1f}ms '
+              f'{r["second_request_ms"]:>7.1f}ms {r["status"]:>6}  {", ".join(r["clients"]) or "-"}')
+
+    if '--json' in args:
+        with open(args[args.index('--json') + 1], 'w') as f:
+            json.dump({'offline': offline, 'samples': samples, 'routes': results}, f, indent=2)
@@ -0,0 +1,91 @@
+"""Benchmark for the image normalization stage that runs before OCR.
+
+For every image in a directory it normalizes the image, uploads the
+original and the normalized variant to the storage bucket (under
+benchmark/), runs Textract on both and reports bytes saved, normalization
+time, OCR latency and whether the recognized text is the same.
+
+Requires AWS credentials with access to the bucket and Textract.
+
+Usage: python normalization_benchmark.py <images_directory> [max_dimension]
+"""
+import os
+import sys
+import time
+
+from chalicelib.image_normalization_service import ImageNormalizationService
+from chalicelib.storage_service import StorageService
+from chalicelib.textract_service import TextractService
+
+MIN_CONFIDENCE = 80.0
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.tif', '.tiff')
+
+
+def recognized_text(lines):
+    return [line['text'] for line in lines
+            if line['text'] and float(line['confidence']) >= MIN_CONFIDENCE]
+
+
+def timed_ocr(textract, file_name):
+    start = time.perf_counter()
+    lines = textract.detect_text(file_name)
+    return recognized_text(lines), time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        sys.exit(__doc__)
+    directory = sys.argv[1]
+    max_dimension = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+
+    storage = StorageService('business-cards-bucket2')
+    textract = TextractService(storage)
+    normalizer = ImageNormalizationService(storage, max_dimension)
+    if not normalizer.is_available():
+        sys.exit('Pillow is not installed')
+
+    totals = {'original_bytes': 0, 'normalized_bytes': 0, 'original_ocr': 0.0,
+              'normalized_ocr': 0.0, 'normalize': 0.0, 'same_text': 0, 'images': 0}
+    try:
+        for file_name in sorted(os.listdir(directory)):
+            if not file_name.lower().endswith(IMAGE_EXTENSIONS):
+                continue
+            with open(os.path.join(directory, file_name), 'rb') as f:
+                original = f.read()
+
+            start = time.perf_counter()
+            normalized = normalizer.normalize(original)
+            normalize_time = time.perf_counter() - start
+
+            storage.write_file(original, f'benchmark/original/{file_name}')
+            storage.write_file(normalized, f'benchmark/normalized/{file_name}')
+            original_text, original_ocr = timed_ocr(textract, f'benchmark/original/{file_name}')
+            normalized_text, normalized_ocr = timed_ocr(textract, f'benchmark/normalized/{file_name}')
+            same_text = original_text == normalized_text
+
+            totals['images'] += 1
+            totals['original_bytes'] += len(original)
+            totals['normalized_bytes'] += len(normalized)
+            totals['original_ocr'] += original_ocr
+            totals['normalized_ocr'] += normalized_ocr
+            totals['normalize'] += normalize_time
+            totals['same_text'] += same_text
+            print(f'{file_name}: {len(original):,} -> {len(normalized):,} bytes, '
+                  f'normalize {normalize_time * 1000:.0f} ms, '
+                  f'OCR {original_ocr * 1000:.0f} -> {normalized_ocr * 1000:.0f} ms, '
+                  f'text {"same" if same_text else "DIFFERENT"}')
+            if not same_text:
+                print(f'  original:   {original_text}')
+                print(f'  normalized: {normalized_text}')
+    finally:
+        storage.delete_files('benchmark/')
+
+    images = totals['images']
+    if images:
+        saved = totals['original_bytes'] - totals['normalized_bytes']
+        print(f'\n{images} images, {saved:,} bytes saved '
+              f'({saved / totals["original_bytes"]:.0%}), '
+              f'mean normalize {totals["normalize"] / images * 1000:.0f} ms, '
+              f'mean OCR {totals["original_ocr"] / images * 1000:.0f} -> '
+              f'{totals["normalized_ocr"] / images * 1000:.0f} ms, '
+              f'same text for {totals["same_text"]}/{images}')
@@ -0,0 +1,84 @@
+"""Creates the AWS resources the app expects besides the Lambda functions
+and backfills data for features enabled on an existing deployment.
+
+Requires AWS credentials allowed to manage the tables and queues.
+
+Usage: python provision.py <command>
+
+Commands:
+    create-search-index   Creates the search index table (SEARCH_INDEX)
+    reindex-cards         Indexes every stored card. Run it with SEARCH_INDEX
+                          set to write on the deployed stage, so cards written
+                          meanwhile are indexed too, then switch it to on.
+    create-names-index    Adds the names index (NAMES_INDEX) to the cards
+                          table. DynamoDB builds it in the background.
+    backfill-name-sort-keys
+                          Writes the name sort key of cards stored without
+                          one. Run it once the index is active, then set
+                          NAMES_INDEX to on.
+    create-recognition-results
+                          Creates the table of the entities precomputed on
+                          upload. Run it before deploying precompute_entities.
+    create-jobs           Creates the bulk recognition jobs table, queue and
+                          dead-letter queue. Run it before deploying, chalice
+                          deploy subscribes the workers to existing queues.
+"""
+import sys
+
+import app
+from chalicelib.dynamo_service import DynamoService
+from chalicelib.recognition_jobs import RecognitionJobQueue, RecognitionJobStore
+from chalicelib.recognition_results import RecognitionResultStore
+
+
+def cards_service():
+    # Independent of the stage's SEARCH_INDEX and NAMES_INDEX settings
+    return DynamoService(app.table_name, app.search_index_table_name, app.names_index_name)
+
+
+def create_search_index():
+    cards_service().search_index.create_table()
+    print(f'Creating table {app.search_index_table_name}')
+
+
+def reindex_cards():
+    count = cards_service().reindex_all_cards()
+    print(f'Indexed {count} cards')
+
+
+def create_names_index():
+    cards_service().create_names_index()
+    print(f'Creating index {app.names_index_name} of {app.table_name}')
+
+
+def backfill_name_sort_keys():
+    count = cards_service().backfill_name_sort_keys()
+    print(f'Updated {count} cards')
+
+
+def create_recognition_results():
+    RecognitionResultStore(app.recognition_results_table_name).create_table()
+    print(f'Creating table {app.recognition_results_table_name}')
+
+
+def create_jobs():
+    RecognitionJobStore(app.jobs_table_name).create_table()
+    print(f'Creating table {app.jobs_table_name}')
+    RecognitionJobQueue(app.jobs_queue_name, app.jobs_dead_letter_queue_name).create_queues()
+    print(f'Created queues {app.jobs_queue_name} and {app.jobs_dead_letter_queue_name}')
+
+
+COMMANDS = {
+    'create-search-index': create_search_index,
+    'reindex-cards': reindex_cards,
+    'create-names-index': create_names_index,
+    'backfill-name-sort-keys': backfill_name_sort_keys,
+    'create-recognition-results': create_recognition_results,
+    'create-jobs': create_jobs,
+}
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 2 or sys.argv[1] not in COMMANDS:
+        sys.exit(__doc__)
+    COMMANDS[sys.argv[1]]()